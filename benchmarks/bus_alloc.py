@@ -0,0 +1,137 @@
+"""
+Measures python heap allocations per message on the bus send / receive path with tracemalloc.
+
+Compares the previous implementation (copying receive, str topics, rebuilding (de)serialization)
+with the current one (services.service._send_msg / _recv_msg / _(de)serialize_content).
+
+For each message, the tracemalloc peak is reset before the message is processed, so the reported values are the
+additional heap bytes needed (at most) while sending / receiving one message, and the number of memory blocks
+still allocated by the (de)serialized message afterwards.
+
+Usage (from the repository root):
+    python benchmarks/bus_alloc.py [--messages 1000]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import zmq
+
+from services.service import _send_msg, _recv_msg, _serialize_content, _deserialize_content
+from utils.useract import UserAct, UserActionType
+
+
+TOPIC = "user_acts/ELearning"
+
+
+# previous implementation (for comparison)
+def legacy_serialize_content(content):
+    if isinstance(content, dict):
+        return {key: legacy_serialize_content(content[key]) for key in content}
+    elif isinstance(content, list):
+        return [legacy_serialize_content(item) for item in content]
+    elif isinstance(content, UserAct):
+        return _serialize_content(content)
+    return content
+
+
+def legacy_deserialize_content(content):
+    if isinstance(content, dict):
+        if len(content.keys()) == 2 and '_type' in content and 'value' in content:
+            return _deserialize_content(content)
+        return {key: legacy_deserialize_content(content[key]) for key in content}
+    elif isinstance(content, list):
+        return [legacy_deserialize_content(item) for item in content]
+    return content
+
+
+def legacy_send(pub_channel, topic: str, content, user_id):
+    data = json.dumps({'timestamp': datetime.now().timestamp(), 'content': legacy_serialize_content(content), 'user_id': user_id})
+    pub_channel.send_multipart((bytes(topic, encoding="ascii"), bytes(data, encoding='ascii')))
+
+
+def legacy_recv(sub_channel):
+    msg = sub_channel.recv_multipart(copy=True)
+    topic = msg[0].decode("ascii")
+    data = json.loads(msg[1])
+    return topic, legacy_deserialize_content(data['content'])
+
+
+def current_send(pub_channel, topic: bytes, content, user_id):
+    _send_msg(pub_channel, topic, _serialize_content(content), user_id)
+
+
+def current_recv(sub_channel):
+    topic, data = _recv_msg(sub_channel)
+    return topic, _deserialize_content(data['content'])
+
+
+def make_payloads():
+    user_acts = [UserAct(text="what is the next quiz", act_type=UserActionType.Search, slot="quiz", value=None, score=0.9),
+                 UserAct(text="what is the next quiz", act_type=UserActionType.RequestHelp, slot="section", value="Topic A", score=0.7)]
+    return {
+        "small (2 user acts)": user_acts,
+        "nested (50 dicts)": {"modules": [{"cmid": idx, "name": f"Module {idx}", "completed": idx % 2 == 0, "grades": [1.0, 0.5]}
+                                          for idx in range(50)]},
+        "large (200 KB text)": {"summary": "x" * 200000},
+    }
+
+
+def measure(label: str, func, num_messages: int):
+    peaks = []
+    blocks = []
+    for _ in range(num_messages):
+        gc.collect()
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        start_blocks = sys.getallocatedblocks()
+        result = func()
+        blocks.append(sys.getallocatedblocks() - start_blocks)
+        peaks.append(tracemalloc.get_traced_memory()[1] - start_size)
+        del result
+    print(f"  {label:<10} peak bytes/msg: {sum(peaks) / len(peaks):>10.0f}   blocks held by result: {sum(blocks) / len(blocks):>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tracemalloc allocation comparison for the bus send / receive path")
+    parser.add_argument("--messages", type=int, default=1000, help="number of messages per measurement")
+    args = parser.parse_args()
+
+    ctx = zmq.Context.instance()
+    pub = ctx.socket(zmq.PUB)
+    pub.sndhwm = 1100000
+    pub.bind("inproc://bus_alloc")
+    sub = ctx.socket(zmq.SUB)
+    sub.rcvhwm = 1100000
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    sub.connect("inproc://bus_alloc")
+    time.sleep(0.1)
+    topic_bytes = bytes(TOPIC, encoding="ascii")
+
+    tracemalloc.start()
+    for name, payload in make_payloads().items():
+        print(f"{name}")
+        print(" send")
+        measure("legacy", lambda: legacy_send(pub, TOPIC, payload, 1), args.messages)
+        measure("current", lambda: current_send(pub, topic_bytes, payload, 1), args.messages)
+        # drain queued messages
+        for _ in range(2 * args.messages):
+            sub.recv_multipart()
+
+        print(" receive")
+        for recv in (legacy_recv, current_recv):
+            for _ in range(args.messages):
+                current_send(pub, topic_bytes, payload, 1)
+            measure("legacy" if recv is legacy_recv else "current", lambda: recv(sub), args.messages)
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
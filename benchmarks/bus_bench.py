@@ -0,0 +1,270 @@
+"""
+Microbenchmarks of the messaging core (services.service / services.bus) with synthetic services.
+
+Scenarios:
+* latency:    publish-to-callback latency of single messages (one producer, one consumer, sequential)
+* throughput: messages / s of one producer sending as fast as possible to one consumer
+* fanout:     one producer, N subscribers of the same topic (latency until all subscribers were called, burst throughput)
+* join:       cost of multi-topic joins: consumer subscribing to 3 topics published together vs. a single topic consumer
+* handshake:  `DialogSystem._start_dialog` duration (control plane round trip) as the number of started users grows
+
+Every scenario runs in its own process for each combination of bus topology (proxy, sharded, brokerless)
+and transport (tcp, inproc). Messages are always encoded as JSON (the only codec of the bus, recorded in the result).
+Results are printed as table and written to a JSON file (including the git revision), so changes to
+services/service.py can be compared with the numbers of the previous version.
+
+Usage (from the repository root):
+    python benchmarks/bus_bench.py [--scenarios latency throughput fanout join handshake] [--topologies proxy sharded brokerless]
+                                   [--protocols tcp inproc] [--fanout 1 4 16] [--messages 5000] [--users 1000] [--output result.json]
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+
+SCENARIOS = ["latency", "throughput", "fanout", "join", "handshake"]
+CODEC = "json"
+USER_ID = 1
+
+
+def percentiles(values: List[float]) -> dict:
+    """ p50 / p99 / mean of latencies in microseconds """
+    if not values:
+        return {"p50_us": None, "p99_us": None, "mean_us": None}
+    ordered = sorted(values)
+    # nearest rank: ceil(p * n) - 1
+    return {"p50_us": ordered[max(0, math.ceil(len(ordered) * 0.5) - 1)] * 1e6, "p99_us": ordered[max(0, math.ceil(len(ordered) * 0.99) - 1)] * 1e6,
+            "mean_us": sum(ordered) / len(ordered) * 1e6}
+
+
+class _Counter:
+    """ Counts callbacks, sets `done` as soon as `target` callbacks were counted """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.target = 0
+        self.done = threading.Event()
+
+    def expect(self, target: int):
+        with self._lock:
+            self.count = 0
+            self.target = target
+            self.done.clear()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+            if self.count >= self.target:
+                self.done.set()
+
+
+def build_services(scenario: str, protocol: str, fanout: int, counter: _Counter):
+    from services.service import Service, PublishSubscribe
+
+    class Producer(Service):
+        @PublishSubscribe(pub_topics=["bench_ping"])
+        def ping(self, user_id, idx):
+            return {"bench_ping": idx}
+
+        @PublishSubscribe(pub_topics=["bench_a"])
+        def single(self, user_id, idx):
+            return {"bench_a": idx}
+
+        @PublishSubscribe(pub_topics=["bench_a", "bench_b", "bench_c"])
+        def multi(self, user_id, idx):
+            return {"bench_a": idx, "bench_b": idx, "bench_c": idx}
+
+    # subscriber function keywords have to match the topic names
+    class PingConsumer(Service):
+        @PublishSubscribe(sub_topics=["bench_ping"])
+        def consume(self, user_id, bench_ping):
+            counter.add()
+
+    class SingleTopicConsumer(Service):
+        @PublishSubscribe(sub_topics=["bench_a"])
+        def consume(self, user_id, bench_a):
+            counter.add()
+
+    class JoinConsumer(Service):
+        @PublishSubscribe(sub_topics=["bench_a", "bench_b", "bench_c"])
+        def consume(self, user_id, bench_a, bench_b, bench_c):
+            counter.add()
+
+    producer = Producer(domain="", protocol=protocol)
+    if scenario in ("latency", "throughput"):
+        consumers = [PingConsumer(domain="", protocol=protocol)]
+    elif scenario == "fanout":
+        consumers = [PingConsumer(domain="", identifier=f"PingConsumer{idx}", protocol=protocol) for idx in range(fanout)]
+    elif scenario == "join":
+        consumers = [JoinConsumer(domain="", protocol=protocol)]
+    elif scenario == "join_baseline":
+        consumers = [SingleTopicConsumer(domain="", protocol=protocol)]
+    else:
+        # handshake: a dialog graph of typical size (producer + 4 consumers)
+        consumers = [PingConsumer(domain="", identifier=f"PingConsumer{idx}", protocol=protocol) for idx in range(4)]
+    return producer, consumers
+
+
+def sequential(send, counter: _Counter, expected: int, num_messages: int, timeout: float) -> List[float]:
+    """ Sends one message at a time, returns the durations until `expected` callbacks were called """
+    durations = []
+    for idx in range(num_messages):
+        counter.expect(expected)
+        start = time.perf_counter()
+        send(idx)
+        if not counter.done.wait(timeout):
+            break
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def burst(send, counter: _Counter, expected: int, num_messages: int, timeout: float) -> dict:
+    """ Sends all messages as fast as possible, returns the duration until all callbacks were called """
+    counter.expect(expected * num_messages)
+    start = time.perf_counter()
+    for idx in range(num_messages):
+        send(idx)
+    counter.done.wait(timeout)
+    elapsed = time.perf_counter() - start
+    return {"sent": num_messages, "callbacks": counter.count, "seconds": elapsed,
+            "msgs_per_s": counter.count / expected / elapsed if elapsed > 0 else 0.0}
+
+
+def run_scenario(scenario: str, topology: str, protocol: str, fanout: int, num_messages: int, num_users: int, timeout: float) -> dict:
+    from services.service import DialogSystem
+
+    counter = _Counter()
+    producer, consumers = build_services(scenario, protocol, fanout, counter)
+    ds = DialogSystem(services=[producer] + consumers, protocol=protocol, topology=topology)
+    result = {"scenario": scenario, "topology": topology, "protocol": protocol, "codec": CODEC}
+
+    if scenario == "handshake":
+        durations = []
+        for user_id in range(1, num_users + 1):
+            start = time.perf_counter()
+            ds._start_dialog(start_signals={}, user_id=user_id)
+            durations.append(time.perf_counter() - start)
+        # _start_dialog duration by number of users already started
+        result["services"] = len(consumers) + 1
+        result["start_dialog"] = {}
+        lower = 0
+        upper = 10
+        while lower < num_users:
+            result["start_dialog"][f"{lower + 1}-{min(upper, num_users)}"] = percentiles(durations[lower:upper])
+            lower, upper = upper, upper * 10
+        batch = list(range(num_users + 1, num_users + 101))
+        start = time.perf_counter()
+        ds.start_dialogs(batch)
+        result["start_dialogs_batch_100_ms"] = (time.perf_counter() - start) * 1000.0
+        return result
+
+    ds.start_dialogs([USER_ID])
+    time.sleep(0.5)
+    ping = lambda idx: producer.ping(user_id=USER_ID, idx=idx)
+    if scenario == "latency":
+        result.update(percentiles(sequential(ping, counter, 1, num_messages, timeout)))
+    elif scenario == "throughput":
+        result.update(burst(ping, counter, 1, num_messages, timeout))
+    elif scenario == "fanout":
+        result["subscribers"] = fanout
+        result.update(percentiles(sequential(ping, counter, fanout, num_messages // 4, timeout)))
+        result.update(burst(ping, counter, fanout, num_messages, timeout))
+    elif scenario in ("join", "join_baseline"):
+        # join: 3 topics published together, consumer called once; baseline: 1 topic
+        if scenario == "join":
+            send = lambda idx: producer.multi(user_id=USER_ID, idx=idx)
+        else:
+            send = lambda idx: producer.single(user_id=USER_ID, idx=idx)
+        result.update(percentiles(sequential(send, counter, 1, num_messages // 4, timeout)))
+        result.update(burst(send, counter, 1, num_messages, timeout))
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def format_row(result: dict) -> str:
+    scenario = result["scenario"]
+    if scenario == "latency":
+        return f"p50 {result['p50_us']:.0f} us, p99 {result['p99_us']:.0f} us"
+    if scenario == "throughput":
+        return f"{result['msgs_per_s']:.0f} msgs/s ({result['callbacks']}/{result['sent']} received)"
+    if scenario == "fanout":
+        return f"1->{result['subscribers']}: p50 {result['p50_us']:.0f} us, p99 {result['p99_us']:.0f} us, {result['msgs_per_s']:.0f} msgs/s"
+    if scenario == "join":
+        single = result["single"]
+        return (f"join p50 {result['p50_us']:.0f} us / {result['msgs_per_s']:.0f} calls/s, "
+                f"single topic p50 {single['p50_us']:.0f} us / {single['msgs_per_s']:.0f} calls/s")
+    buckets = ", ".join(f"users {users}: {stats['mean_us'] / 1000:.2f} ms" for users, stats in result["start_dialog"].items())
+    return f"{buckets}, batch of 100: {result['start_dialogs_batch_100_ms']:.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message bus microbenchmarks")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--topologies", nargs="+", default=["proxy", "sharded", "brokerless"])
+    parser.add_argument("--protocols", nargs="+", default=["tcp", "inproc"])
+    parser.add_argument("--fanout", nargs="+", type=int, default=[1, 4, 16], help="numbers of subscribers (fanout scenario)")
+    parser.add_argument("--messages", type=int, default=5000, help="messages per burst (sequential measurements: 1/4 of it)")
+    parser.add_argument("--users", type=int, default=1000, help="users started one by one (handshake scenario)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="max. seconds to wait for callbacks")
+    parser.add_argument("--output", help="result file (default: logs/benchmarks/bus_bench_<date>.json)")
+    parser.add_argument("--run", nargs=4, help=argparse.SUPPRESS)  # internal: scenario topology protocol fanout
+    args = parser.parse_args()
+
+    if args.run:
+        scenario, topology, protocol, fanout = args.run
+        result = run_scenario(scenario, topology, protocol, int(fanout), args.messages, args.users, args.timeout)
+        print(json.dumps(result), flush=True)
+        os._exit(0)  # services do not shut down their threads
+
+    def run(scenario: str, topology: str, protocol: str, fanout: int = 1) -> dict:
+        output = subprocess.run([sys.executable, os.path.realpath(__file__), "--run", scenario, topology, protocol, str(fanout),
+                                 "--messages", str(args.messages), "--users", str(args.users), "--timeout", str(args.timeout)],
+                                capture_output=True, text=True).stdout
+        try:
+            return json.loads(output.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            return None
+
+    results = []
+    for scenario in args.scenarios:
+        print(scenario)
+        for protocol in args.protocols:
+            for topology in args.topologies:
+                for fanout in (args.fanout if scenario == "fanout" else [1]):
+                    result = run(scenario, topology, protocol, fanout)
+                    if result is not None and scenario == "join":
+                        # baseline: same delivery with a single topic
+                        result["single"] = run("join_baseline", topology, protocol)
+                    if result is None or (scenario == "join" and result["single"] is None):
+                        print(f"  {protocol:<7} {topology:<11} failed")
+                        continue
+                    results.append(result)
+                    print(f"  {protocol:<7} {topology:<11} {format_row(result)}")
+
+    output = args.output or os.path.join(ROOT_DIR, "logs", "benchmarks", f"bus_bench_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    os.makedirs(os.path.dirname(os.path.realpath(output)), exist_ok=True)
+    with open(output, "w") as result_file:
+        json.dump({"benchmark": "bus_bench", "date": datetime.now().isoformat(timespec="seconds"), "revision": git_revision(),
+                   "codec": CODEC, "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "run")},
+                   "results": results}, result_file, indent=2)
+    print(f"result written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Measures message bus throughput (messages / second) for each bus topology (see services.bus).
+
+Three producer services publish concurrently (one thread each) to topics of different families
+(user_utterance, sys_acts, beliefstate), three consumer services count the received messages.
+Each topology runs in its own process.
+
+Usage (from the repository root):
+    python benchmarks/bus_topology.py [--messages 20000] [--topologies proxy sharded brokerless] [--protocol tcp]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+TOPICS = ["user_utterance", "sys_acts", "beliefstate"]
+USER_ID = 1
+
+
+def run_topology(topology: str, protocol: str, num_messages: int, timeout: float) -> dict:
+    from services.service import Service, PublishSubscribe, DialogSystem
+
+    def make_producer(topic: str) -> Service:
+        class Producer(Service):
+            @PublishSubscribe(pub_topics=[topic])
+            def produce(self, user_id, idx):
+                return {topic: idx}
+        return Producer(domain="", protocol=protocol)
+
+    class Consumer(Service):
+        received = 0
+
+    # subscriber function keywords have to match the topic names
+    class UtteranceConsumer(Consumer):
+        @PublishSubscribe(sub_topics=["user_utterance"])
+        def consume(self, user_id, user_utterance):
+            self.received += 1
+
+    class SysActConsumer(Consumer):
+        @PublishSubscribe(sub_topics=["sys_acts"])
+        def consume(self, user_id, sys_acts):
+            self.received += 1
+
+    class BeliefstateConsumer(Consumer):
+        @PublishSubscribe(sub_topics=["beliefstate"])
+        def consume(self, user_id, beliefstate):
+            self.received += 1
+
+    producers = [make_producer(topic) for topic in TOPICS]
+    consumers = [consumer_class(domain="", protocol=protocol) for consumer_class in (UtteranceConsumer, SysActConsumer, BeliefstateConsumer)]
+    ds = DialogSystem(services=producers + consumers, protocol=protocol, topology=topology)
+    ds.start_dialogs([USER_ID])
+    time.sleep(0.5)
+
+    def produce(producer):
+        for idx in range(num_messages):
+            producer.produce(user_id=USER_ID, idx=idx)
+
+    threads = [threading.Thread(target=produce, args=(producer,)) for producer in producers]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    expected = num_messages * len(TOPICS)
+    while sum(consumer.received for consumer in consumers) < expected and time.perf_counter() - start < timeout:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    received = sum(consumer.received for consumer in consumers)
+    return {"topology": topology, "sent": expected, "received": received, "seconds": elapsed, "msgs_per_s": received / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message bus throughput per topology")
+    parser.add_argument("--messages", type=int, default=20000, help="messages per producer")
+    parser.add_argument("--topologies", nargs="+", default=["proxy", "sharded", "brokerless"])
+    parser.add_argument("--protocol", default="tcp", help="tcp or inproc")
+    parser.add_argument("--timeout", type=float, default=60.0, help="max. seconds to wait for all messages")
+    parser.add_argument("--run", help=argparse.SUPPRESS)  # internal: run one topology in this process
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_topology(args.run, args.protocol, args.messages, args.timeout)), flush=True)
+        os._exit(0)  # services do not shut down their threads
+
+    print(f"{'topology':<12} {'received':>16} {'seconds':>8} {'msgs/s':>10}")
+    for topology in args.topologies:
+        output = subprocess.run([sys.executable, os.path.realpath(__file__), "--run", topology, "--protocol", args.protocol,
+                                 "--messages", str(args.messages), "--timeout", str(args.timeout)],
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{topology:<12} {result['received']:>7}/{result['sent']:<8} {result['seconds']:>8.2f} {result['msgs_per_s']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
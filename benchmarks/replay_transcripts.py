@@ -0,0 +1,84 @@
+"""
+Replays scripted conversations through the ELearning dialog system in-process (no tornado, see services.hci.transcript)
+and checks output equivalence and latency budgets. Exits with status 1 if any check failed.
+
+Record the outputs of a known good version as expected outputs first, then replay after changes:
+    python tools/moodle_stub.py --port 8081 &
+    export MOODLE_SERVER_WEB_HOST=localhost:8081 MOODLE_SERVER_SSL=false
+    python benchmarks/replay_transcripts.py --record             # writes the captured outputs into the transcripts as "expect"
+    python benchmarks/replay_transcripts.py [--repeat 5] [resources/transcripts/search.json ...] [--output result.json]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="in-process transcript replay (turn regression and timing)")
+    parser.add_argument("transcripts", nargs="*", help="transcript files (default: resources/transcripts/*.json)")
+    parser.add_argument("--record", action="store_true", help="store the captured outputs as expected outputs in the transcript files")
+    parser.add_argument("--repeat", type=int, default=1, help="replay every transcript several times (new user for each run)")
+    parser.add_argument("--first-userid", type=int, default=100000)
+    parser.add_argument("--turn-timeout", type=float, default=30.0)
+    parser.add_argument("--settle", type=float, default=0.3, help="seconds to wait for further messages after an answer")
+    parser.add_argument("--verbose", action="store_true", help="print the messages of every turn")
+    parser.add_argument("--output", help="result file (JSON)")
+    args = parser.parse_args()
+
+    from elearning import load_elearning_domain
+    from services.hci.transcript import TranscriptRunner, record_expectations, summarize
+    from utils.logger import configure_error_logger
+
+    configure_error_logger()
+    paths = args.transcripts or sorted(glob.glob(os.path.join(ROOT_DIR, "resources", "transcripts", "*.json")))
+    domain, services = load_elearning_domain()
+    runner = TranscriptRunner(domain, services, turn_timeout=args.turn_timeout, settle=args.settle)
+
+    user_id = args.first_userid
+    all_results = []
+    report = []
+    failed = False
+    for path in paths:
+        with open(path, encoding="utf-8") as transcript_file:
+            transcript = json.load(transcript_file)
+        name = transcript.get("name", os.path.basename(path))
+        for run in range(args.repeat):
+            results = runner.run(transcript, user_id)
+            user_id += 1
+            all_results.extend(results)
+            report.append({"transcript": name, "run": run, "turns": [result.to_dict() for result in results]})
+            for result in results:
+                latency = f"{result.latency * 1000.0:7.0f} ms" if result.latency is not None else "     - ms"
+                status = "ok" if not result.failures or args.record else "FAIL"
+                print(f"{name} #{run} turn {result.index:<3} {result.kind:<5} {latency} {status:<4} {result.text[:60]}")
+                if args.verbose:
+                    for message in result.messages:
+                        print(f"      > {message}")
+                if not args.record:
+                    for failure in result.failures:
+                        print(f"      ! {failure}")
+                        failed = True
+            if args.record and run == 0:
+                with open(path, "w", encoding="utf-8") as transcript_file:
+                    json.dump(record_expectations(transcript, results), transcript_file, indent=2, ensure_ascii=False)
+
+    stats, stages = summarize(all_results)
+    print(f"\n{stats['answered']}/{stats['turns']} turns answered, latency p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, max {stats['max_ms']} ms")
+    print("mean time per turn:")
+    for name, milliseconds in stages.items():
+        print(f"  {name:<50} {milliseconds:8.1f} ms")
+    if args.output:
+        with open(args.output, "w") as result_file:
+            json.dump({"date": datetime.now().isoformat(timespec="seconds"), "summary": stats, "stages_ms": stages, "runs": report},
+                      result_file, indent=2, ensure_ascii=False)
+    os._exit(1 if failed else 0)  # services do not shut down their threads
+
+
+if __name__ == "__main__":
+    main()
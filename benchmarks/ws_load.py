@@ -0,0 +1,259 @@
+"""
+End-to-end turn benchmark: simulates N moodle clients against the /ws endpoint of a running run_server.py.
+
+Each client connects to /ws, sends start_dialog and then a scripted mix of user utterances
+(drawn from resources/new_corpus and resources/test_corpus_test.csv), interleaved with
+course module completion events posted to /event.
+A turn is the time from sending a user utterance until the first frame with system messages arrives.
+
+Reports throughput (turns / s), p50 / p95 / p99 turn latency, error rate (timeouts, failed connections,
+failed event posts) and the RSS of the server process (pid from /health, read from /proc - server on this machine only).
+Every run writes a JSON result file (including the git revision), so results of different versions can be compared.
+
+Usage (from the repository root), e.g. against the local moodle stub (tools/moodle_stub.py):
+    python tools/moodle_stub.py --port 8081 --latency 30 &
+    MOODLE_SERVER_WEB_HOST=localhost:8081 MOODLE_SERVER_SSL=false python run_server.py &
+    python benchmarks/ws_load.py --clients 50 --turns 20 [--server localhost:44123] [--output logs/benchmarks/run.json]
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import math
+import os
+import random
+import subprocess
+import time
+from datetime import datetime
+from typing import List
+
+import tornado.websocket
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+COMPLETION_UPDATED_EVENT = "\\core\\event\\course_module_completion_updated"
+
+
+def load_utterances() -> List[str]:
+    """ First column of all corpus files (new corpus: one utterance per line, test corpus: utterance; label) """
+    files = sorted(glob.glob(os.path.join(ROOT_DIR, "resources", "new_corpus", "*.csv")))
+    files.append(os.path.join(ROOT_DIR, "resources", "test_corpus_test.csv"))
+    utterances = []
+    for path in files:
+        with open(path, newline="", encoding="utf-8") as corpus_file:
+            for row in csv.reader(corpus_file):
+                if row and row[0].strip():
+                    utterances.append(row[0].strip())
+    return utterances
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Nearest-rank percentile of (unsorted) values """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))]
+
+
+def read_rss(pid: int) -> int:
+    """ Resident set size (bytes) of a local process (None, if not available) """
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.turns = 0
+        self.events = 0
+        self.errors = {"connect": 0, "start_dialog": 0, "turn_timeout": 0, "event": 0}
+
+    def num_errors(self) -> int:
+        return sum(self.errors.values())
+
+
+class SimulatedClient:
+    """ One moodle user: chat widget websocket + completion events sent by the moodle server """
+
+    def __init__(self, userid: int, args, utterances: List[str], stats: Stats):
+        self.userid = userid
+        self.args = args
+        self.utterances = utterances
+        self.stats = stats
+        self.rng = random.Random(f"{args.seed}-{userid}")
+        self.frames = asyncio.Queue()
+
+    async def _read(self, websocket):
+        while True:
+            message = await websocket.read_message()
+            if message is None:
+                return
+            messages = json.loads(message)
+            if any(entry.get("party") == "system" for entry in messages):
+                await self.frames.put(time.perf_counter())
+
+    def _drain(self):
+        while not self.frames.empty():
+            self.frames.get_nowait()
+
+    async def _wait_for_answer(self) -> float:
+        """ Returns the arrival time of the next system frame (None on timeout) """
+        try:
+            return await asyncio.wait_for(self.frames.get(), self.args.turn_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _post_event(self):
+        event = {"eventname": COMPLETION_UPDATED_EVENT, "userid": self.userid, "courseid": self.args.courseid,
+                 "contextinstanceid": self.rng.randint(1, self.args.max_cmid), "timecreated": int(time.time())}
+        try:
+            await AsyncHTTPClient().fetch(f"http://{self.args.server}/event", method="POST", body=json.dumps(event))
+            self.stats.events += 1
+        except (HTTPClientError, OSError):
+            self.stats.errors["event"] += 1
+
+    async def run(self):
+        try:
+            websocket = await tornado.websocket.websocket_connect(f"ws://{self.args.server}/ws?token={self.userid}",
+                                                                  connect_timeout=self.args.turn_timeout)
+        except (tornado.websocket.WebSocketError, OSError, asyncio.TimeoutError):
+            self.stats.errors["connect"] += 1
+            return
+        reader = asyncio.ensure_future(self._read(websocket))
+        try:
+            websocket.write_message(json.dumps({"topic": "start_dialog", "domain": 0, "courseid": self.args.courseid,
+                                                "booksearchtoken": self.args.token, "wsuserid": self.userid,
+                                                "timestamp": int(time.time())}))
+            if await self._wait_for_answer() is None:
+                self.stats.errors["start_dialog"] += 1
+                return
+            for _ in range(self.args.turns):
+                await asyncio.sleep(self.rng.uniform(0.0, 2.0 * self.args.think_time))
+                if self.rng.random() < self.args.event_ratio:
+                    await self._post_event()
+                    # answers to events are not part of the next turn
+                    await asyncio.sleep(self.args.event_settle)
+                self._drain()
+                sent = time.perf_counter()
+                websocket.write_message(json.dumps({"topic": "user_utterance", "domain": 0, "courseid": self.args.courseid,
+                                                    "msg": self.rng.choice(self.utterances)}))
+                answered = await self._wait_for_answer()
+                if answered is None:
+                    self.stats.errors["turn_timeout"] += 1
+                else:
+                    self.stats.turns += 1
+                    self.stats.latencies.append(answered - sent)
+        except tornado.websocket.WebSocketClosedError:
+            self.stats.errors["connect"] += 1
+        finally:
+            reader.cancel()
+            websocket.close()
+
+
+async def fetch_health(server: str) -> dict:
+    try:
+        response = await AsyncHTTPClient().fetch(f"http://{server}/health")
+        return json.loads(response.body)
+    except (HTTPClientError, OSError, ValueError):
+        return None
+
+
+async def run_benchmark(args) -> dict:
+    AsyncHTTPClient.configure(None, max_clients=max(10, args.clients))
+    utterances = load_utterances()
+    stats = Stats()
+    health = await fetch_health(args.server)
+    pid = health["pid"] if health is not None else None
+    rss_samples = []
+
+    async def sample_rss():
+        while pid is not None:
+            rss = read_rss(pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.ensure_future(sample_rss())
+    rss_before = read_rss(pid) if pid is not None else None
+    clients = [SimulatedClient(args.first_userid + idx, args, utterances, stats) for idx in range(args.clients)]
+
+    async def start_client(idx: int, client: SimulatedClient):
+        # ramp up: spread the connections over the ramp interval
+        await asyncio.sleep(args.ramp * idx / max(1, args.clients))
+        await client.run()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[start_client(idx, client) for idx, client in enumerate(clients)])
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    operations = stats.turns + stats.events + stats.num_errors()
+    return {
+        "benchmark": "ws_load",
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "token")},
+        "seconds": elapsed,
+        "turns": stats.turns,
+        "events": stats.events,
+        "throughput_turns_per_s": stats.turns / elapsed if elapsed > 0 else 0.0,
+        "latency_s": {"p50": percentile(stats.latencies, 50), "p95": percentile(stats.latencies, 95),
+                      "p99": percentile(stats.latencies, 99), "max": max(stats.latencies) if stats.latencies else None,
+                      "mean": sum(stats.latencies) / len(stats.latencies) if stats.latencies else None},
+        "errors": stats.errors,
+        "error_rate": stats.num_errors() / operations if operations > 0 else 0.0,
+        "server": {"pid": pid, "rss_before": rss_before, "rss_after": read_rss(pid) if pid is not None else None,
+                   "rss_max": max(rss_samples) if rss_samples else None},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="websocket load generator / end-to-end turn benchmark")
+    parser.add_argument("--server", default="localhost:44123", help="host:port of run_server.py (no ssl)")
+    parser.add_argument("--clients", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--turns", type=int, default=10, help="user utterances per client")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which the clients connect")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause (s) between turns of a client")
+    parser.add_argument("--event-ratio", type=float, default=0.2, help="probability of a completion event before a turn")
+    parser.add_argument("--event-settle", type=float, default=0.5, help="seconds to wait after an event before the next turn")
+    parser.add_argument("--turn-timeout", type=float, default=30.0, help="seconds until an unanswered turn counts as error")
+    parser.add_argument("--courseid", type=int, default=2)
+    parser.add_argument("--max-cmid", type=int, default=36, help="completion events use course module ids 1..max-cmid")
+    parser.add_argument("--first-userid", type=int, default=1000)
+    parser.add_argument("--token", default="benchmark", help="webservice token sent with start_dialog")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file (default: logs/benchmarks/ws_load_<date>.json)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    output = args.output or os.path.join(ROOT_DIR, "logs", "benchmarks", f"ws_load_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    os.makedirs(os.path.dirname(os.path.realpath(output)), exist_ok=True)
+    with open(output, "w") as result_file:
+        json.dump(result, result_file, indent=2)
+
+    latency = result["latency_s"]
+    print(f"{result['turns']} turns, {result['events']} events in {result['seconds']:.1f}s: {result['throughput_turns_per_s']:.1f} turns/s")
+    if latency["p50"] is not None:
+        print(f"turn latency p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms, p99 {latency['p99'] * 1000:.0f} ms")
+    print(f"error rate {result['error_rate']:.2%} {result['errors']}")
+    if result["server"]["rss_max"] is not None:
+        print(f"server rss max {result['server']['rss_max'] / 2 ** 20:.0f} MiB")
+    print(f"result written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,9 @@ import os
 
 
 MOOLDE_SERVER_PROTOCOL = "https" if os.environ['MOODLE_SERVER_SSL'] == 'true' else "http" # change this to HTTP or HTTPS (or set the environemnt variable)
-MOODLE_SERVER_WEB_HOST = "webserver" # IP Adress / domain (and port, if not default 80) of moodle webserver, e.g. "myaddress.com", "myaddress:1234" (excluding protocol)
-DS_SERVER_PORT = 44123 # Port under which the chatbot should accept websocket connections / http requests
+MOODLE_SERVER_WEB_HOST = os.environ.get('MOODLE_SERVER_WEB_HOST', "webserver") # IP Adress / domain (and port, if not default 80) of moodle webserver, e.g. "myaddress.com", "myaddress:1234" (excluding protocol), "localhost:8081" for tools/moodle_stub.py
+DS_SERVER_PORT = int(os.environ.get('DS_SERVER_PORT', 44123)) # Port under which the chatbot should accept websocket connections / http requests
+DS_SERVER_WORKERS = 4 # Number of worker processes when started via run_supervisor.py (run_server.py always runs a single process)
 
 # SSL OPTIONS
 if MOOLDE_SERVER_PROTOCOL == "https":
@@ -14,3 +15,63 @@ if MOOLDE_SERVER_PROTOCOL == "https":
 ## INTERNAL CONFIGURATION
 ##
 DS_SERVER_IP_ADDR = "127.0.0.1"    # IP address of dialog system backend (for internal communication; should stay localhost)
+DS_BUS_SUB_PORT = int(os.environ.get('DS_BUS_SUB_PORT', 65533))  # message bus port services subscribe to
+DS_BUS_PUB_PORT = int(os.environ.get('DS_BUS_PUB_PORT', 65534))  # message bus port services publish to
+DS_BUS_REG_PORT = int(os.environ.get('DS_BUS_REG_PORT', 65535))  # port for registering remote services
+DS_BUS_CTRL_PORT = int(os.environ.get('DS_BUS_CTRL_PORT', 65532))  # control plane port (dialog start / end requests to services)
+DS_BUS_TOPOLOGY = os.environ.get('DS_BUS_TOPOLOGY', 'proxy')  # "proxy" (one proxy thread), "sharded" (one proxy per topic family) or "brokerless" (direct connections)
+DS_BUS_SHARD_FAMILIES = ["user_utterance", "sys_acts"]  # sharded topology: topic prefixes with their own proxy (+ one proxy for control messages, one for all other topics)
+DS_BUS_SHARD_BASE_PORT = int(os.environ.get('DS_BUS_SHARD_BASE_PORT', 65400))  # sharded topology: shard i uses ports base + 2 * i and base + 2 * i + 1
+DS_BUS_ADVERTISE_ADDR = os.environ.get('DS_BUS_ADVERTISE_ADDR', DS_SERVER_IP_ADDR)  # brokerless topology: address publishers bind on (reachable by remote services)
+DS_BUS_BROKERLESS_PORTS = (49152, 65000)  # brokerless topology: port range publishers bind on (tcp)
+DS_BUS_HWM = int(os.environ.get('DS_BUS_HWM', 10000))  # default queue size (messages) of bus sockets, per published topic
+DS_BUS_TOPIC_HWM = {}  # queue sizes of specific topics, e.g. {"sys_utterance": 1000}
+DS_BUS_OVERFLOW_POLICY = os.environ.get('DS_BUS_OVERFLOW_POLICY', 'block')  # full send queue: "block", "drop_oldest" or "reject" (error act to the user)
+DS_BUS_TOPIC_OVERFLOW_POLICY = {}  # overflow policies of specific topics, e.g. {"user_utterance": "reject"}
+DS_BUS_BLOCK_TIMEOUT = 5.0  # overflow policy "block": max. seconds to wait for space in the send queue before the message is dropped (counted as timed out, error act to the user)
+DS_BUS_OVERFLOW_ERROR_TOPIC = "sys_acts"  # overflow policies "reject" and "block" (timeout): topic for the error act (SysActionType.Bad) sent to the user
+
+# JOINS (functions subscribing to several topics are called once a value for each topic was received)
+DS_JOIN_TIMEOUT = 60.0  # seconds until partially received inputs of a function call (per user) are stale and discarded
+DS_JOIN_STALE_POLICY = "first"  # timeout measured from the "first" value of a partial join or from its "latest" value
+DS_JOIN_MAX_PARTIALS = 10000  # max. number of partial joins per function (the oldest one is discarded if exceeded)
+
+# TRACING (spans of all services for a sampled share of the turns, see utils/tracing.py)
+DS_TRACE_SAMPLE_RATE = float(os.environ.get('DS_TRACE_SAMPLE_RATE', 0.01))  # share of turns that are traced (0: tracing off)
+DS_TRACE_FILE = os.environ.get('DS_TRACE_FILE', './logs/traces.jsonl')  # finished spans are appended to this file (JSON lines)
+
+# PROFILING (on demand via the /admin/profile endpoint of run_server.py, see utils/profiling.py)
+DS_PROFILE_DIR = os.environ.get('DS_PROFILE_DIR', './logs/profiles')  # result files (.prof / .folded) are written to this folder
+DS_PROFILE_SAMPLE_INTERVAL = 0.005  # profiling mode "sample": seconds between two stack samples
+DS_ADMIN_ALLOWED_IPS = ["127.0.0.1", "::1"]  # clients allowed to use the /admin endpoints
+
+# MULTI-PROCESS MODE (run_supervisor.py)
+DS_WORKER_MODE = os.environ.get('DS_WORKER_MODE', 'false') == 'true'  # set by the supervisor: worker processes listen on localhost only, without SSL
+DS_WORKER_BASE_PORT = 44200             # worker i accepts forwarded connections / requests on port DS_WORKER_BASE_PORT + i
+DS_WORKER_BUS_PORT_STRIDE = 10          # worker i uses the message bus ports above, lowered by i * DS_WORKER_BUS_PORT_STRIDE (>= number of shard ports in the sharded topology)
+DS_WORKER_HEALTH_INTERVAL = 5.0         # seconds between health checks of the worker processes
+DS_WORKER_VIRTUAL_NODES = 64            # number of points per worker on the consistent hashing ring
+
+# WEBSOCKET DELIVERY
+WS_OUTBOX_MAX_BUFFERED = 50                 # max. number of messages buffered per user while the websocket is closed (e.g. page transition)
+WS_OUTBOX_DROP_POLICY = "drop_oldest"       # what to discard if the buffer is full: "drop_oldest" or "drop_newest"
+
+# MOODLE EVENTS
+MOODLE_EVENT_QUEUE_SIZE = 10000             # max. number of received moodle events waiting to be published to the dialog system
+MOODLE_COMPLETION_DEBOUNCE_WINDOW = 0.5     # seconds to wait for newer completion events of the same user and course module before publishing (0 to disable)
+MOODLE_COMPLETION_MAX_DEBOUNCE_DELAY = 2.0  # max. seconds a burst of completion events for the same user and course module is held back
+
+# MOODLE WEBSERVICE
+MOODLE_TOKEN_CACHE_TTL = 900.0              # seconds a validated (user id, webservice token) pair is trusted, websocket reconnects within this time skip the moodle probe
+MOODLE_TOKEN_CACHE_NEGATIVE_TTL = 30.0      # seconds a token rejected by moodle stays rejected without asking moodle again
+MOODLE_TOKEN_CACHE_SIZE = 100000            # max. number of cached (user id, webservice token) pairs
+MOODLE_HEALTH_FAILURE_THRESHOLD = 3         # consecutive failed webservice calls after which moodle is considered unreachable
+MOODLE_HEALTH_RETRY_INTERVAL = 5.0          # seconds until the first new dialog start probes an unreachable moodle again
+MOODLE_COURSE_CACHE_TTL = 3600.0            # max. seconds course metadata (content links, sections, quizzes, badges) is shared by all users without asking moodle again
+MOODLE_COURSE_CACHE_WARMUP_WORKERS = 4      # threads fetching course metadata in the background when a course is accessed (again)
+MOODLE_COURSE_CACHE_FIRST_ACCESS_WARMUP = True  # fetch the content links and sections of all course modules on the first access to a course (courses without course graph)
+
+# COURSE GRAPHS (course structure from moodle backups, see tools/tag_mbz.py --graph and elearning/coursegraph.py)
+COURSE_GRAPH_DIR = os.environ.get('COURSE_GRAPH_DIR', './resources/course_graphs')  # folder with course_<courseid>.json files, courses without a file are navigated via moodle
+COURSE_GRAPH_COMPLETION_TTL = 2.0           # seconds the completion states of a user are reused for further lookups (dropped on completion events)
+COURSE_GRAPH_VERIFY_RATE = 0.02             # share of local first / next course module lookups that are also asked from moodle, differences are logged, counted and moodle's answer is used (0 to disable)
@@ -0,0 +1,13 @@
+"""
+pytest setup for the unit tests (test_*.py next to this file): `python -m pytest -q`
+
+config.py requires the moodle server settings from the environment, the tests never contact a real moodle
+(test_async_service.py runs a fake moodle web service in the test process).
+test_nlu.py is a script for manual checks of the NLU (loads the embedding model), it is not collected.
+"""
+import os
+
+os.environ.setdefault('MOODLE_SERVER_SSL', 'false')
+os.environ.setdefault('MOODLE_SERVER_WEB_HOST', 'localhost:8093')
+
+collect_ignore = ["test_nlu.py"]
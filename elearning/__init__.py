@@ -0,0 +1,24 @@
+def load_elearning_domain():
+    """ Creates the services of the ELearning domain. Returns (domain name, [NLU, BST, policy, NLG, DB logger]). """
+    print("LOADING ELEARNING DOMAIN")
+    from elearning.policy_ELearning import ELearningPolicy
+    from elearning.eLearningBst import ELearningBST
+    from elearning.dbloggerhandler import DBLoggingHandler
+    from services.nlg.nlg import ELearningNLG
+    from services.nlu.nlu import ELearningNLU
+    domain = 'ELearning'
+    e_learning_nlu = ELearningNLU(domain=domain)
+    e_learning_policy = ELearningPolicy(domain=domain)
+    e_learning_bst = ELearningBST(domain=domain)
+    e_learning_nlg = ELearningNLG(domain=domain)
+    e_learning_logger = DBLoggingHandler(domain=domain)
+    return domain, [e_learning_nlu, e_learning_bst, e_learning_policy, e_learning_nlg, e_learning_logger]
+
+
+def configure_moodle_session(services: list, user_id: int, wstoken: str, wsuserid: int, moodle_timestamp: int, time_diff_chatbot_moodle: int):
+    """ Sets the webservice token and moodle server time of a user in the policy and the DB logger (services as returned by `load_elearning_domain`) """
+    services[2].set_state(user_id, "BOOKSEARCHTOKEN", wstoken)
+    services[2].set_state(user_id, "SERVERTIMESTAMP", moodle_timestamp)
+    services[2].set_state(user_id, "WSUSERID", wsuserid)
+    services[2].set_state(user_id, "SERVERTIMEDIFFERENCE", time_diff_chatbot_moodle)
+    services[-1].set_state(user_id, "BOOKSEARCHTOKEN", wstoken)
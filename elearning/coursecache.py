@@ -0,0 +1,235 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+import config
+from elearning import moodledb
+from elearning.moodledb import BadgeInfo, ContentLinkInfo, H5PQuizParameters
+from utils import metrics
+
+
+# kinds of cached course metadata
+CONTENT_LINK = "content_link"   # key: course module id
+SECTION = "section"             # key: course module id, value: (section id, section name)
+H5P_QUIZ = "h5pquiz"            # key: course module id
+BADGE = "badge"                 # key: (badge id, context id)
+
+_LOADERS = {
+    CONTENT_LINK: lambda wstoken, cmid: moodledb.fetch_content_link(wstoken=wstoken, cmid=cmid),
+    SECTION: lambda wstoken, cmid: moodledb.fetch_section_id_and_name(wstoken=wstoken, cmid=cmid),
+    H5P_QUIZ: lambda wstoken, cmid: moodledb.fetch_h5pquiz_params(wstoken=wstoken, cmid=cmid),
+    BADGE: lambda wstoken, key: moodledb.fetch_badge_info(wstoken=wstoken, badgeid=key[0], contextid=key[1]),
+}
+# list of the course modules of a course (not cached, only used for the warmup on first access)
+_COURSE_MODULES_LOADER = lambda wstoken, courseid: moodledb.fetch_course_module_types(wstoken=wstoken, courseid=courseid)
+
+# moodle events that change the structure or content of a course
+COURSE_UPDATED_EVENT = "\\core\\event\\course_updated"
+MODULE_UPDATED_EVENTS = ("\\core\\event\\course_module_updated", "\\core\\event\\course_module_deleted")
+COURSE_STRUCTURE_EVENTS = ("\\core\\event\\course_module_created", "\\core\\event\\course_section_created",
+                           "\\core\\event\\course_section_updated", "\\core\\event\\course_section_deleted",
+                           "\\core\\event\\course_content_deleted", "\\core\\event\\course_restored")
+BADGE_UPDATED_EVENTS = ("\\core\\event\\badge_updated", "\\core\\event\\badge_deleted")
+
+_MISSING = object()
+
+
+def _normalize_key(key):
+    """ Object ids of moodle events are strings, the ones of the course graphs and the policy ints """
+    return tuple(int(part) for part in key) if isinstance(key, tuple) else int(key)
+
+
+def _module_keys(cmids: Iterable[int], h5p_cmids: Iterable[int]) -> List[Tuple[str, object]]:
+    """ Keys of the content links and sections of the given course modules and the quiz parameters of h5p activities """
+    return [(kind, int(cmid)) for cmid in cmids for kind in (CONTENT_LINK, SECTION)] + [(H5P_QUIZ, int(cmid)) for cmid in h5p_cmids]
+
+
+class _CourseEntries:
+    """ Cached metadata of one course: (kind, key) -> value, dropped as a whole after `expires` """
+    __slots__ = ("values", "expires")
+
+    def __init__(self, expires: float):
+        self.values = {}
+        self.expires = expires
+
+
+class CourseCache:
+    """
+    Course metadata that is the same for all users (content links, sections of course modules, h5p quiz parameters,
+    badges), shared by all users of this process and kept apart from per-user state.
+
+    Entries are grouped by course. The entries of a course are dropped when moodle reports a change of the course
+    (`handle_event`) or at the latest `ttl` seconds after the first access, which also bounds how long other server
+    processes (that did not receive the event) serve outdated entries.
+    Accessing a course warms the cache in the background (with the webservice token of the accessing user, in parallel):
+    the first access fetches the list of course modules (one call) and then the content links and sections of all modules,
+    an access after the course was dropped fetches the keys cached before. `warmup` can be called for known modules
+    (courses with a course graph, see elearning/coursegraph.py).
+    """
+
+    def __init__(self, ttl: float = config.MOODLE_COURSE_CACHE_TTL, warmup_workers: int = config.MOODLE_COURSE_CACHE_WARMUP_WORKERS,
+                 first_access_warmup: bool = config.MOODLE_COURSE_CACHE_FIRST_ACCESS_WARMUP):
+        self.ttl = ttl
+        self.warmup_workers = warmup_workers
+        self.first_access_warmup = first_access_warmup
+        self._courses: Dict[int, _CourseEntries] = {}
+        self._rewarm: Dict[int, set] = {}  # course id -> keys cached before the course was dropped
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=warmup_workers, thread_name_prefix="course_cache_warmup")
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.warmed = 0
+        self.warmup_failures = 0
+
+    def _course(self, courseid: int, wstoken: str, first_access_warmup: bool = True) -> _CourseEntries:
+        """ Returns the entries of a course (lock has to be held), starts the warmup if the course is accessed (again) """
+        now = time.monotonic()
+        course = self._courses.get(courseid)
+        if course is not None and course.expires < now:
+            self._drop(courseid)
+            course = None
+        if course is None:
+            course = self._courses[courseid] = _CourseEntries(now + self.ttl)
+            keys = self._rewarm.pop(courseid, None)
+            if keys is None:
+                # first access (in this process)
+                if first_access_warmup and self.first_access_warmup:
+                    self._executor.submit(self._warmup_course, wstoken, courseid, course)
+            elif len(keys) > 0:
+                self._submit_warmup(wstoken, courseid, course, list(keys))
+        return course
+
+    def _submit_warmup(self, wstoken: str, courseid: int, course: _CourseEntries, keys: List[Tuple[str, object]]):
+        # split into one chunk per worker, so the keys are fetched in parallel
+        chunk_size = len(keys) // self.warmup_workers + 1
+        for idx in range(0, len(keys), chunk_size):
+            self._executor.submit(self._warmup, wstoken, courseid, course, keys[idx:idx + chunk_size])
+
+    def _drop(self, courseid: int):
+        """ Drops all entries of a course (lock has to be held), remembers their keys for the next warmup """
+        course = self._courses.pop(courseid, None)
+        if course is not None:
+            self._rewarm.setdefault(courseid, set()).update(course.values.keys())
+            self.invalidations += 1
+
+    def _warmup_course(self, wstoken: str, courseid: int, course: _CourseEntries):
+        """ Fetches the course modules of a course and warms the cache with their metadata """
+        if moodledb.moodle_health.is_down():
+            return
+        try:
+            module_types = _COURSE_MODULES_LOADER(wstoken, courseid)
+        except Exception:
+            self.warmup_failures += 1
+            return
+        with self._lock:
+            if self._courses.get(courseid) is not course:
+                return  # dropped in the meantime
+        self._submit_warmup(wstoken, courseid, course, _module_keys(
+            module_types.keys(), [cmid for cmid, module_type in module_types.items() if module_type == "h5pactivity"]))
+
+    def _warmup(self, wstoken: str, courseid: int, course: _CourseEntries, keys: Iterable[Tuple[str, object]]):
+        if moodledb.moodle_health.is_down():
+            return
+        for kind, key in keys:
+            with self._lock:
+                if self._courses.get(courseid) is not course:
+                    return  # dropped again in the meantime
+                if (kind, key) in course.values:
+                    continue
+            try:
+                value = _LOADERS[kind](wstoken, key)
+            except Exception:
+                # e.g. deleted course module: leave it to the next lookup
+                self.warmup_failures += 1
+                continue
+            with self._lock:
+                if self._courses.get(courseid) is course:
+                    course.values[(kind, key)] = value
+                    self.warmed += 1
+
+    def get(self, wstoken: str, courseid: int, kind: str, key):
+        """ Returns the cached value or fetches it from moodle (exceptions of the webservice call are not cached) """
+        courseid = int(courseid)  # moodle events carry the ids as strings
+        key = _normalize_key(key)
+        with self._lock:
+            course = self._course(courseid, wstoken)
+            value = course.values.get((kind, key), _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = _LOADERS[kind](wstoken, key)
+        with self._lock:
+            # don't store values fetched while the course was invalidated
+            if self._courses.get(courseid) is course:
+                course.values[(kind, key)] = value
+        return value
+
+    def warmup(self, wstoken: str, courseid: int, cmids: Iterable[int] = (), h5p_cmids: Iterable[int] = ()):
+        """ Fetches the content links and sections of the given course modules (and quiz parameters of h5p activities) in the background """
+        courseid = int(courseid)
+        with self._lock:
+            course = self._course(courseid, wstoken, first_access_warmup=False)
+        self._submit_warmup(wstoken, courseid, course, _module_keys(cmids, h5p_cmids))
+
+    def invalidate_course(self, courseid: int):
+        with self._lock:
+            self._drop(int(courseid))
+
+    def invalidate(self, courseid: int, kind: str, key):
+        with self._lock:
+            course = self._courses.get(int(courseid))
+            if course is not None and course.values.pop((kind, _normalize_key(key)), _MISSING) is not _MISSING:
+                self.invalidations += 1
+
+    def handle_event(self, event_data: dict):
+        """ Drops the entries affected by a moodle event (ignores events that don't change course metadata) """
+        try:
+            event_name = event_data.get('eventname', '').lower().strip()
+            if event_name in MODULE_UPDATED_EVENTS:
+                courseid = int(event_data['courseid'])
+                cmid = int(event_data['objectid'])
+                for kind in (CONTENT_LINK, SECTION, H5P_QUIZ):
+                    self.invalidate(courseid, kind, cmid)
+            elif event_name in BADGE_UPDATED_EVENTS:
+                self.invalidate(int(event_data['courseid']), BADGE, (int(event_data['objectid']), int(event_data['contextid'])))
+            elif event_name == COURSE_UPDATED_EVENT or event_name in COURSE_STRUCTURE_EVENTS:
+                self.invalidate_course(int(event_data['courseid']))
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = sum(len(course.values) for course in self._courses.values())
+            return {"courses": len(self._courses), "entries": entries, "hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations, "warmed": self.warmed, "warmup_failures": self.warmup_failures}
+
+
+course_cache = CourseCache()
+metrics.gauge("moodle_course_cache_lookups_total", "Lookups in the shared course metadata cache",
+              lambda: {("hit",): course_cache.hits, ("miss",): course_cache.misses}, ["result"], "counter")
+metrics.gauge("moodle_course_cache_invalidations_total", "Courses and entries dropped from the course metadata cache because of moodle events or expiry",
+              lambda: course_cache.invalidations, metric_type="counter")
+
+
+#
+# cached versions of the moodledb functions (same arguments, plus the course the object belongs to)
+#
+
+def fetch_content_link(wstoken: str, courseid: int, cmid: int) -> ContentLinkInfo:
+    return course_cache.get(wstoken, courseid, CONTENT_LINK, cmid)
+
+def fetch_section_id_and_name(wstoken: str, courseid: int, cmid: int) -> Tuple[int, str]:
+    return course_cache.get(wstoken, courseid, SECTION, cmid)
+
+def fetch_h5pquiz_params(wstoken: str, courseid: int, cmid: int) -> H5PQuizParameters:
+    return course_cache.get(wstoken, courseid, H5P_QUIZ, cmid)
+
+def fetch_badge_info(wstoken: str, courseid: int, badgeid: int, contextid: int) -> BadgeInfo:
+    return course_cache.get(wstoken, courseid, BADGE, (badgeid, contextid))
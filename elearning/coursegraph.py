@@ -0,0 +1,279 @@
+"""
+Course navigation without asking moodle for the course structure.
+
+Course graphs (JSON, written by `tools/tag_mbz.py --graph` from a moodle backup) contain the sections of a course in order,
+the course modules of each section in order with their type, name, branch topic and tags.
+If a graph exists for a course (`config.COURSE_GRAPH_DIR/course_<courseid>.json`), the functions below compute the next
+course modules / new sections locally and only ask moodle for the completion state of the user
+(one call for all course modules, shortly reused for further lookups of the same user).
+Without a graph, they call the corresponding block_chatbot web service functions.
+
+The next course module is searched in the section of the current module only, like the policy expects from the plugin
+("no more quizzes in the current section"). The plugin's source is not part of this repository: a share of the local
+first / next course module lookups (`config.COURSE_GRAPH_VERIFY_RATE`) is also answered by moodle, differences are logged,
+counted (`course_graph_mismatches_total`) and moodle's answer is used.
+A section counts as new for a user if none of its course modules is completed
+(the web service function of the plugin also regards viewed, but incomplete modules), new sections are not verified.
+"""
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Set, Union
+
+import config
+from elearning import moodledb
+from elearning.coursecache import course_cache
+from elearning.moodledb import SectionInfo
+from utils import metrics
+
+
+COMPLETION_UPDATED_EVENT = "\\core\\event\\course_module_completion_updated"
+
+
+class GraphModule:
+    __slots__ = ("cmid", "type", "name", "sectionid", "topic", "tags", "visible")
+
+    def __init__(self, cmid: int, type: str, name: str, sectionid: int, topic: str, tags: List[str], visible: bool):
+        self.cmid = cmid
+        self.type = type
+        self.name = name
+        self.sectionid = sectionid
+        self.topic = topic
+        self.tags = tags
+        self.visible = visible
+
+
+class GraphSection:
+    __slots__ = ("id", "section", "name", "branch", "visible", "cmids")
+
+    def __init__(self, id: int, section: int, name: str, branch: str, visible: bool, cmids: List[int]):
+        self.id = id
+        self.section = section  # index of section in course
+        self.name = name
+        self.branch = branch
+        self.visible = visible
+        self.cmids = cmids
+
+
+class CourseGraph:
+    """ Sections and course modules of one course in course order """
+
+    def __init__(self, courseid: int, sections: List[GraphSection], modules: Dict[int, GraphModule]):
+        self.courseid = courseid
+        self.sections = sorted(sections, key=lambda section: section.section)
+        self.sections_by_id = {section.id: section for section in self.sections}
+        self.modules = modules
+        # all visible course modules in course order, position of each module
+        self.order = [cmid for section in self.sections if section.visible for cmid in section.cmids
+                      if cmid in modules and modules[cmid].visible]
+        self.position = {cmid: idx for idx, cmid in enumerate(self.order)}
+
+    @staticmethod
+    def from_dict(graph: dict) -> "CourseGraph":
+        modules = {}
+        sections = []
+        for section in graph["sections"]:
+            for cmid in section["modules"]:
+                module = graph["modules"][str(cmid)]
+                modules[cmid] = GraphModule(cmid=cmid, type=module["type"], name=module["name"], sectionid=section["id"],
+                                            topic=module.get("topic"), tags=module.get("tags", []), visible=module.get("visible", True))
+            sections.append(GraphSection(id=section["id"], section=section["section"], name=section["name"], branch=section.get("branch"),
+                                         visible=section.get("visible", True), cmids=section["modules"]))
+        return CourseGraph(courseid=graph["courseid"], sections=sections, modules=modules)
+
+    @staticmethod
+    def _available(module: GraphModule, include_types: List[str], completed: Set[int], allow_only_unfinished: bool) -> bool:
+        return module.type in include_types and (not allow_only_unfinished or module.cmid not in completed)
+
+    def first_module(self, sectionid: int, include_types: List[str], completed: Set[int], allow_only_unfinished: bool = False) -> Union[int, None]:
+        """
+        First course module of the section with one of the given types (optionally only modules not completed yet).
+        `sectionid` is the id of the section (`GraphSection.id`, `CourseModuleAccess.section`), not its index in the course.
+        """
+        section = self.sections_by_id.get(sectionid)
+        if section is None or not section.visible:
+            return None
+        for cmid in section.cmids:
+            if cmid in self.position and self._available(self.modules[cmid], include_types, completed, allow_only_unfinished):
+                return cmid
+        return None
+
+    def next_module(self, cmid: int, include_types: List[str], completed: Set[int], allow_only_unfinished: bool = False) -> Union[int, None]:
+        """
+        Next course module after `cmid` in the section of `cmid` with one of the given types
+        (None at the end of the section: the policy offers the next sections then)
+        """
+        if cmid not in self.position:
+            return None
+        section = self.sections_by_id[self.modules[cmid].sectionid]
+        for next_cmid in section.cmids[section.cmids.index(cmid) + 1:]:
+            if next_cmid in self.position and self._available(self.modules[next_cmid], include_types, completed, allow_only_unfinished):
+                return next_cmid
+        return None
+
+    def new_sections(self, completed: Set[int]) -> List[SectionInfo]:
+        """ Visible sections without completed course modules (with their first course module) """
+        sections = []
+        for section in self.sections:
+            cmids = [cmid for cmid in section.cmids if cmid in self.position]
+            if not section.visible or len(cmids) == 0 or any(cmid in completed for cmid in cmids):
+                continue
+            sections.append(SectionInfo(id=section.id, section=section.section, name=section.name, firstcmid=cmids[0],
+                                        url=f"{config.MOOLDE_SERVER_PROTOCOL}://{config.MOODLE_SERVER_WEB_HOST}/course/view.php?id={self.courseid}#section-{section.section}"))
+        return sections
+
+
+def load_course_graphs(directory: str) -> Dict[int, CourseGraph]:
+    """ Loads all course graphs (course_<courseid>.json) of a directory """
+    graphs = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            with open(path, encoding="utf-8") as graph_file:
+                graph = CourseGraph.from_dict(json.load(graph_file))
+            graphs[graph.courseid] = graph
+        except:
+            logging.getLogger("error_log").error(f"could not load course graph {path}\n{traceback.format_exc()}")
+    return graphs
+
+
+class CourseNavigator:
+    """
+    Course graphs of this process and a short-lived cache of the users' completion states.
+
+    The completion states of a user are reused for `completion_ttl` seconds (the policy looks up several sections per turn)
+    and dropped as soon as a completion event of the user arrives (`handle_event`).
+    """
+
+    def __init__(self, graph_dir: str = config.COURSE_GRAPH_DIR, completion_ttl: float = config.COURSE_GRAPH_COMPLETION_TTL,
+                 verify_rate: float = config.COURSE_GRAPH_VERIFY_RATE):
+        self.graph_dir = graph_dir
+        self.completion_ttl = completion_ttl
+        self.verify_rate = verify_rate
+        self._graphs = None
+        self._warm_courses = set()
+        self._completion = {}  # (user id, course id) -> (completed course module ids, expiry time)
+        self._lock = threading.Lock()
+
+        # statistics
+        self.local_lookups = 0
+        self.completion_fetches = 0
+        self.verified = 0
+        self.mismatches = {}  # lookup -> number of local results that differed from moodle
+
+    def graph(self, courseid: int, wstoken: str = None) -> Union[CourseGraph, None]:
+        courseid = int(courseid)  # moodle events carry the id as string
+        with self._lock:
+            if self._graphs is None:
+                self._graphs = load_course_graphs(self.graph_dir) if self.graph_dir else {}
+            graph = self._graphs.get(courseid)
+            warmup = graph is not None and wstoken is not None and courseid not in self._warm_courses
+            if warmup:
+                self._warm_courses.add(courseid)
+        if warmup:
+            # all course modules are known: fetch their content links and sections into the shared course cache
+            course_cache.warmup(wstoken, courseid, cmids=graph.order,
+                                h5p_cmids=[cmid for cmid in graph.order if graph.modules[cmid].type == "h5pactivity"])
+        return graph
+
+    def completed(self, wstoken: str, userid: int, courseid: int) -> Set[int]:
+        """ Ids of the course modules the user completed """
+        userid, courseid = int(userid), int(courseid)
+        key = (userid, courseid)
+        with self._lock:
+            entry = self._completion.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                return entry[0]
+        states = moodledb.fetch_course_module_completionstates(wstoken=wstoken, userid=userid, courseid=courseid)
+        completed = {cmid for cmid, state in states.items() if state in (1, 2)}
+        with self._lock:
+            self.completion_fetches += 1
+            self._completion[key] = (completed, time.monotonic() + self.completion_ttl)
+            if len(self._completion) > 10000:
+                now = time.monotonic()
+                self._completion = {key: entry for key, entry in self._completion.items() if entry[1] >= now}
+        return completed
+
+    def verify(self, lookup: str, local_result, moodle_lookup: Callable[[], Any], details: str = ""):
+        """
+        Returns the result of a local lookup, for a share of `verify_rate` lookups compares it with the answer of moodle
+        (`moodle_lookup`) first: differences are logged and counted, moodle's answer is returned then.
+        """
+        if self.verify_rate <= 0.0 or random.random() >= self.verify_rate:
+            return local_result
+        try:
+            moodle_result = moodle_lookup()
+        except Exception:
+            return local_result
+        with self._lock:
+            self.verified += 1
+            if moodle_result == local_result:
+                return local_result
+            self.mismatches[lookup] = self.mismatches.get(lookup, 0) + 1
+        logging.getLogger("error_log").warning(f"course graph: {lookup}({details}) = {local_result}, moodle: {moodle_result}")
+        return moodle_result
+
+    def handle_event(self, event_data: dict):
+        """ Drops the cached completion states of the user of a completion event """
+        try:
+            if event_data.get('eventname', '').lower().strip() == COMPLETION_UPDATED_EVENT:
+                with self._lock:
+                    self._completion.pop((int(event_data['userid']), int(event_data['courseid'])), None)
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    def stats(self) -> dict:
+        return {"courses": sorted(self._graphs) if self._graphs is not None else None,
+                "local_lookups": self.local_lookups, "completion_fetches": self.completion_fetches,
+                "verified": self.verified, "mismatches": dict(self.mismatches)}
+
+
+course_navigator = CourseNavigator()
+metrics.gauge("course_graph_mismatches_total", "Local course navigation lookups that differed from the answer of moodle (see COURSE_GRAPH_VERIFY_RATE)",
+              lambda: {(lookup,): count for lookup, count in course_navigator.mismatches.items()}, ["lookup"], "counter")
+
+
+def _types(include_types: str) -> List[str]:
+    return [typename.strip() for typename in include_types.split(",") if typename.strip()]
+
+
+#
+# versions of the moodledb navigation functions that use the course graph, if available
+#
+
+def fetch_first_available_course_module_id(wstoken: str, userid: int, courseid: int, sectionid: int, includetypes: str = "url,book,resource,h5pactivity,quiz,icecreamgame", allow_only_unfinished: bool = False) -> Union[int, None]:
+    """ `sectionid`: id of the section (e.g. `CourseModuleAccess.section`) """
+    moodle_lookup = lambda: moodledb.fetch_first_available_course_module_id(wstoken=wstoken, userid=userid, courseid=courseid, sectionid=sectionid,
+                                                                            includetypes=includetypes, allow_only_unfinished=allow_only_unfinished)
+    graph = course_navigator.graph(courseid, wstoken)
+    if graph is None:
+        return moodle_lookup()
+    course_navigator.local_lookups += 1
+    completed = course_navigator.completed(wstoken, userid, courseid) if allow_only_unfinished else set()
+    return course_navigator.verify("first_module", graph.first_module(sectionid, _types(includetypes), completed, allow_only_unfinished),
+                                   moodle_lookup, f"section {sectionid}, {includetypes}, user {userid}")
+
+def fetch_next_available_course_module_id(wstoken: str, userid: int, courseid: int, current_cmid: int, include_types: str = "url,book,resource,h5pactivity,quiz,icecreamgame", allow_only_unfinished: bool = False, current_cm_completion: int = 0) -> Union[int, None]:
+    moodle_lookup = lambda: moodledb.fetch_next_available_course_module_id(wstoken=wstoken, userid=userid, current_cmid=current_cmid, include_types=include_types,
+                                                                           allow_only_unfinished=allow_only_unfinished, current_cm_completion=current_cm_completion)
+    graph = course_navigator.graph(courseid, wstoken)
+    if graph is None:
+        return moodle_lookup()
+    course_navigator.local_lookups += 1
+    completed = course_navigator.completed(wstoken, userid, courseid) if allow_only_unfinished else set()
+    if current_cm_completion:
+        # the completion of the current module might not be stored by moodle yet
+        completed = completed | {current_cmid}
+    return course_navigator.verify("next_module", graph.next_module(current_cmid, _types(include_types), completed, allow_only_unfinished),
+                                   moodle_lookup, f"cmid {current_cmid}, {include_types}, user {userid}")
+
+def fetch_available_new_course_section_ids(wstoken: str, userid: int, courseid: int) -> List[SectionInfo]:
+    graph = course_navigator.graph(courseid, wstoken)
+    if graph is None:
+        return list(moodledb.fetch_available_new_course_section_ids(wstoken=wstoken, userid=userid, courseid=courseid))
+    course_navigator.local_lookups += 1
+    return graph.new_sections(course_navigator.completed(wstoken, userid, courseid))
@@ -0,0 +1,149 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Tuple
+
+
+COMPLETION_UPDATED_EVENT = "\\core\\event\\course_module_completion_updated"
+
+
+def validate_event(event: dict) -> int:
+    """ Checks the fields the queue relies on (numeric user id, event name), returns the user id. Raises ValueError for malformed events. """
+    if not isinstance(event, dict):
+        raise ValueError(f"moodle event is not an object: {event!r}")
+    if not isinstance(event.get('eventname'), str):
+        raise ValueError(f"moodle event without event name: {event!r}")
+    try:
+        return int(event['userid'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"moodle event without numeric user id: {event!r}")
+
+
+class MoodleEventQueue:
+    """
+    Bounded ingestion queue for events sent by moodle.
+
+    HTTP handlers only enqueue events (`offer`) and can acknowledge immediately.
+    A single worker thread publishes the events in the order they were received,
+    so the events of each user are forwarded in order (and only one thread uses the publisher socket).
+
+    If accepting a batch would exceed `max_pending` events, the whole batch is rejected,
+    so the caller can signal backpressure (and moodle can retry the batch later) without duplicating events.
+
+    Completion events (course_module_completion_updated) are debounced per (user, course module):
+    the worker holds them back for `debounce_window` seconds, a newer completion event for the same
+    course module replaces the held one. This way, a burst of completion updates (e.g. triggered by the
+    autocomplete plugin) costs only one evaluation in the policy. Held events are published
+    at the latest `max_debounce_delay` seconds after the first event of the burst, or as soon as
+    any other event for the same user arrives (to keep the order of the user's events).
+    """
+
+    def __init__(self, publish: Callable[[int, dict], Any], max_pending: int = 10000,
+                 debounce_window: float = 0.5, max_debounce_delay: float = 2.0):
+        """
+        Args:
+            publish: function called by the worker for each event with arguments (user_id, event_data)
+            max_pending: max. number of events waiting to be published
+            debounce_window: time (in seconds) to wait for newer completion events of the same course module. 0 disables debouncing.
+            max_debounce_delay: max. time (in seconds) a completion event is held back
+        """
+        self._publish = publish
+        self.max_pending = max_pending
+        self.debounce_window = debounce_window
+        self.max_debounce_delay = max_debounce_delay
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        # held back completion events (only accessed by the worker thread), ordered by arrival of the first event of each burst:
+        # (user id, course module id) -> [first arrival time, deadline, event]
+        self._debounced: Dict[Tuple[int, int], list] = {}
+
+        # statistics
+        self.accepted = 0
+        self.rejected = 0
+        self.published = 0
+        self.failed = 0
+        self.coalesced = 0  # completion events replaced by a newer event for the same user and course module
+
+        self._worker_thread = threading.Thread(target=self._worker, daemon=True)
+        self._worker_thread.start()
+
+    def offer(self, events: List[dict]) -> bool:
+        """
+        Enqueues all given events, if there is enough space left.
+
+        Returns:
+            True, if the events were accepted - False, if the batch was rejected because the queue is full
+        """
+        with self._lock:
+            if self._pending + len(events) > self.max_pending:
+                self.rejected += len(events)
+                return False
+            self._pending += len(events)
+            self.accepted += len(events)
+        for event in events:
+            self._queue.put(event)
+        return True
+
+    def pending(self) -> int:
+        """ Returns the number of events waiting to be published """
+        return self._pending
+
+    def _worker(self):
+        while True:
+            timeout = None
+            if len(self._debounced) > 0:
+                timeout = max(0.0, min(entry[1] for entry in self._debounced.values()) - time.monotonic())
+            try:
+                event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+            if event is not None:
+                try:
+                    self._ingest(event)
+                except:
+                    # malformed event: drop it, the worker has to keep publishing the following events
+                    self.failed += 1
+                    logging.getLogger("error_log").error(traceback.format_exc())
+                    self._done()
+            self._publish_due(time.monotonic())
+
+    def _ingest(self, event: dict):
+        user_id = validate_event(event)
+        if self.debounce_window > 0 and event['eventname'].lower().strip() == COMPLETION_UPDATED_EVENT:
+            now = time.monotonic()
+            key = (user_id, event.get('contextinstanceid'))
+            if key in self._debounced:
+                # newer completion state for the same course module supersedes the held event
+                first_arrival = self._debounced[key][0]
+                self._debounced[key][1] = min(now + self.debounce_window, first_arrival + self.max_debounce_delay)
+                self._debounced[key][2] = event
+                self.coalesced += 1
+                self._done()
+            else:
+                self._debounced[key] = [now, now + self.debounce_window, event]
+        else:
+            # publish held events of this user first to keep the order of events
+            for key in [key for key in self._debounced if key[0] == user_id]:
+                self._publish_event(user_id, self._debounced.pop(key)[2])
+            self._publish_event(user_id, event)
+
+    def _publish_due(self, now: float):
+        for key in [key for key, entry in self._debounced.items() if entry[1] <= now]:
+            self._publish_event(key[0], self._debounced.pop(key)[2])
+
+    def _publish_event(self, user_id: int, event: dict):
+        try:
+            self._publish(user_id, event)
+            self.published += 1
+        except:
+            self.failed += 1
+            logging.getLogger("error_log").error(traceback.format_exc())
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
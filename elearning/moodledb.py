@@ -1,9 +1,15 @@
 # coding: utf-8
 import datetime
+import json
+import threading
 from dataclasses import dataclass
 from typing import Dict, List, Tuple, Union
-from config import MOODLE_SERVER_WEB_HOST, MOOLDE_SERVER_PROTOCOL
+from urllib.parse import urlencode
+from config import MOODLE_SERVER_WEB_HOST, MOOLDE_SERVER_PROTOCOL, MOODLE_HEALTH_FAILURE_THRESHOLD, MOODLE_HEALTH_RETRY_INTERVAL
 import requests
+import time
+from tornado.httpclient import AsyncHTTPClient
+from utils import metrics, tracing
 
 sess = requests.Session()
 API_ENDPOINT = f"{MOOLDE_SERVER_PROTOCOL}://{MOODLE_SERVER_WEB_HOST}/webservice/rest/server.php"
@@ -40,7 +46,7 @@ class BranchReviewQuizzes:
 @dataclass
 class CourseModuleAccess:
 	cmid: int
-	section: int
+	section: int # section id (not the index of the section in the course)
 	timeaccess: datetime.datetime
 	completionstate: int
 
@@ -65,12 +71,14 @@ class BadgeCompletionInfo:
 
 @dataclass
 class BadgeInfo:
+	__slots__ = ("id", "name", "url")
 	id: int
 	name: str
 	url: str # url to badge image
 
 @dataclass
 class H5PQuizParameters:
+	__slots__ = ("host", "context", "filearea", "itemid", "filename")
 	host: str
 	context: int
 	filearea: str
@@ -100,8 +108,16 @@ class SectionInfo:
 	name: str
 	firstcmid: int
 
+@dataclass
+class SectionSummary:
+	id: int # section id
+	section: int # index of section in course
+	name: str
+	summary: str # HTML
+
 @dataclass
 class ContentLinkInfo:
+	__slots__ = ("url", "name", "typename")
 	url: str
 	name: str
 	typename : str
@@ -121,6 +137,53 @@ class GlossaryItem:
 	definition: str # definition of concept
 
 
+class MoodleHealth:
+	"""
+	Reachability of the moodle webservice, shared by all users of this process.
+	Every api call reports its outcome: moodle is considered down after `failure_threshold` consecutive failed calls
+	(no connection / no JSON response). While down, callers can skip probing moodle (`is_down`) - after
+	`retry_interval` seconds without a new failure, the next call probes moodle again.
+	"""
+
+	def __init__(self, failure_threshold: int = MOODLE_HEALTH_FAILURE_THRESHOLD, retry_interval: float = MOODLE_HEALTH_RETRY_INTERVAL):
+		self.failure_threshold = failure_threshold
+		self.retry_interval = retry_interval
+		self._lock = threading.Lock()
+		self.consecutive_failures = 0
+		self.failures = 0
+		self.last_success = None # unix timestamps
+		self.last_failure = None
+
+	def record_success(self):
+		self.last_success = time.time()
+		if self.consecutive_failures > 0:
+			with self._lock:
+				self.consecutive_failures = 0
+
+	def record_failure(self):
+		with self._lock:
+			self.consecutive_failures += 1
+			self.failures += 1
+			self.last_failure = time.time()
+
+	def is_down(self) -> bool:
+		return self.consecutive_failures >= self.failure_threshold and time.time() - self.last_failure < self.retry_interval
+
+	def stats(self) -> dict:
+		return {
+			"up": not self.is_down(),
+			"consecutive_failures": self.consecutive_failures,
+			"failures": self.failures,
+			"last_success": self.last_success,
+			"last_failure": self.last_failure
+		}
+
+
+moodle_health = MoodleHealth()
+metrics.gauge("moodle_webservice_up", "1 if the moodle webservice is considered reachable", lambda: 0 if moodle_health.is_down() else 1)
+_API_LATENCY = metrics.histogram("moodle_api_latency_seconds", "Duration of moodle webservice calls", ["wsfunction"])
+
+
 def api_call(wstoken: str, wsfunction: str, params: dict):
 	body={
 		"wstoken": wstoken,
@@ -128,8 +191,37 @@ def api_call(wstoken: str, wsfunction: str, params: dict):
 		"moodlewsrestformat": "json",
 		**params
 	}
-	response = sess.post(url=API_ENDPOINT, data=body, verify=False)
-	data = response.json()
+	start = time.perf_counter()
+	try:
+		with tracing.span(f"moodle.{wsfunction}"):
+			response = sess.post(url=API_ENDPOINT, data=body, verify=False)
+			data = response.json()
+	except Exception:
+		moodle_health.record_failure()
+		raise
+	moodle_health.record_success()
+	_API_LATENCY.labels(wsfunction).observe(time.perf_counter() - start)
+	return data
+
+
+async def api_call_async(wstoken: str, wsfunction: str, params: dict):
+	""" Non-blocking version of `api_call` for `async def` service functions (see services.async_service.AsyncService) """
+	body={
+		"wstoken": wstoken,
+		"wsfunction": wsfunction,
+		"moodlewsrestformat": "json",
+		**params
+	}
+	start = time.perf_counter()
+	try:
+		with tracing.span(f"moodle.{wsfunction}"):
+			response = await AsyncHTTPClient().fetch(API_ENDPOINT, method="POST", body=urlencode(body, doseq=True), validate_cert=False)
+			data = json.loads(response.body)
+	except Exception:
+		moodle_health.record_failure()
+		raise
+	moodle_health.record_success()
+	_API_LATENCY.labels(wsfunction).observe(time.perf_counter() - start)
 	return data
 
 
@@ -209,6 +301,28 @@ def fetch_available_new_course_section_ids(wstoken: str, userid: int, courseid:
 	))
 	return filter(lambda info: info.firstcmid is not None, [SectionInfo(**res) for res in response])
 
+def fetch_course_section_summaries(wstoken: str, courseid: int) -> List[SectionSummary]:
+	""" Names and (HTML) summaries of all sections of a course (moodle core function) """
+	response = api_call(wstoken=wstoken, wsfunction="core_course_get_contents", params=dict(
+		courseid=courseid
+	))
+	return [SectionSummary(id=section['id'], section=section['section'], name=section['name'], summary=section['summary']) for section in response]
+
+def fetch_course_module_types(wstoken: str, courseid: int) -> Dict[int, str]:
+	""" All course modules of a course (moodle core function): cmid -> module type (e.g. "book", "h5pactivity") """
+	response = api_call(wstoken=wstoken, wsfunction="core_course_get_contents", params=dict(
+		courseid=courseid
+	))
+	return {module['id']: module['modname'] for section in response for module in section.get('modules', [])}
+
+def fetch_course_module_completionstates(wstoken: str, userid: int, courseid: int) -> Dict[int, int]:
+	""" Completion state of all course modules with completion tracking (moodle core function): cmid -> state (0: incomplete, 1: complete, 2: pass, 3: fail) """
+	response = api_call(wstoken=wstoken, wsfunction="core_completion_get_activities_completion_status", params=dict(
+		courseid=courseid,
+		userid=userid
+	))
+	return {status['cmid']: status['state'] for status in response['statuses']}
+
 def fetch_icecreamgame_course_module_id(wstoken: str, courseid: int) -> int:
 	response = api_call(wstoken=wstoken, wsfunction="block_chatbot_get_icecreamgame_course_module_id", params=dict(
 		courseid=courseid
@@ -32,7 +32,9 @@ from services.service import Service
 from utils import SysAct, SysActionType
 from utils.domain.jsonlookupdomain import JSONLookupDomain
 from utils import UserAct
-from elearning.moodledb import ContentLinkInfo, UserSettings, WeeklySummary, fetch_available_new_course_section_ids, fetch_badge_info, fetch_branch_review_quizzes, fetch_closest_badge, fetch_content_link, fetch_first_available_course_module_id, fetch_h5pquiz_params, fetch_has_seen_any_course_modules, fetch_last_user_weekly_summary, fetch_last_viewed_course_modules, fetch_next_available_course_module_id, fetch_oldest_worst_grade_course_ids, fetch_section_completionstate, fetch_section_id_and_name, fetch_user_settings, fetch_user_statistics, fetch_viewed_course_modules_count
+from elearning.coursecache import fetch_badge_info, fetch_content_link, fetch_h5pquiz_params, fetch_section_id_and_name
+from elearning.coursegraph import fetch_available_new_course_section_ids, fetch_first_available_course_module_id, fetch_next_available_course_module_id
+from elearning.moodledb import ContentLinkInfo, UserSettings, WeeklySummary, fetch_branch_review_quizzes, fetch_closest_badge, fetch_has_seen_any_course_modules, fetch_last_user_weekly_summary, fetch_last_viewed_course_modules, fetch_oldest_worst_grade_course_ids, fetch_section_completionstate, fetch_user_settings, fetch_user_statistics, fetch_viewed_course_modules_count
 from utils.useract import UserActionType, UserAct
 # from dotenv import load_dotenv
 import os
@@ -212,7 +214,7 @@ class ELearningPolicy(Service):
             self.clear_memory(user_id)
         elif event_name == "\\core\\event\\badge_awarded":
             return {'sys_acts': [
-                self.congratulate_badge_issued(user_id=user_id, badge_id=moodle_event['objectid'], contextid=moodle_event['contextid'])
+                self.congratulate_badge_issued(user_id=user_id, courseid=moodle_event['courseid'], badge_id=moodle_event['objectid'], contextid=moodle_event['contextid'])
             ]}
         elif event_name == "\\core\\event\\course_module_completion_updated":
             # check if we finished a whole branch
@@ -223,7 +225,7 @@ class ELearningPolicy(Service):
             self.set_state(user_id, NEXT_MODULE_SUGGESTIONS, list(filter(lambda sec_info: sec_info.firstcmid != cmid, self.get_state(user_id, NEXT_MODULE_SUGGESTIONS))))
 
             # find current section id from course module
-            section_id, section_name = fetch_section_id_and_name(wstoken=self.get_wstoken(user_id), cmid=cmid)
+            section_id, section_name = fetch_section_id_and_name(wstoken=self.get_wstoken(user_id), courseid=moodle_event['courseid'], cmid=cmid)
             branch_review_info = fetch_branch_review_quizzes(wstoken=self.get_wstoken(user_id), userid=user_id, sectionid=section_id)
             self.set_state(user_id, REVIEW_QUIZZES, branch_review_info.candidates)
             if branch_review_info.completed and len(branch_review_info.candidates) > 0:
@@ -265,7 +267,7 @@ class ELearningPolicy(Service):
                 improvements.append(True if current_grade > previous_quiz_attempt_info.grade else False)
                 self.set_state(user_id=user_id, attribute_name=REVIEW_QUIZ_IMPROVEMENTS, attribute_value=improvements)
                 if not next_quiz_info is None:
-                    sys_acts.append(self.display_quiz(user_id=user_id, coursemoduleid=next_quiz_info.cmid))
+                    sys_acts.append(self.display_quiz(user_id=user_id, courseid=moodle_event['courseid'], coursemoduleid=next_quiz_info.cmid))
                 else:
                     # create a graphic summary of how many quizzes the user did better on
                     sys_acts.append(SysAct(act_type=SysActionType.DisplayQuizImprovements, slot_values={"improvements": improvements}))
@@ -274,7 +276,7 @@ class ELearningPolicy(Service):
             # In the case that the quiz is done outside the chatbot, give feedback (about absolute grade) and offer next quiz (if applicable)
             self.open_chatbot(user_id=user_id, context=ChatbotOpeningContext.QUIZ)
             success_percentage = (moodle_event['other']['result']['score']['raw'] / moodle_event['other']['result']['score']['max']) * 100.0
-            next_quiz_id = fetch_next_available_course_module_id(wstoken=self.get_wstoken(user_id), userid=user_id, current_cmid=int(moodle_event['contextinstanceid']),
+            next_quiz_id = fetch_next_available_course_module_id(wstoken=self.get_wstoken(user_id), userid=user_id, courseid=moodle_event['courseid'], current_cmid=int(moodle_event['contextinstanceid']),
                                                                  include_types='h5pactivity', allow_only_unfinished=True, current_cm_completion=True)
             if next_quiz_id is None:
                 # there are no more quizzes in the current section - suggest to move on to new section
@@ -284,7 +286,7 @@ class ELearningPolicy(Service):
                 sys_acts.append(self.fetch_n_next_available_course_sections(userid=user_id, courseid=moodle_event['courseid']))
                 return {"sys_acts": sys_acts}
             else:
-                next_quiz_link = fetch_content_link(wstoken=self.get_wstoken(user_id), cmid=next_quiz_id) if next_quiz_id else None
+                next_quiz_link = fetch_content_link(wstoken=self.get_wstoken(user_id), courseid=moodle_event['courseid'], cmid=next_quiz_id) if next_quiz_id else None
                 return {"sys_acts": [SysAct(act_type=SysActionType.FeedbackToQuiz, slot_values=dict(
                     success_percentage=success_percentage,
                     **next_quiz_link.to_dict("nächste Quiz")
@@ -428,7 +430,7 @@ class ELearningPolicy(Service):
                         # only display progress towards next closest batch if user is sufficiently close
                         acts.append(SysAct(act_type=SysActionType.DisplayBadgeProgress, slot_values=dict(
                             badge_name=closest_badge_info.name, percentage_done=closest_badge_info.completion_percentage,
-                            missing_activities=[fetch_content_link(wstoken=self.get_wstoken(user_id), cmid=cmid).to_dict()
+                            missing_activities=[fetch_content_link(wstoken=self.get_wstoken(user_id), courseid=courseid, cmid=cmid).to_dict()
                                                 for cmid in closest_badge_info.open_modules]
                         )))
                         append_suggestions=False
@@ -447,7 +449,7 @@ class ELearningPolicy(Service):
                 # only display progress towards next closest batch if user is sufficiently close
                 return SysAct(act_type=SysActionType.DisplayBadgeProgress, slot_values=dict(
                             badge_name=closest_badge_info.name, percentage_done=closest_badge_info.completion_percentage,
-                            missing_activities=[fetch_content_link(wstoken=self.get_wstoken(user_id), cmid=cmid).to_dict()
+                            missing_activities=[fetch_content_link(wstoken=self.get_wstoken(user_id), courseid=courseid, cmid=cmid).to_dict()
                                                 for cmid in closest_badge_info.open_modules]
                     ))
             else:
@@ -462,18 +464,18 @@ class ELearningPolicy(Service):
                 badge_name=None, percentage_done=None, missing_activities=None
             ))
 
-    def congratulate_badge_issued(self, user_id: int, badge_id: int, contextid: int) -> SysAct:
+    def congratulate_badge_issued(self, user_id: int, courseid: int, badge_id: int, contextid: int) -> SysAct:
         self.open_chatbot(user_id=user_id, context=ChatbotOpeningContext.BADGE)
         # find badge
-        badge_info = fetch_badge_info(wstoken=self.get_wstoken(user_id), badgeid=badge_id, contextid=contextid)
+        badge_info = fetch_badge_info(wstoken=self.get_wstoken(user_id), courseid=courseid, badgeid=badge_id, contextid=contextid)
         # get badge image link
         return SysAct(act_type=SysActionType.CongratulateBadge,
             slot_values=dict(badge_name=badge_info.name,
                     badge_img_url=badge_info.url)
         )
     
-    def display_quiz(self, user_id: int, coursemoduleid: int) -> SysAct:
-        hvp_params = fetch_h5pquiz_params(wstoken=self.get_wstoken(user_id), cmid=coursemoduleid)
+    def display_quiz(self, user_id: int, courseid: int, coursemoduleid: int) -> SysAct:
+        hvp_params = fetch_h5pquiz_params(wstoken=self.get_wstoken(user_id), courseid=courseid, cmid=coursemoduleid)
         self.resize_chatbot(user_id=user_id, size=ChatbotWindowSize.LARGE)
         return SysAct(act_type=SysActionType.DisplayQuiz, slot_values=dict(quiz_embed=hvp_params.serialize()))
     
@@ -512,7 +514,7 @@ class ELearningPolicy(Service):
         remaining_suggestions = available_new_course_section_ids[max_display_options:]
         act = SysAct(act_type=SysActionType.InformNextOptions, slot_values=dict(
                     has_more=len(remaining_suggestions) > 0,
-                    next_available_sections=[fetch_content_link(wstoken=self.get_wstoken(userid),
+                    next_available_sections=[fetch_content_link(wstoken=self.get_wstoken(userid), courseid=courseid,
                                                                 cmid=section.firstcmid).to_dict(section.name) 
                                                 for section in next_suggestions])
         )
@@ -566,7 +568,7 @@ class ELearningPolicy(Service):
                 next_quiz_info = review_candidates[0] if len(review_candidates) > 0 else None
                 self.set_state(user_id=user_id, attribute_name=CURRENT_REVIEW_QUIZ, attribute_value=next_quiz_info)
                 if not next_quiz_info is None:
-                    sys_acts.append(self.display_quiz(user_id=user_id, coursemoduleid=next_quiz_info.cmid))
+                    sys_acts.append(self.display_quiz(user_id=user_id, courseid=courseid, coursemoduleid=next_quiz_info.cmid))
                 else: 
                     sys_acts.append(SysAct(act_type=SysActionType.DisplayQuiz, slot_values={"quiz_embed": None}))
                 self.set_state(user_id, REVIEW_QUIZZES, review_candidates[1:])
@@ -653,13 +655,13 @@ class ELearningPolicy(Service):
                             next_modules[completed_module.section] = next_module_id
                 next_available_module_links = []
                 for cmid in next_modules.values():
-                    section_id, section_name = fetch_section_id_and_name(wstoken=self.get_wstoken(userid), cmid=cmid)
-                    next_available_module_links.append(fetch_content_link(wstoken=self.get_wstoken(userid), cmid=cmid).to_dict(section_name))
+                    section_id, section_name = fetch_section_id_and_name(wstoken=self.get_wstoken(userid), courseid=courseid, cmid=cmid)
+                    next_available_module_links.append(fetch_content_link(wstoken=self.get_wstoken(userid), courseid=courseid, cmid=cmid).to_dict(section_name))
 
                 # user has started, but not completed one or more sections
                 if add_last_viewed_course_module:
                     acts.append(SysAct(act_type=SysActionType.InformLastViewedCourseModule, slot_values=dict(
-                        last_viewed_course_module=fetch_content_link(wstoken=self.get_wstoken(userid), cmid=last_completed_course_module.cmid).to_dict()
+                        last_viewed_course_module=fetch_content_link(wstoken=self.get_wstoken(userid), courseid=courseid, cmid=last_completed_course_module.cmid).to_dict()
                     )))
                 if len(next_available_module_links) > 0:
                     acts.append(
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import config
+from elearning.moodledb import MoodleHealth, fetch_user_settings, moodle_health
+from utils import metrics
+
+
+class InvalidTokenError(Exception):
+    """ Moodle rejected the webservice token of the user """
+
+
+class MoodleUnavailableError(Exception):
+    """ The moodle webservice could not be reached """
+
+
+class TokenValidationCache:
+    """
+    Remembers which (user id, webservice token) pairs were validated by moodle.
+
+    Valid pairs are trusted for `ttl` seconds, pairs rejected by moodle are rejected for `negative_ttl` seconds
+    without asking moodle again. Holds at most `max_entries` pairs (least recently used pairs are evicted first).
+    """
+
+    def __init__(self, ttl: float = config.MOODLE_TOKEN_CACHE_TTL, negative_ttl: float = config.MOODLE_TOKEN_CACHE_NEGATIVE_TTL,
+                 max_entries: int = config.MOODLE_TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (user id, token) -> (valid, expiry time)
+        self._lock = threading.Lock()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_id: int, wstoken: str) -> Optional[bool]:
+        """ Returns True (validated) / False (rejected) for cached pairs, None if moodle has to be asked """
+        key = (user_id, wstoken)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def store(self, user_id: int, wstoken: str, valid: bool):
+        expiry = time.monotonic() + (self.ttl if valid else self.negative_ttl)
+        with self._lock:
+            self._entries[(user_id, wstoken)] = (valid, expiry)
+            self._entries.move_to_end((user_id, wstoken))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, wstoken: str):
+        with self._lock:
+            self._entries.pop((user_id, wstoken), None)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenValidationCache()
+metrics.gauge("moodle_token_cache_lookups_total", "Lookups in the webservice token validation cache",
+              lambda: {("hit",): token_cache.hits, ("miss",): token_cache.misses}, ["result"], "counter")
+
+
+def validate_token(wstoken: str, user_id: int, cache: TokenValidationCache = token_cache, health: MoodleHealth = moodle_health):
+    """
+    Checks that moodle accepts the webservice token of the user (probes moodle by fetching the user's settings),
+    unless the result is cached or moodle is known to be unreachable.
+
+    Raises:
+        InvalidTokenError: moodle rejected the token (or answered with settings of another user)
+        MoodleUnavailableError: moodle could not be reached
+    """
+    cached = cache.lookup(user_id, wstoken)
+    if cached is True:
+        return
+    if cached is False:
+        raise InvalidTokenError(f"webservice token of user {user_id} was rejected by moodle")
+    if health.is_down():
+        raise MoodleUnavailableError(f"moodle unreachable since {health.consecutive_failures} calls")
+    try:
+        fetch_user_settings(wstoken=wstoken, userid=user_id)
+    except (KeyError, AssertionError, TypeError) as e:
+        # moodle answered, but not with the user's settings (e.g. exception "invalidtoken")
+        cache.store(user_id, wstoken, False)
+        raise InvalidTokenError(f"webservice token of user {user_id} was rejected by moodle") from e
+    except Exception as e:
+        raise MoodleUnavailableError("moodle webservice could not be reached") from e
+    cache.store(user_id, wstoken, True)
@@ -22,56 +22,138 @@ def get_embeddings(embedder, corpus):
     #corpus_embeddings = util.normalize_embeddings(corpus_embeddings)
     return corpus_embeddings
 
-def cross_validation(corpus_per_inform):
-    embedder = SentenceTransformer('PM-AI/bi-encoder_msmarco_bert-base_german')
-    #embedder = SentenceTransformer('aari1995/German_Semantic_STS_V2', device='cuda:0')
+EVAL_MODEL = 'PM-AI/bi-encoder_msmarco_bert-base_german'
+EVAL_CACHE = './resources/eval_embeddings.pt'
+
+def embedder_name(embedder):
+    """ Key of the cached embeddings of a model: name (or path) of the transformer model and embedding dimension """
+    try:
+        name = embedder[0].auto_model.config._name_or_path
+    except (AttributeError, IndexError, KeyError, TypeError):
+        # unknown model: its embeddings must not be mixed with the cached ones
+        name = f"{type(embedder).__name__}-{id(embedder)}"
+    return f"{name}/{embedder.get_sentence_embedding_dimension()}"
+
+def encode_once(embedder, sentences, cache_path=None, model_name=None):
+    """
+    Encodes every distinct sentence only once and returns the embeddings of all sentences (in order, on the cpu).
+    With `cache_path`, the embeddings are kept on disk (for one model, `model_name`, default: see `embedder_name`)
+    and only sentences that are not cached yet are encoded.
+    """
+    if model_name is None:
+        model_name = embedder_name(embedder)
+    cached = {'model': model_name, 'corpus': [], 'embeddings': None}
+    if cache_path and os.path.exists(cache_path):
+        stored = torch.load(cache_path, map_location='cpu')
+        if stored.get('model') == model_name:
+            cached = stored
+    index = {sentence: idx for idx, sentence in enumerate(cached['corpus'])}
+    missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in index))
+    if len(missing) > 0:
+        #print("Encoding", len(missing), "new sentences...")
+        new_embeddings = get_embeddings(embedder, missing).cpu()
+        embeddings = new_embeddings if cached['embeddings'] is None else torch.cat([cached['embeddings'], new_embeddings])
+        for sentence in missing:
+            index[sentence] = len(index)
+        cached = {'model': model_name, 'corpus': cached['corpus'] + missing, 'embeddings': embeddings}
+        if cache_path:
+            torch.save(cached, cache_path)
+    return cached['embeddings'][[index[sentence] for sentence in sentences]]
+
+def group_membership(groups, num_groups, device=None):
+    """
+    Boolean matrix (at least num_groups x len(groups)): entry [g, i] is True if sentence i belongs to group g.
+    `groups` contains the group id of each sentence, or a collection of group ids (sentence in several informs).
+    """
+    pairs = [(group, idx) for idx, sentence_groups in enumerate(groups)
+             for group in (sentence_groups if isinstance(sentence_groups, (set, frozenset, list, tuple)) else [sentence_groups])]
+    if len(pairs) == 0:
+        return torch.zeros((num_groups, len(groups)), dtype=torch.bool, device=device)
+    rows, columns = zip(*pairs)
+    membership = torch.zeros((max(num_groups, max(rows) + 1), len(groups)), dtype=torch.bool, device=device)
+    membership[list(rows), list(columns)] = True
+    return membership
+
+def masked_nearest_neighbours(query_embeddings, corpus_embeddings, query_groups, corpus_groups, same_group, exclude_self=False, batch_size=1024):
+    """
+    Nearest neighbour (cosine similarity) of each query in the corpus, from one similarity matrix (computed in blocks of
+    `batch_size` queries) where the entries that are not allowed as neighbours are masked:
+     - same_group=True: only corpus sentences of the query's group (intent), with exclude_self the query itself is masked
+       (leave-one-out, queries have to be the corpus then)
+     - same_group=False: only corpus sentences not belonging to the query's group (leave-one-intent-out)
+    `query_groups` contains the group id of each query, `corpus_groups` the group id(s) of each corpus sentence (see `group_membership`).
+    Returns (scores, indices), queries without any allowed neighbour get the score -inf and index -1.
+    """
+    device = corpus_embeddings.device
+    query_embeddings = util.normalize_embeddings(query_embeddings.to(device))
+    corpus_embeddings = util.normalize_embeddings(corpus_embeddings)
+    query_groups = torch.as_tensor(query_groups, device=device)
+    membership = group_membership(corpus_groups, int(query_groups.max()) + 1 if len(query_groups) > 0 else 0, device)
     scores = []
-    for inform in corpus_per_inform:
-        #scores = []
-        for sentence in inform[1]:
-            corpus_test = inform[1].copy()
-            corpus_test.remove(sentence)
-            corpus_embeddings = get_embeddings(embedder, corpus_test)
-            query_embedding = embedder.encode(sentence, convert_to_tensor=True)
-            #query_embedding = util.normalize_embedding(query_embedding
-        
-            # We use cosine-similarity and torch.topk to find the highest 5 scores
-            cos_scores = util.cos_sim(query_embedding, corpus_embeddings)[0]
-            top_results = torch.topk(cos_scores, k=1)
-            scores.append(top_results[0][0].item())
-        #print("inform: ", inform[0])
+    indices = []
+    for start in range(0, len(query_embeddings), batch_size):
+        end = min(start + batch_size, len(query_embeddings))
+        cos_scores = query_embeddings[start:end] @ corpus_embeddings.T
+        same = membership[query_groups[start:end]]
+        mask = ~same if same_group else same
+        if exclude_self:
+            rows = torch.arange(end - start, device=device)
+            mask[rows, rows + start] = True
+        cos_scores.masked_fill_(mask, float('-inf'))
+        top_results = torch.max(cos_scores, dim=1)
+        scores.append(top_results[0])
+        indices.append(top_results[1].masked_fill(torch.isinf(top_results[0]), -1))
+    return torch.cat(scores).cpu(), torch.cat(indices).cpu()
+
+def print_scores(scores):
+    scores = [score for score in scores.tolist() if score != float('-inf')]
     print("scores: ", scores)
     print("mean: ", sum(scores)/len(scores))
     print("max: ", max(scores))
     print("min: ", min(scores))
     print("\n====================================================\n")
-        
 
-def cross_validation_across_informs(corpus_per_inform, corpus_full):
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    embedder = SentenceTransformer('PM-AI/bi-encoder_msmarco_bert-base_german', device=device)
-    #embedder = SentenceTransformer('aari1995/German_Semantic_STS_V2', device='cuda:0')
-    scores = []
-    for inform in corpus_per_inform:
-        #scores = []
-        corpus_test = corpus_full.copy()
-        for sentence in inform[1]:
-            corpus_test.remove(sentence)
-        print("corpus_test: ", len(corpus_test))
-        corpus_embeddings = get_embeddings(embedder, corpus_test)
-        for sentence in inform[1]:
-            query_embedding = embedder.encode(sentence, convert_to_tensor=True)
-      
-            # We use cosine-similarity and torch.topk to find the highest 5 scores
-            cos_scores = util.cos_sim(query_embedding, corpus_embeddings)[0]
-            top_results = torch.topk(cos_scores, k=1)
-            scores.append(top_results[0][0].item())
+def cross_validation(corpus_per_inform, embedder=None, cache_path=EVAL_CACHE):
+    """
+    Leave-one-out within each inform: score of the most similar other sentence of the same inform, for every sentence.
+    All sentences are encoded once (see `encode_once`), the neighbours are computed from the masked similarity matrix.
+    """
+    if embedder is None:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        embedder = SentenceTransformer(EVAL_MODEL, device=device)
+        #embedder = SentenceTransformer('aari1995/German_Semantic_STS_V2', device='cuda:0')
+    sentences = [sentence for inform in corpus_per_inform for sentence in inform[1]]
+    groups = [idx for idx, inform in enumerate(corpus_per_inform) for _ in inform[1]]
+    time_start = time.time()
+    corpus_embeddings = encode_once(embedder, sentences, cache_path).to(embedder.device)
+    scores, _ = masked_nearest_neighbours(corpus_embeddings, corpus_embeddings, groups, groups, same_group=True, exclude_self=True)
+    print("leave-one-out for", len(sentences), "sentences in", time.time() - time_start, "seconds")
+    print_scores(scores)
+    return scores
         
-    print("scores: ", scores)
-    print("mean: ", sum(scores)/len(scores))
-    print("max: ", max(scores))
-    print("min: ", min(scores))
-    print("\n====================================================\n")
+
+def cross_validation_across_informs(corpus_per_inform, corpus_full, embedder=None, cache_path=EVAL_CACHE):
+    """
+    Leave-one-inform-out: score of the most similar sentence of the full corpus without the sentences of the inform,
+    for every sentence of every inform (a sentence of several informs is masked for each of them).
+    """
+    if embedder is None:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        embedder = SentenceTransformer(EVAL_MODEL, device=device)
+        #embedder = SentenceTransformer('aari1995/German_Semantic_STS_V2', device='cuda:0')
+    sentences = [sentence for inform in corpus_per_inform for sentence in inform[1]]
+    groups = [idx for idx, inform in enumerate(corpus_per_inform) for _ in inform[1]]
+    informs_of_sentence = {}
+    for sentence, group in zip(sentences, groups):
+        informs_of_sentence.setdefault(sentence, set()).add(group)
+    # sentences of the full corpus that are not part of any inform are never masked
+    corpus_groups = [informs_of_sentence.get(sentence, set()) for sentence in corpus_full]
+    time_start = time.time()
+    embeddings = encode_once(embedder, sentences + corpus_full, cache_path).to(embedder.device)
+    scores, _ = masked_nearest_neighbours(embeddings[:len(sentences)], embeddings[len(sentences):], groups, corpus_groups, same_group=False)
+    print("leave-one-inform-out for", len(sentences), "sentences in", time.time() - time_start, "seconds")
+    print_scores(scores)
+    return scores
 
 def make_pickeld_corpus(corpus_train, train_labels, corpus_test, test_labels, name=""):
     
@@ -1,7 +1,7 @@
 import logging
+import os
 import time
 import traceback
-from typing import List
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
@@ -9,142 +9,58 @@ import json
 import asyncio
 
 import config
-from elearning.moodledb import fetch_user_settings
-from services.service import PublishSubscribe, Service, DialogSystem
+from elearning import load_elearning_domain, configure_moodle_session
+from elearning.coursecache import course_cache
+from elearning.coursegraph import course_navigator
+from elearning.eventqueue import MoodleEventQueue, validate_event
+from elearning.moodledb import moodle_health
+from elearning.tokencache import token_cache, validate_token
+from services.hci.gui import GUIServer
+from services.service import DialogSystem
+from utils import metrics, profiling
 from utils.logger import configure_error_logger
 
 io_loop = tornado.ioloop.IOLoop.current()
 asyncio.set_event_loop(io_loop.asyncio_loop)
 
 configure_error_logger()
-
-
-def load_elearning_domain():
-    print("LOADING ELEARNING DOMAIN")
-    from elearning.policy_ELearning import ELearningPolicy
-    from elearning.eLearningBst import ELearningBST
-    from elearning.dbloggerhandler import DBLoggingHandler
-    from services.nlg.nlg import ELearningNLG
-    from services.nlu.nlu import ELearningNLU
-    domain = 'ELearning'
-    e_learning_nlu = ELearningNLU(domain=domain)
-    e_learning_policy = ELearningPolicy(domain=domain)
-    e_learning_bst = ELearningBST(domain=domain)
-    e_learning_nlg = ELearningNLG(domain=domain)
-    e_learning_logger = DBLoggingHandler(domain=domain)
-    return domain, [e_learning_nlu, e_learning_bst, e_learning_policy, e_learning_nlg, e_learning_logger]
+start_time = time.time()
 
 #  setup dialog system
 domain_1, services_1 = load_elearning_domain()
 
-import asyncio
-class GUIServer(Service):
-    NOT_FIRST_TURN = "NOT_FIRST_TURN"
-
-    def __init__(self, domains):
-        super().__init__(domain="")
-        self.websockets = {}
-        self.domains = domains
-
-    @PublishSubscribe(sub_topics=['socket_opened'], pub_topics=['user_utterance', 'sys_state'])
-    def on_socket_opened(self, user_id: str, socket_opened: bool = True):
-        """ If page (re-)load/transition is registered (websocket (re-)connected),
-            we check if the current session state contains chat history for the given user already.
-            If not, we start a new dialog by publishing an empty user_utterance and sys_state message to the backend.
-        """
-        try:
-            if not socket_opened:
-                return
-
-            not_first_turn = self.get_state(user_id, GUIServer.NOT_FIRST_TURN)
-            if not_first_turn:
-                # check if history contains missed messages
-                # if so, send and clear buffer
-                missed = self.get_state(user_id, "MISSED_MESSAGES")
-                if missed is not None:
-                    for msg in missed:
-                        io_loop.asyncio_loop.call_soon_threadsafe(self.websockets[user_id].write_message, json.dumps([{"content": msg, "format": "text", "party": "system"}]))
-                    self.set_state(user_id, "MISSED_MESSAGES", None)
-            else:
-                # chat history not found, start new dialog in backend
-                self.set_state(user_id, GUIServer.NOT_FIRST_TURN, True)
-                return {f'user_utterance/{self.domains[0]}': '', f'sys_state/{self.domains[0]}': {}}
-        except:
-            # Log error
-            logging.getLogger("error_log").error(traceback.format_exc())
-
-    @PublishSubscribe(pub_topics=['user_utterance', 'courseid'])
-    def user_utterance(self, user_id, domain_idx = 0, courseid=0, message = ""):
-        try:
-            # forward message from moodle frontend to dialog system backend
-            return {f'user_utterance/{self.domains[domain_idx]}': message,
-                    f'courseid/{self.domains[domain_idx]}': courseid}
-        except:
-            # Log error
-            logging.getLogger("error_log").error(traceback.format_exc())
-        
-    @PublishSubscribe(pub_topics=['moodle_event'])
-    def moodle_event(self, user_id, domain_idx=0, event_data: dict = None):
-        try:
-            if 'eventname' in event_data and event_data['eventname'].lower().strip() == "\\core\\event\\user_loggedin":
-                # clear chat history when user logs back in
-                self.clear_memory(user_id)
-            return {f'moodle_event/{self.domains[domain_idx]}': event_data}
-        except:
-            # Log error
-            logging.getLogger("error_log").error(traceback.format_exc())
-    
-    @PublishSubscribe(pub_topics=['settings'])
-    def settings_changed(self, user_id, domain_idx=0, settings: dict = None):
-        return {f'settings/{self.domains[domain_idx]}': settings} 
-
-    @PublishSubscribe(sub_topics=['control_event'])
-    def forward_control_event_to_websocket(self, user_id, control_event: str = None):
-        try:
-            user_id = int(user_id)
-            if not user_id in self.websockets:
-                # store messages during page transition where socket is closed
-                # print("MISSED MSG", sys_utterance)
-                pass
-            else:
-                # forward message to moodle frontend
-                io_loop.asyncio_loop.call_soon_threadsafe(self.websockets[user_id].write_message, json.dumps([{"content": control_event, "format": "text", "party": "control"}]))
-        except:
-            # Log error
-            logging.getLogger("error_log").error(traceback.format_exc())
-
-    @PublishSubscribe(sub_topics=['sys_utterance'])
-    def forward_message_to_websocket(self, user_id, sys_utterance: List[str] = None):
-        try:
-            user_id = int(user_id)
-
-            for message in sys_utterance:
-                if not user_id in self.websockets:
-                    # store messages during page transition where socket is closed
-                    missed = self.get_state(user_id, "MISSED_MESSAGES")
-                    if missed is None:
-                        missed = []
-                    missed.append(message)
-                    self.set_state(user_id, "MISSED_MESSAGES", missed)
-                else:
-                    # forward message to moodle frontend
-                    io_loop.asyncio_loop.call_soon_threadsafe(self.websockets[user_id].write_message, json.dumps([{"content": message, "format": "text", "party": "system"}]))
-        except:
-            # Log error
-            logging.getLogger("error_log").error(traceback.format_exc())
-
 # setup dialog system
 domains = [domain_1]
-gui_service = GUIServer(domains)
+gui_service = GUIServer(domains, schedule=io_loop.asyncio_loop.call_soon_threadsafe)
 services = [gui_service]
 services.extend(services_1)
 ds = DialogSystem(services=services)
+metrics.gauge("ds_websockets", "Number of open websocket connections", lambda: len(gui_service.websockets))
+metrics.gauge("ds_join_partials", "Partially received inputs of functions subscribing to several topics",
+              lambda: {(f"{type(service).__name__}.{func_name}",): stats["partials"]
+                       for service in services for func_name, stats in service.join_stats().items()}, ["function"])
+metrics.gauge("ds_join_expired_total", "Partial inputs discarded because of the join timeout or the max. number of partials",
+              lambda: {(f"{type(service).__name__}.{func_name}",): stats["expired"] + stats["evicted"]
+                       for service in services for func_name, stats in service.join_stats().items()}, ["function"], "counter")
 error_free = ds.is_error_free_messaging_pipeline()
 if not error_free:
     ds.print_inconsistencies()
 # ds.draw_system_graph()
 print('setup system')
 
+def publish_moodle_event(user_id: int, event_data: dict):
+    # course changes invalidate the shared course metadata (also if the editing user has no active dialog),
+    # completion events the cached completion states of the user
+    course_cache.handle_event(event_data)
+    course_navigator.handle_event(event_data)
+    gui_service.moodle_event(user_id=user_id, event_data=event_data)
+
+# moodle events are published to the dialog system by the queue's worker thread
+moodle_event_queue = MoodleEventQueue(publish=publish_moodle_event,
+                                      max_pending=config.MOODLE_EVENT_QUEUE_SIZE,
+                                      debounce_window=config.MOODLE_COMPLETION_DEBOUNCE_WINDOW,
+                                      max_debounce_delay=config.MOODLE_COMPLETION_MAX_DEBOUNCE_DELAY)
+
 
 class SimpleWebSocket(tornado.websocket.WebSocketHandler):
     """ Websocket for communication between frontend and backend """ 
@@ -156,7 +72,7 @@ class SimpleWebSocket(tornado.websocket.WebSocketHandler):
         try:
             self.userid = self._extract_token(self.request.uri)
             if self.userid:
-                gui_service.websockets[self.userid] = self
+                gui_service.attach_websocket(self.userid, self)
         except:
             # Log error
             logging.getLogger("error_log").error(traceback.format_exc())
@@ -184,23 +100,23 @@ class SimpleWebSocket(tornado.websocket.WebSocketHandler):
                     # check if we can connect to the webservice.
                     # If so, start the dialog - if not, close the connection.
                     try:
-                        # this function call will fail if we can't connect to the webservice
-                        fetch_user_settings(wstoken=booksearchtoken, userid=self.userid)
-                    
-                        services_1[2].set_state(self.userid, "BOOKSEARCHTOKEN", booksearchtoken)
-                        services_1[2].set_state(self.userid, "SERVERTIMESTAMP", moodle_timestamp)
-                        services_1[2].set_state(self.userid, "WSUSERID", wsuserid)
-                        services_1[2].set_state(self.userid, "SERVERTIMEDIFFERENCE", time_diff_chatbot_moodle)
-                        services_1[-1].set_state(self.userid, "BOOKSEARCHTOKEN", booksearchtoken)
-
-                        ds._start_dialog(start_signals={f'socket_opened/{domains[domain_index]}': True, f'courseid/{domains[domain_index]}': courseid}, user_id=self.userid)
+                        # this function call will fail if we can't connect to the webservice or the token is invalid
+                        # (reconnects within config.MOODLE_TOKEN_CACHE_TTL skip the moodle call, see elearning.tokencache)
+                        validate_token(wstoken=booksearchtoken, user_id=self.userid)
+
+                        configure_moodle_session(services_1, self.userid, booksearchtoken, wsuserid, moodle_timestamp, time_diff_chatbot_moodle)
+
+                        if not (gui_service.has_session(self.userid) and ds.resume_dialog(self.userid)):
+                            ds._start_dialog(start_signals={f'socket_opened/{domains[domain_index]}': True, f'courseid/{domains[domain_index]}': courseid}, user_id=self.userid)
+                        # else: running dialog (page transition) - the websocket was attached in `open`, which delivered
+                        # the messages buffered in the meantime, no handshake with the services needed
                     except:
                         # close the connection since we can't reach the webservice (yet).
                         # UI should retry after waiting interval.
                         self.close()
                         logging.getLogger("error_log").error("MOODLE WEB SERVICE COULD NOT BE REACHED: " + traceback.format_exc()) 
                 elif topic == 'user_utterance':
-                    gui_service.websockets[self.userid] = self # set active websocket to last interaction (user might have multiple tabs open)
+                    gui_service.attach_websocket(self.userid, self) # set active websocket to last interaction (user might have multiple tabs open)
                     gui_service.user_utterance(user_id=self.userid, domain_idx=domain_index, courseid=courseid, message=data['msg'])
         except:
             # Log error
@@ -209,8 +125,7 @@ class SimpleWebSocket(tornado.websocket.WebSocketHandler):
     def on_close(self):
         try:
             # find right connection to delete
-            if self.userid in gui_service.websockets:
-                del gui_service.websockets[self.userid]
+            gui_service.detach_websocket(self.userid, self)
         except:
             # Log error
             logging.getLogger("error_log").error(traceback.format_exc()) 
@@ -224,14 +139,44 @@ class MoodleEventHandler(tornado.web.RequestHandler):
         try:
             event_data = json.loads(self.request.body)
             # print("GOT MOODLE EVENT", event_data)
-            
-            user_id = int(event_data['userid'])
-            gui_service.moodle_event(user_id=user_id, event_data=event_data)
+            validate_event(event_data)
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.set_status(400)
+            return
+        try:
+            if not moodle_event_queue.offer([event_data]):
+                # ingestion queue is full, moodle should retry later
+                self.set_status(503)
+                self.set_header("Retry-After", "1")
         except:
             # Log error
             logging.getLogger("error_log").error(traceback.format_exc()) 
 
 
+class MoodleEventBatchHandler(tornado.web.RequestHandler):
+    """ Accepts a JSON list of moodle events. Responds with 202 as soon as the events are queued for publishing. """
+    def post(self):
+        try:
+            events = json.loads(self.request.body)
+            if isinstance(events, dict):
+                events = [events]
+            for event_data in events:
+                validate_event(event_data)
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.set_status(400)
+            return
+        if moodle_event_queue.offer(events):
+            self.set_status(202)
+        else:
+            # ingestion queue is full, moodle should retry the whole batch later
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+
+
 class UserSettingsHandler(tornado.web.RequestHandler):
     def post(self):
         try:
@@ -243,11 +188,72 @@ class UserSettingsHandler(tornado.web.RequestHandler):
             # Log error
             logging.getLogger("error_log").error(traceback.format_exc())
 
+class HealthHandler(tornado.web.RequestHandler):
+    """ Reports liveness and load of this server process (polled by run_supervisor.py in multi-process mode) """
+    def get(self):
+        self.write({
+            "pid": os.getpid(),
+            "uptime": time.time() - start_time,
+            "websockets": len(gui_service.websockets),
+            "resident_users": gui_service.num_resident_users(),
+            "pending_moodle_events": moodle_event_queue.pending(),
+            "moodle": moodle_health.stats(),
+            "token_cache": token_cache.stats(),
+            "course_cache": course_cache.stats(),
+            "course_graphs": course_navigator.stats(),
+            "outbox": gui_service.outbox_stats()
+        })
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Exports turn / callback / moodle latency histograms and bus, join and connection gauges in the Prometheus text format """
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """
+    Controls on-demand profiling of PublishSubscribe functions (see utils.profiling), only reachable from config.DS_ADMIN_ALLOWED_IPS.
+
+    GET: active sessions, result files and the functions that can be profiled
+    POST {"target": "ELearningPolicy.choose_sys_act", "mode": "cprofile" or "sample", "calls": 100, "seconds": 60}: start a session
+    DELETE ?target=ELearningPolicy.choose_sys_act: stop a session (writes the result file)
+    """
+    def prepare(self):
+        if self.request.remote_ip not in config.DS_ADMIN_ALLOWED_IPS:
+            raise tornado.web.HTTPError(403)
+
+    def get(self):
+        self.write(profiling.status())
+
+    def post(self):
+        try:
+            request = json.loads(self.request.body)
+            session = profiling.start(request['target'], mode=request.get('mode', profiling.CPROFILE),
+                                      calls=request.get('calls'), seconds=request.get('seconds'))
+        except Exception as e:
+            # e.g. unknown target (see GET for the known ones), no limit given
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.set_status(400)
+            self.write({"error": repr(e)})
+            return
+        self.write(session.info())
+
+    def delete(self):
+        target = self.get_argument("target")
+        self.write({"target": target, "file": profiling.stop(target)})
+
+
 def make_app():
     return tornado.web.Application([
         (r"/ws", SimpleWebSocket),
         (r"/event", MoodleEventHandler),
-        (r"/usersettings", UserSettingsHandler)
+        (r"/events", MoodleEventBatchHandler),
+        (r"/usersettings", UserSettingsHandler),
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/admin/profile", ProfileHandler)
     ])
 
 if __name__ == "__main__":
@@ -255,8 +261,12 @@ if __name__ == "__main__":
     ssl_options = {
         "certfile": config.SSL_CERT_FILE,
         "keyfile": config.SSL_PRIVATE_KEY_FILE,
-    } if config.MOOLDE_SERVER_PROTOCOL == "https" else None
+    } if config.MOOLDE_SERVER_PROTOCOL == "https" and not config.DS_WORKER_MODE else None
     http_server = tornado.httpserver.HTTPServer(app, ssl_options=ssl_options)
-    http_server.listen(config.DS_SERVER_PORT)
+    if config.DS_WORKER_MODE:
+        # worker process behind run_supervisor.py: only accept forwarded connections from localhost
+        http_server.listen(config.DS_SERVER_PORT, address=config.DS_SERVER_IP_ADDR)
+    else:
+        http_server.listen(config.DS_SERVER_PORT)
     print("Starting tornado...")
     tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,344 @@
+"""
+Multi-process mode: starts `config.DS_SERVER_WORKERS` worker processes (each running `run_server.py` with its own dialog system)
+and accepts all websocket connections / http requests on `config.DS_SERVER_PORT`.
+
+Requests are routed to the worker owning the user (consistent hashing on the user id), so a user's websocket,
+moodle events and settings updates always reach the worker holding the user's dialog state.
+The observability endpoints of the workers are available per worker (`?worker=N`): `/health`, `/metrics`, `/admin/profile`.
+`/metrics` without a worker combines the metrics of all workers (labeled with `worker`).
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+import traceback
+from typing import Dict, List, Union
+from urllib.parse import urlencode
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+
+import config
+from utils.hashring import ConsistentHashRing
+from utils.logger import configure_error_logger
+
+configure_error_logger()
+
+
+class Worker:
+    """ Handle for one worker process """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.port = config.DS_WORKER_BASE_PORT + index
+        self.process = None
+        self.restarts = 0
+        self.healthy = False
+        self.last_health = None         # last health report of the worker
+        self.last_health_check = None   # time of the last successful health check
+
+    def start(self):
+        port_offset = self.index * config.DS_WORKER_BUS_PORT_STRIDE
+        env = dict(os.environ,
+                   DS_WORKER_MODE='true',
+                   DS_SERVER_PORT=str(self.port),
+                   DS_BUS_SUB_PORT=str(config.DS_BUS_SUB_PORT - port_offset),
+                   DS_BUS_PUB_PORT=str(config.DS_BUS_PUB_PORT - port_offset),
+                   DS_BUS_REG_PORT=str(config.DS_BUS_REG_PORT - port_offset),
+                   DS_BUS_CTRL_PORT=str(config.DS_BUS_CTRL_PORT - port_offset),
+                   DS_BUS_SHARD_BASE_PORT=str(config.DS_BUS_SHARD_BASE_PORT - port_offset))
+        self.process = subprocess.Popen([sys.executable, "run_server.py"], env=env,
+                                        cwd=os.path.dirname(os.path.realpath(__file__)))
+        self.healthy = False
+        print(f"Started worker {self.index} (pid {self.process.pid}, port {self.port})")
+
+    def url(self, path: str, protocol: str = "http") -> str:
+        return f"{protocol}://{config.DS_SERVER_IP_ADDR}:{self.port}{path}"
+
+
+workers = [Worker(index) for index in range(config.DS_SERVER_WORKERS)]
+ring = ConsistentHashRing(nodes=list(range(len(workers))), virtual_nodes=config.DS_WORKER_VIRTUAL_NODES)
+http_client = tornado.httpclient.AsyncHTTPClient()
+
+
+def get_worker(user_id: int) -> Worker:
+    return workers[ring.get_node(user_id)]
+
+
+async def forward(worker: Worker, path: str, method: str = "GET", body: bytes = None) -> Union[tornado.httpclient.HTTPResponse, None]:
+    """ Forwards a request to the given worker, returns the worker's response (None if the worker is not reachable) """
+    try:
+        return await http_client.fetch(worker.url(path), method=method, body=body, raise_error=False,
+                                       allow_nonstandard_methods=body is None and method != "GET")
+    except:
+        # worker not reachable (e.g. still starting up)
+        logging.getLogger("error_log").error(traceback.format_exc())
+        return None
+
+
+async def forward_post(worker: Worker, path: str, body: bytes) -> int:
+    """ Forwards a POST request to the given worker, returns the worker's response status """
+    response = await forward(worker, path, method="POST", body=body)
+    return response.code if response is not None else 503
+
+
+def worker_argument(handler: tornado.web.RequestHandler) -> Union[Worker, None]:
+    """ Returns the worker selected by the query argument `worker` (index), None if there is none. Raises HTTPError 400 for invalid indices. """
+    index = handler.get_argument("worker", None)
+    if index is None:
+        return None
+    if not index.isdigit() or int(index) >= len(workers):
+        raise tornado.web.HTTPError(400, f"unknown worker {index}")
+    return workers[int(index)]
+
+
+class WorkerForwardHandler(tornado.web.RequestHandler):
+    """ Base class for handlers forwarding a request to one worker (all query arguments but `worker` are passed on) """
+
+    async def forward_to(self, worker: Worker, path: str):
+        query = urlencode([(key, value) for key, values in self.request.query_arguments.items() if key != "worker"
+                           for value in values], doseq=True)
+        response = await forward(worker, f"{path}?{query}" if query else path, method=self.request.method,
+                                 body=self.request.body if self.request.method == "POST" else None)
+        if response is None:
+            self.set_status(503)
+            return
+        self.set_status(response.code)
+        if "Content-Type" in response.headers:
+            self.set_header("Content-Type", response.headers["Content-Type"])
+        if response.body:
+            self.write(response.body)
+
+
+_SAMPLE = re.compile(r"^([^\s{]+)(?:\{(.*)\})?\s+(.+)$")
+
+
+def merge_metrics(worker_metrics: Dict[int, str]) -> str:
+    """
+    Combines the metrics (Prometheus text format) of several workers: the samples of each metric family are grouped,
+    every sample gets the label `worker` (index of the worker), comment lines (HELP / TYPE) are kept once per family.
+    """
+    families = {}  # family name -> (comment lines, samples), in order of appearance
+    for index, text in worker_metrics.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = parts[2]
+                    comments, _ = families.setdefault(family, ([], []))
+                    if line not in comments:
+                        comments.append(line)
+                continue
+            match = _SAMPLE.match(line)
+            if match is None:
+                continue
+            name, labels, value = match.groups()
+            labels = f'worker="{index}",{labels}' if labels else f'worker="{index}"'
+            # samples of a family may have suffixes (e.g. histogram _bucket), samples without HELP / TYPE form their own family
+            sample_family = family if family is not None and name.startswith(family) else name
+            families.setdefault(sample_family, ([], []))[1].append(f"{name}{{{labels}}} {value}")
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class ProxyWebSocket(tornado.websocket.WebSocketHandler):
+    """ Forwards a websocket connection from the moodle frontend to the worker owning the user """
+
+    async def open(self, *args):
+        # NOTE: tornado calls on_message only after open returned, i.e. after the worker connection is established
+        self.worker_connection = None
+        self.closed = False
+        try:
+            user_id = int(self.get_argument("token"))
+            worker = get_worker(user_id)
+            self.worker_connection = await tornado.websocket.websocket_connect(worker.url(self.request.uri, protocol="ws"),
+                                                                               on_message_callback=self.on_worker_message)
+            if self.closed:
+                # client disconnected while we were connecting to the worker
+                self.worker_connection.close()
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.close()
+
+    def on_worker_message(self, message):
+        if message is None:
+            # worker closed the connection (e.g. moodle web service not reachable) - UI will retry
+            if not self.closed:
+                self.close()
+        elif not self.closed:
+            self.write_message(message)
+
+    def on_message(self, message):
+        if self.worker_connection is not None:
+            self.worker_connection.write_message(message)
+
+    def on_close(self):
+        self.closed = True
+        if self.worker_connection is not None:
+            self.worker_connection.close()
+
+    def check_origin(self, *args, **kwargs):
+        # allow cross-origin
+        return True
+
+
+class ProxyUserRequestHandler(tornado.web.RequestHandler):
+    """ Forwards a request with a single JSON object containing a `userid` (moodle event, user settings) """
+
+    async def post(self):
+        try:
+            user_id = int(json.loads(self.request.body)['userid'])
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.set_status(400)
+            return
+        self.set_status(await forward_post(get_worker(user_id), self.request.path, self.request.body))
+
+
+class ProxyEventBatchHandler(tornado.web.RequestHandler):
+    """
+    Splits a batch of moodle events by owning worker and forwards the partial batches.
+    Responds with 202 if all workers accepted their events, else with the first error status.
+    NOTE: after an error response, a retry of the full batch will deliver events accepted by other workers twice.
+    """
+
+    async def post(self):
+        try:
+            events = json.loads(self.request.body)
+            if isinstance(events, dict):
+                events = [events]
+            batches: Dict[int, List[dict]] = {}
+            for event_data in events:
+                batches.setdefault(ring.get_node(int(event_data['userid'])), []).append(event_data)
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+            self.set_status(400)
+            return
+        status = 202
+        for worker_idx, batch in batches.items():
+            worker_status = await forward_post(workers[worker_idx], "/events", json.dumps(batch).encode("utf-8"))
+            if worker_status >= 300 and status < 300:
+                status = worker_status
+        self.set_status(status)
+        if status == 503:
+            self.set_header("Retry-After", "1")
+
+
+class SupervisorHealthHandler(WorkerForwardHandler):
+    """ Reports the health of all worker processes, `?worker=N`: current health report of worker N """
+
+    async def get(self):
+        worker = worker_argument(self)
+        if worker is not None:
+            await self.forward_to(worker, "/health")
+            return
+        self.write({"workers": [{
+            "index": worker.index,
+            "pid": worker.process.pid if worker.process else None,
+            "port": worker.port,
+            "healthy": worker.healthy,
+            "restarts": worker.restarts,
+            "seconds_since_last_check": time.time() - worker.last_health_check if worker.last_health_check else None,
+            "report": worker.last_health
+        } for worker in workers]})
+
+
+class SupervisorMetricsHandler(WorkerForwardHandler):
+    """ Metrics of all workers (see `merge_metrics`), `?worker=N`: metrics of worker N only """
+
+    async def get(self):
+        worker = worker_argument(self)
+        if worker is not None:
+            await self.forward_to(worker, "/metrics")
+            return
+        responses = await asyncio.gather(*[forward(worker, "/metrics") for worker in workers])
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        # unreachable workers (e.g. restarting) are left out
+        self.write(merge_metrics({worker.index: response.body.decode("utf-8") for worker, response in zip(workers, responses)
+                                  if response is not None and response.code == 200}))
+
+
+class ProxyProfileHandler(WorkerForwardHandler):
+    """
+    Forwards profiling requests to a worker: /admin/profile?worker=N (see ProfileHandler of run_server.py, profiling is per process).
+    Only reachable from config.DS_ADMIN_ALLOWED_IPS (the workers only see the supervisor's address).
+    """
+
+    def prepare(self):
+        if self.request.remote_ip not in config.DS_ADMIN_ALLOWED_IPS:
+            raise tornado.web.HTTPError(403)
+
+    async def _forward(self):
+        worker = worker_argument(self)
+        if worker is None:
+            raise tornado.web.HTTPError(400, "missing argument worker")
+        await self.forward_to(worker, "/admin/profile")
+
+    async def get(self):
+        await self._forward()
+
+    async def post(self):
+        await self._forward()
+
+    async def delete(self):
+        await self._forward()
+
+
+async def check_workers():
+    """ Restarts terminated workers and collects the health reports of the running ones """
+    for worker in workers:
+        if worker.process.poll() is not None:
+            logging.getLogger("error_log").error(f"Worker {worker.index} terminated with exit code {worker.process.returncode}, restarting")
+            worker.restarts += 1
+            worker.start()
+            continue
+        try:
+            response = await http_client.fetch(worker.url("/health"), request_timeout=config.DS_WORKER_HEALTH_INTERVAL)
+            worker.last_health = json.loads(response.body)
+            worker.last_health_check = time.time()
+            worker.healthy = True
+        except:
+            # worker not reachable (yet)
+            worker.healthy = False
+
+
+def make_app():
+    return tornado.web.Application([
+        (r"/ws", ProxyWebSocket),
+        (r"/event", ProxyUserRequestHandler),
+        (r"/events", ProxyEventBatchHandler),
+        (r"/usersettings", ProxyUserRequestHandler),
+        (r"/health", SupervisorHealthHandler),
+        (r"/metrics", SupervisorMetricsHandler),
+        (r"/admin/profile", ProxyProfileHandler)
+    ])
+
+
+if __name__ == "__main__":
+    for worker in workers:
+        worker.start()
+    app = make_app()
+    ssl_options = {
+        "certfile": config.SSL_CERT_FILE,
+        "keyfile": config.SSL_PRIVATE_KEY_FILE,
+    } if config.MOOLDE_SERVER_PROTOCOL == "https" else None
+    http_server = tornado.httpserver.HTTPServer(app, ssl_options=ssl_options)
+    http_server.listen(config.DS_SERVER_PORT)
+    tornado.ioloop.PeriodicCallback(check_workers, config.DS_WORKER_HEALTH_INTERVAL * 1000).start()
+    print(f"Supervisor listening on port {config.DS_SERVER_PORT} with {len(workers)} workers")
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        for worker in workers:
+            worker.process.terminate()
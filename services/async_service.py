@@ -0,0 +1,233 @@
+"""
+asyncio based runtime for services.
+
+`services.service.Service` starts one thread (with its own SUB socket) per decorated function plus one thread for the
+dialog system control channel. `AsyncService` runs all of its listeners and control channel handling as coroutines
+on one shared event loop instead, so functions decorated with `PublishSubscribe` may be `async def` and await
+I/O (e.g. `elearning.moodledb.api_call_async`) without blocking a thread per waiting turn.
+"""
+import asyncio
+import inspect
+import json
+import logging
+import threading
+import traceback
+from typing import Any, Dict, List
+
+import zmq
+import zmq.asyncio
+from zmq import Context
+
+from services.service import Service, _JoinBuffer, _send_msg, _send_ack, _deserialize_content, _recv_msg_async, _control_reply_payload, \
+    _ROUTE_TERMINATE, CTRL_READY, CTRL_START, CTRL_END, CTRL_TERMINATE, CTRL_TRAIN, CTRL_EVAL, CTRL_OK
+from utils import tracing
+
+
+class _ServiceLoop:
+    """ Event loop (running in a daemon thread) shared by all AsyncService instances of this process """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # share the underlying context with the synchronous sockets (required for inproc transport)
+        self.ctx = zmq.asyncio.Context.shadow(Context.instance().underlying)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="AsyncServiceLoop", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls) -> "_ServiceLoop":
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = _ServiceLoop()
+            return cls._instance
+
+    def run(self, coro):
+        """ Runs `coro` on the service loop, blocks until it completed and returns its result """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+def get_service_loop() -> asyncio.AbstractEventLoop:
+    """ Returns the event loop running all AsyncService listeners (e.g. to schedule work from other threads) """
+    return _ServiceLoop.get_instance().loop
+
+
+async def _recv_ack_async(sub_channel, topic: str, expected_content=True, expected_user="default"):
+    """ Waits until an acknowledge-message for the specified topic with the expected content is received """
+    ack_topic = bytes(topic if topic.startswith("ACK/") else f"ACK/{topic}", encoding="ascii")
+    while True:
+        recv_topic, data = await _recv_msg_async(sub_channel)
+        if recv_topic == ack_topic and data['content'] == expected_content and data['user_id'] == expected_user:
+            return
+
+
+class AsyncService(Service):
+    """
+    Service base class running on the shared asyncio event loop instead of one thread per listener.
+
+    * Functions decorated with `PublishSubscribe` may be coroutines (async def). Turns of different users run concurrently,
+      turns of the same user (and function) are processed in the order their inputs arrived.
+    * Synchronous decorated functions are called directly on the event loop, so they must not block
+      (use async def and `await` for I/O).
+    * `dialog_start` may also be a coroutine.
+
+    The interface (topics, control messages, state) is the same as for `Service`, so both kinds of services can be
+    mixed in one `DialogSystem`.
+    """
+
+    _async_handlers = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._service_loop = _ServiceLoop.get_instance()
+        self._turn_tasks = {}  # (function name, user id) -> task of the latest turn (only accessed on the service loop)
+        self._receivers = []   # arguments of the receiver coroutines (started by _register_with_dialogsystem)
+
+    def _setup_listener(self, func_instance, topics: List[str], queued_topics: List[str]):
+        """ Same as `Service._setup_listener`, but registers a receiver coroutine instead of a thread """
+        if len(topics + queued_topics) == 0:
+            # no subscribed to topics - no need to setup anything (e.g. only publisher)
+            return
+        assert set(topics).isdisjoint(queued_topics), "sub_topics and queued_sub_topics have to be disjoint!"
+
+        terminate_topic = f"{str(func_instance)}/TERMINATE"
+        self._listener_names.append(func_instance.func_name)
+        self._join_buffers[func_instance.func_name] = _JoinBuffer(len(topics) + len(queued_topics))
+        self._internal_terminate_topics[terminate_topic] = str(func_instance)
+
+        subscriber = self._service_loop.run(self._create_subscriber(
+            subscriptions=[self._get_sub_topic_str(topic) for topic in topics + queued_topics], control_subscriptions=[terminate_topic]))
+        control_channel_pub = self._bus.publisher(Context.instance(), control=True, owner=self._start_topic)
+        self._receivers.append((subscriber, control_channel_pub, func_instance, topics, queued_topics, terminate_topic))
+
+        # add to list of local topics
+        self._sub_topics.update(topics + queued_topics)
+
+    async def _create_subscriber(self, subscriptions: List[str] = [], control_subscriptions: List[str] = []):
+        """ Creates an asyncio SUB socket (on the service loop) """
+        return self._bus.subscriber(self._service_loop.ctx, subscriptions=subscriptions,
+                                    control_subscriptions=control_subscriptions, owner=self._start_topic)
+
+    async def _receiver(self, subscriber, control_channel_pub, func_instance, topics: List[str], queued_topics: List[str], terminate_topic: str):
+        """ Coroutine version of `Service._receiver_thread` """
+        routes = self._make_routing_table(topics, queued_topics, terminate_topic)
+        terminating = False
+        func_name = func_instance.func_name # get function name from delegate
+        active_attr = f"_{func_name}_active"
+        join_buffer = self._join_buffers[func_name]
+
+        while not terminating:
+            try:
+                topic, data = await _recv_msg_async(subscriber)
+                route = routes.get(topic)
+                if route is None:
+                    # topic received for the first time (prefix match of a subscription)
+                    route = self._resolve_route(routes, topic, topics, queued_topics)
+                kind, arg_name = route
+                user_id = data['user_id']
+
+                if kind == _ROUTE_TERMINATE:
+                    # shutdown listener by exiting loop
+                    self.set_state(user_id, active_attr, False)
+                    _send_ack(control_channel_pub, terminate_topic, True, user_id)
+                    terminating = True
+                elif self.get_state(user_id, active_attr):
+                    # non-control message
+                    if self.debug_logger:
+                        self.debug_logger.info(
+                            f"- (DS): listener for user {user_id}, function {func_instance}:\n   received for topic {topic.decode('ascii')}:\n   {data['content']}")
+                    # the task of an async function copies the trace context when it is scheduled
+                    with tracing.use_context(data.get('trace')):
+                        result = self._dispatch(func_instance, user_id, kind, arg_name, _deserialize_content(data['content']),
+                                                data['timestamp'], join_buffer)
+                        if inspect.iscoroutine(result):
+                            self._schedule_turn(func_name, user_id, result)
+            except asyncio.CancelledError:
+                break
+            except:
+                logging.getLogger("error_log").error(traceback.format_exc())
+        # shutdown
+        subscriber.close()
+        control_channel_pub.close()
+
+    def _schedule_turn(self, func_name: str, user_id, coro):
+        """ Runs the coroutine of a function call as a task, after the previous call for the same function and user finished """
+        key = (func_name, user_id)
+        task = asyncio.get_running_loop().create_task(self._run_turn(self._turn_tasks.get(key), coro))
+        self._turn_tasks[key] = task
+
+        def _forget(finished_task):
+            if self._turn_tasks.get(key) is finished_task:
+                del self._turn_tasks[key]
+        task.add_done_callback(_forget)
+
+    async def _run_turn(self, previous: asyncio.Task, coro):
+        if previous is not None:
+            # keep order of turns per user (exceptions of the previous turn are logged there)
+            await asyncio.wait([previous])
+        try:
+            await coro
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    def _setup_dialog_ctrl_msg_listener(self, ctx=None):
+        # receiver for internal ACK messages (listener shutdown) is an asyncio socket
+        self._service_loop.run(self._setup_async_ctrl_msg_listener())
+
+    async def _setup_async_ctrl_msg_listener(self):
+        super()._setup_dialog_ctrl_msg_listener(self._service_loop.ctx)
+
+    def _register_with_dialogsystem(self):
+        """ Starts all receiver coroutines and the control channel listener """
+        for receiver_args in self._receivers:
+            asyncio.run_coroutine_threadsafe(self._receiver(*receiver_args), self._service_loop.loop)
+        # start listening to dialog system control channel messages
+        asyncio.run_coroutine_threadsafe(self._async_control_channel_listener(), self._service_loop.loop)
+
+    async def _handle_dialog_start_async(self, user_ids: List[Any]) -> Dict[Any, str]:
+        """ Same as `Service._handle_dialog_start`, `dialog_start` may be a coroutine """
+        failed = {}
+        for user_id in user_ids:
+            try:
+                started = self.dialog_start(user_id=user_id)
+                if inspect.isawaitable(started):
+                    await started
+                self._start_listeners(user_id)
+            except:
+                logging.getLogger("error_log").error(traceback.format_exc())
+                failed[user_id] = traceback.format_exc(limit=1)
+        return failed
+
+    async def _async_control_channel_listener(self):
+        """ Coroutine version of `Service._control_channel_listener` """
+        self._control_socket = self._connect_control_plane(self._service_loop.ctx)
+        await self._control_socket.send_multipart((b"", CTRL_READY, b"null"))
+        listen = True
+        while listen:
+            try:
+                correlation_id, command, payload = await self._control_socket.recv_multipart()
+                payload = json.loads(payload)
+                failed = {}
+
+                if command == CTRL_START:
+                    failed = await self._handle_dialog_start_async(payload)
+                elif command == CTRL_END:
+                    failed = self._handle_dialog_end(payload)
+                elif command == CTRL_TERMINATE:
+                    # terminate all listeners of this service (wait until they stopped)
+                    for internal_terminate_topic in self._internal_terminate_topics:
+                        _send_msg(self._control_channel_pub, internal_terminate_topic, True, payload)
+                        await _recv_ack_async(self._internal_control_channel_sub, internal_terminate_topic, True, payload)
+                    self.dialog_exit(payload)
+                    listen = False
+                elif command == CTRL_TRAIN:
+                    self.train()
+                elif command == CTRL_EVAL:
+                    self.eval()
+                await self._control_socket.send_multipart((correlation_id, CTRL_OK, _control_reply_payload(failed)))
+            except asyncio.CancelledError:
+                break
+            except:
+                logging.getLogger("error_log").error(traceback.format_exc())
+        self._control_socket.close()
@@ -0,0 +1,517 @@
+"""
+Message bus topologies: decides where the PUB / SUB sockets of services connect to (or bind on).
+
+* `PROXY`: all messages go through one XSUB/XPUB proxy thread (default)
+* `SHARDED`: one proxy thread per topic family (`config.DS_BUS_SHARD_FAMILIES`), one for control messages
+  (listener shutdown and its acknowledgements) and one for all other topics.
+  Each message goes through exactly one proxy (the one of its topic), publishers of several families use one socket
+  per proxy. Subscribers connect to all proxies whose topics can match their subscriptions.
+* `BROKERLESS`: no proxy - every publisher binds its own endpoint, subscribers connect directly to all publishers of
+  matching topics. Requires a two-phase setup: first all publishers are created (and registered in the endpoint
+  registry), then `wire` connects the subscribers. Remote services receive the registry during registration.
+
+All sockets have bounded queues (`config.DS_BUS_HWM`, per topic `config.DS_BUS_TOPIC_HWM`). Publishers never drop
+messages silently (XPUB_NODROP): a full queue is handled by the overflow policy of the publishing topic (see `BoundedPublisher`),
+overflows are counted per topic (see `publish_stats`).
+The proxies don't use XPUB_NODROP, so a slow subscriber can't stall a proxy (and with it all users and topics): once the queue
+of one subscriber is full, the proxy drops the messages for this subscriber only.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import zmq
+from zmq.devices import ThreadProxy
+
+import config
+from utils import metrics
+
+
+PROXY = "proxy"
+SHARDED = "sharded"
+BROKERLESS = "brokerless"
+TOPOLOGIES = (PROXY, SHARDED, BROKERLESS)
+
+# overflow policies (what happens to a published message if the send queue is full)
+BLOCK = "block"              # wait until there is space again (at most `config.DS_BUS_BLOCK_TIMEOUT`, then like REJECT, raises PublishTimeoutError)
+DROP_OLDEST = "drop_oldest"  # buffer the message, drop the oldest buffered message of the topic if the buffer is full
+REJECT = "reject"            # drop the message and raise PublishOverflowError (the service sends an error act to the user)
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, REJECT)
+
+
+class PublishOverflowError(Exception):
+    """ Raised when a message is rejected because the send queue of its topic is full (overflow policy REJECT) """
+
+    def __init__(self, topic: str, reason: str = "message rejected"):
+        super().__init__(f"send queue for topic {topic} is full, {reason}")
+        self.topic = topic
+
+
+class PublishTimeoutError(PublishOverflowError):
+    """ Raised when a message is dropped because the send queue of its topic stayed full for `config.DS_BUS_BLOCK_TIMEOUT` (overflow policy BLOCK) """
+
+    def __init__(self, topic: str, timeout: float):
+        super().__init__(topic, f"message dropped after waiting {timeout} s")
+
+
+def high_water_mark(topic: str) -> int:
+    """ Returns the send queue size (messages) for a topic (without domain) """
+    return config.DS_BUS_TOPIC_HWM.get(topic, config.DS_BUS_HWM)
+
+
+def overflow_policy(topic: str) -> str:
+    """ Returns the overflow policy for a topic (without domain) """
+    policy = config.DS_BUS_TOPIC_OVERFLOW_POLICY.get(topic, config.DS_BUS_OVERFLOW_POLICY)
+    assert policy in OVERFLOW_POLICIES, f"unknown overflow policy {policy} for topic {topic}"
+    return policy
+
+
+class _TopicStats:
+    """ Overflow counters of one topic (summed over all publishers of this process) """
+
+    def __init__(self):
+        self.sent = 0               # messages handed to the bus
+        self.queued = 0             # messages currently waiting in DROP_OLDEST buffers
+        self.dropped = 0            # messages dropped (DROP_OLDEST buffer full)
+        self.rejected = 0           # messages rejected (REJECT)
+        self.timed_out = 0          # messages dropped after waiting for space (BLOCK timeout)
+        self.blocked_seconds = 0.0  # time publishers waited for space in the send queue
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"sent": self.sent, "queued": self.queued, "dropped": self.dropped, "rejected": self.rejected,
+                "timed_out": self.timed_out, "blocked_seconds": self.blocked_seconds}
+
+
+_stats: Dict[str, _TopicStats] = {}
+_stats_lock = threading.Lock()
+
+
+def _stats_for(topic: str) -> _TopicStats:
+    with _stats_lock:
+        if topic not in _stats:
+            _stats[topic] = _TopicStats()
+        return _stats[topic]
+
+
+def publish_stats() -> Dict[str, Dict[str, float]]:
+    """ Returns the publish counters (sent, queued, dropped, rejected, timed_out, blocked_seconds) per topic (without domain) """
+    with _stats_lock:
+        return {topic: stats.to_dict() for topic, stats in _stats.items()}
+
+
+def _publish_stat(key: str) -> Dict[Tuple[str], float]:
+    return {(topic,): stats[key] for topic, stats in publish_stats().items()}
+
+
+metrics.gauge("ds_bus_queued_messages", "Messages waiting in publisher buffers (overflow policy drop_oldest), per topic",
+              lambda: _publish_stat("queued"), ["topic"])
+metrics.gauge("ds_bus_sent_total", "Messages handed to the bus, per topic", lambda: _publish_stat("sent"), ["topic"], "counter")
+metrics.gauge("ds_bus_dropped_total", "Messages dropped because of full send queues, per topic",
+              lambda: _publish_stat("dropped"), ["topic"], "counter")
+metrics.gauge("ds_bus_rejected_total", "Messages rejected because of full send queues, per topic",
+              lambda: _publish_stat("rejected"), ["topic"], "counter")
+metrics.gauge("ds_bus_timed_out_total", "Messages dropped because send queues stayed full for the block timeout, per topic",
+              lambda: _publish_stat("timed_out"), ["topic"], "counter")
+metrics.gauge("ds_bus_blocked_seconds_total", "Time publishers waited for space in full send queues, per topic",
+              lambda: _publish_stat("blocked_seconds"), ["topic"], "counter")
+
+
+class BoundedPublisher:
+    """
+    Wraps a PUB socket (created with XPUB_NODROP, so a full queue raises zmq.Again instead of dropping messages)
+    and applies the overflow policy of the topic of each message. Can be used in place of the socket for
+    `services.service._send_msg`, which raises PublishOverflowError (REJECT) / PublishTimeoutError (BLOCK timeout)
+    for messages that could not be sent.
+    """
+
+    _flush_interval = 0.01  # seconds between retries of sending DROP_OLDEST buffers
+
+    def __init__(self, socket, policy: str = None, buffer_size: int = config.DS_BUS_HWM,
+                 block_timeout: float = config.DS_BUS_BLOCK_TIMEOUT):
+        """
+        Args:
+            socket: PUB socket (see `BusTopology.publisher`)
+            policy: overflow policy for all topics, None: configured policy of each topic (see `overflow_policy`)
+            buffer_size: max. number of buffered messages (DROP_OLDEST)
+            block_timeout: max. seconds to wait for space in the send queue (BLOCK)
+        """
+        assert policy is None or policy in OVERFLOW_POLICIES, f"unknown overflow policy {policy}"
+        self._socket = socket
+        self._policy = policy
+        self._block_timeout = block_timeout
+        self._pending = deque()  # DROP_OLDEST: (frames, stats) waiting for space in the send queue
+        self._buffer_size = buffer_size
+        self._topics = {}        # encoded topic -> (stats, policy)
+        self._lock = threading.Lock()  # the socket is used by the publishing threads and the flush thread
+
+    def _topic(self, topic: bytes) -> Tuple[_TopicStats, str]:
+        if topic not in self._topics:
+            topic_name = topic.decode("ascii").split("/")[0]
+            self._topics[topic] = (_stats_for(topic_name), self._policy if self._policy else overflow_policy(topic_name))
+        return self._topics[topic]
+
+    def _try_send(self, frames, copy: bool) -> bool:
+        try:
+            self._socket.send_multipart(frames, flags=zmq.NOBLOCK, copy=copy)
+            return True
+        except zmq.Again:
+            return False
+
+    def send_multipart(self, frames, copy: bool = False):
+        stats, policy = self._topic(frames[0])
+        with self._lock:
+            # buffered messages are sent first (keeps the order of messages)
+            if self._flush() and self._try_send(frames, copy):
+                stats.sent += 1
+                return
+
+            # send queue is full
+            if policy == BLOCK:
+                self._block(frames, copy, stats)
+            elif policy == DROP_OLDEST:
+                if len(self._pending) >= self._buffer_size:
+                    dropped_frames, dropped_stats = self._pending.popleft()
+                    dropped_stats.queued -= 1
+                    self._dropped(dropped_stats, dropped_frames[0])
+                self._pending.append((frames, stats))
+                stats.queued += 1
+                _Flusher.get_instance().add(self)
+            else:
+                stats.rejected += 1
+                raise PublishOverflowError(frames[0].decode("ascii"))
+
+    def _block(self, frames, copy: bool, stats: _TopicStats):
+        start = time.perf_counter()
+        delay = 0.0001
+        sent = False
+        while not sent and time.perf_counter() - start < self._block_timeout:
+            time.sleep(delay)
+            delay = min(2 * delay, 0.01)
+            sent = self._flush() and self._try_send(frames, copy)
+        stats.blocked_seconds += time.perf_counter() - start
+        if not sent:
+            stats.timed_out += 1
+            raise PublishTimeoutError(frames[0].decode("ascii"), self._block_timeout)
+        stats.sent += 1
+
+    @staticmethod
+    def _dropped(stats: _TopicStats, topic: bytes):
+        stats.dropped += 1
+        if stats.dropped == 1 or stats.dropped % 1000 == 0:
+            logging.getLogger("error_log").warning(f"bus overflow: dropped {stats.dropped} message(s) of topic {topic.decode('ascii')}")
+
+    def _flush(self) -> bool:
+        """ Sends buffered messages (DROP_OLDEST) while there is space. Returns True if the buffer is empty. """
+        while self._pending:
+            frames, stats = self._pending[0]
+            if not self._try_send(frames, False):
+                return False
+            self._pending.popleft()
+            stats.queued -= 1
+            stats.sent += 1
+        return True
+
+    def flush(self) -> bool:
+        with self._lock:
+            return self._flush()
+
+    def close(self):
+        with self._lock:
+            for _, stats in self._pending:
+                stats.queued -= 1
+                stats.dropped += 1
+            self._pending.clear()
+            self._socket.close()
+
+
+class _Flusher:
+    """ Daemon thread sending the buffered messages of DROP_OLDEST publishers, even if no new message is published """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self._publishers = set()
+        self._publishers_lock = threading.Lock()
+        threading.Thread(target=self._run, name="BusFlusher", daemon=True).start()
+
+    @classmethod
+    def get_instance(cls) -> "_Flusher":
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = _Flusher()
+            return cls._instance
+
+    def add(self, publisher: BoundedPublisher):
+        with self._publishers_lock:
+            self._publishers.add(publisher)
+
+    def _run(self):
+        while True:
+            time.sleep(BoundedPublisher._flush_interval)
+            with self._publishers_lock:
+                publishers = list(self._publishers)
+            for publisher in publishers:
+                if publisher.flush():
+                    with self._publishers_lock:
+                        self._publishers.discard(publisher)
+
+
+class _ShardedPublisher:
+    """
+    Publisher of topics of several shards (sharded topology): one PUB socket per shard, each message is sent through the
+    socket of the shard of its topic (a single socket connected to several shards would send it through all of them).
+    Can be used in place of a PUB socket for `BoundedPublisher` and `services.service._send_msg`.
+    """
+
+    def __init__(self, topology: "BusTopology", ctx, shards: List[int], hwm: int):
+        self._topology = topology
+        self._ctx = ctx
+        self._hwm = hwm
+        self._sockets = {shard: topology._shard_publisher(ctx, shard, hwm) for shard in shards}
+        self._routes = {}  # encoded topic -> socket
+
+    def _socket(self, topic: bytes):
+        socket = self._routes.get(topic)
+        if socket is None:
+            shard = self._topology._shard_of(_topic_name(topic.decode("ascii")))
+            if shard not in self._sockets:
+                # topic not declared when the publisher was created (e.g. start signals)
+                self._sockets[shard] = self._topology._shard_publisher(self._ctx, shard, self._hwm)
+            socket = self._routes[topic] = self._sockets[shard]
+        return socket
+
+    def send_multipart(self, frames, flags: int = 0, copy: bool = True, track: bool = False):
+        return self._socket(frames[0]).send_multipart(frames, flags=flags, copy=copy, track=track)
+
+    def close(self, linger: int = None):
+        for socket in self._sockets.values():
+            socket.close(linger)
+
+
+class _Endpoint:
+    """ Registry entry for a bound publisher (brokerless topology) """
+
+    def __init__(self, address: str, topics: Optional[List[str]], control: bool, owner: str):
+        self.address = address
+        self.topics = topics    # published topics (without domain), None: any topic (e.g. start signals)
+        self.control = control  # control publisher (only relevant for subscribers of the same owner)
+        self.owner = owner
+
+    def to_tuple(self) -> Tuple:
+        return self.address, self.topics, self.control, self.owner
+
+
+def _topic_name(subscription: str) -> str:
+    """ Strips the domain from a subscription string, e.g. 'user_acts/ELearning' -> 'user_acts' """
+    return subscription.split("/")[0]
+
+
+class BusTopology:
+    """
+    Creates the bus sockets for services and the dialog system.
+
+    The dialog system creates one instance (and starts the proxies, if any) and shares it with all local services.
+    Services running standalone on a remote node create their own instance from the config.
+    """
+
+    def __init__(self, kind: str = PROXY, protocol: str = "tcp", host: str = config.DS_SERVER_IP_ADDR,
+                 sub_port: int = config.DS_BUS_SUB_PORT, pub_port: int = config.DS_BUS_PUB_PORT,
+                 shard_families: List[str] = config.DS_BUS_SHARD_FAMILIES, shard_base_port: int = config.DS_BUS_SHARD_BASE_PORT,
+                 advertise_host: str = config.DS_BUS_ADVERTISE_ADDR):
+        """
+        Args:
+            kind: one of PROXY, SHARDED, BROKERLESS
+            protocol: either 'inproc' or 'tcp'
+            host: address of the proxies
+            sub_port / pub_port: proxy ports subscribers / publishers connect to (proxy topology)
+            shard_families: topic prefixes getting their own proxy (sharded topology)
+            shard_base_port: shard i binds the ports shard_base_port + 2 * i (publishers) and shard_base_port + 2 * i + 1 (subscribers)
+            advertise_host: address publishers bind on in the brokerless topology (has to be reachable by remote services)
+        """
+        assert kind in TOPOLOGIES, f"unknown bus topology {kind}"
+        self.kind = kind
+        self.protocol = protocol
+        self.host = host
+        self.sub_port = sub_port
+        self.pub_port = pub_port
+        self.shard_families = list(shard_families)
+        self.shard_base_port = shard_base_port
+        self.advertise_host = advertise_host
+        # shards: one per topic family, then control, then default
+        self._control_shard = len(self.shard_families)
+        self._default_shard = len(self.shard_families) + 1
+        self._proxies = []
+
+        # brokerless topology
+        self._endpoints: List[_Endpoint] = []
+        self._unwired = []  # (socket, subscribed topic names, control, owner) of subscribers created before `wire`
+        self._wired = False
+
+    def _address(self, port: int) -> str:
+        return f"{self.protocol}://{self.host}:{port}"
+
+    def _shard_ports(self, shard: int) -> Tuple[int, int]:
+        """ Returns (publisher port, subscriber port) of a shard """
+        return self.shard_base_port + 2 * shard, self.shard_base_port + 2 * shard + 1
+
+    def _data_shards(self) -> List[int]:
+        return [shard for shard in range(self._default_shard + 1) if shard != self._control_shard]
+
+    def _shard_of(self, topic_name: str) -> int:
+        """ Returns the data shard carrying a topic (without domain): the first matching topic family, else the default shard """
+        for idx, family in enumerate(self.shard_families):
+            if topic_name.startswith(family):
+                return idx
+        return self._default_shard
+
+    def _shards_of(self, topic_names: Optional[List[str]]) -> List[int]:
+        """ Returns the data shards carrying the given topics (None: all data shards) """
+        if topic_names is None or "" in topic_names:
+            return self._data_shards()
+        return sorted({self._shard_of(name) for name in topic_names})
+
+    def _subscription_shards(self, topic_names: List[str]) -> List[int]:
+        """
+        Returns the data shards a subscriber of the given topics (prefix matches) has to connect to:
+        the shards of all families that could match a subscription (e.g. 'sys' matches the family 'sys_acts')
+        and the default shard, unless the subscription only matches topics of one family.
+        """
+        if "" in topic_names:
+            return self._data_shards()
+        shards = set()
+        for name in topic_names:
+            shards.update(idx for idx, family in enumerate(self.shard_families) if name.startswith(family) or family.startswith(name))
+            if not any(name.startswith(family) for family in self.shard_families):
+                shards.add(self._default_shard)
+        return sorted(shards)
+
+    def start_brokers(self):
+        """ Starts the proxy thread(s) of the topology (called once by the dialog system) """
+        if self.kind == PROXY:
+            port_pairs = [(self.pub_port, self.sub_port)]
+        elif self.kind == SHARDED:
+            port_pairs = [self._shard_ports(shard) for shard in range(self._default_shard + 1)]
+        else:
+            return
+        for pub_port, sub_port in port_pairs:
+            proxy = ThreadProxy(in_type=zmq.XSUB, out_type=zmq.XPUB)
+            # bounded queues; no XPUB_NODROP on the output: a slow subscriber would block the proxy for all subscribers,
+            # instead the messages for a subscriber with a full queue are dropped. A full input queue (proxy slower than
+            # the publishers) surfaces at the publishers and is handled by their overflow policy.
+            proxy.setsockopt_in(zmq.RCVHWM, config.DS_BUS_HWM)
+            proxy.setsockopt_out(zmq.SNDHWM, config.DS_BUS_HWM)
+            proxy.bind_in(self._address(pub_port))
+            proxy.bind_out(self._address(sub_port))
+            proxy.start()
+            self._proxies.append(proxy)
+
+    def publisher(self, ctx, topics: Optional[List[str]] = None, control: bool = False, owner: str = None,
+                  hwm: int = config.DS_BUS_HWM):
+        """
+        Creates a PUB socket. Sends block (or raise zmq.Again with zmq.NOBLOCK) if the send queue is full.
+
+        Args:
+            topics: topics (without domain) published on the socket, None: any topic
+            control: True for sockets publishing only listener shutdown messages / acknowledgements
+            owner: service the socket belongs to (control messages are only exchanged within a service)
+            hwm: send queue size (messages)
+        """
+        if self.kind == SHARDED:
+            if control:
+                return self._shard_publisher(ctx, self._control_shard, hwm)
+            shards = self._shards_of(topics)
+            if len(shards) == 1:
+                return self._shard_publisher(ctx, shards[0], hwm)
+            # one socket per shard: every message has to go through the shard of its topic only
+            return _ShardedPublisher(self, ctx, shards, hwm)
+        publisher = ctx.socket(zmq.PUB)
+        publisher.sndhwm = hwm
+        publisher.setsockopt(zmq.XPUB_NODROP, 1)
+        if self.kind == PROXY:
+            publisher.connect(self._address(self.pub_port))
+        else:
+            assert not self._wired, "brokerless topology: publishers have to be created before the subscribers are wired"
+            if self.protocol == "inproc":
+                address = f"inproc://bus-{uuid.uuid4().hex}"
+                publisher.bind(address)
+            else:
+                port = publisher.bind_to_random_port(f"tcp://{self.advertise_host}",
+                                                     min_port=config.DS_BUS_BROKERLESS_PORTS[0],
+                                                     max_port=config.DS_BUS_BROKERLESS_PORTS[1])
+                address = f"tcp://{self.advertise_host}:{port}"
+            self._endpoints.append(_Endpoint(address, topics, control, owner))
+        return publisher
+
+    def _shard_publisher(self, ctx, shard: int, hwm: int):
+        """ Creates a PUB socket connected to one shard (sharded topology) """
+        publisher = ctx.socket(zmq.PUB)
+        publisher.sndhwm = hwm
+        publisher.setsockopt(zmq.XPUB_NODROP, 1)
+        publisher.connect(self._address(self._shard_ports(shard)[0]))
+        return publisher
+
+    def subscriber(self, ctx, subscriptions: List[str] = [], control_subscriptions: List[str] = [], owner: str = None):
+        """
+        Creates a SUB socket subscribed to the given topic strings.
+
+        Args:
+            subscriptions: data topics (including domain)
+            control_subscriptions: listener shutdown topics / acknowledgements
+            owner: service the socket belongs to
+        """
+        subscriber = ctx.socket(zmq.SUB)
+        subscriber.rcvhwm = config.DS_BUS_HWM
+        for topic in subscriptions + control_subscriptions:
+            subscriber.setsockopt(zmq.SUBSCRIBE, bytes(topic, encoding="ascii"))
+        topic_names = [_topic_name(topic) for topic in subscriptions]
+        if self.kind == PROXY:
+            subscriber.connect(self._address(self.sub_port))
+        elif self.kind == SHARDED:
+            shards = self._subscription_shards(topic_names) if len(subscriptions) > 0 else []
+            if len(control_subscriptions) > 0:
+                shards.append(self._control_shard)
+            for shard in shards:
+                subscriber.connect(self._address(self._shard_ports(shard)[1]))
+        else:
+            entry = (subscriber, topic_names, len(control_subscriptions) > 0, owner)
+            if self._wired:
+                self._connect(*entry)
+            else:
+                self._unwired.append(entry)
+        return subscriber
+
+    def _connect(self, subscriber, topic_names: List[str], control: bool, owner: str):
+        """ Connects a subscriber to all registered publishers of matching topics (brokerless topology) """
+        for endpoint in self._endpoints:
+            if endpoint.control:
+                matches = control and endpoint.owner == owner
+            elif endpoint.topics is None:
+                matches = len(topic_names) > 0
+            else:
+                # subscriptions are prefix matches - connect if any topic could match (filtering is done by the socket)
+                matches = any(topic.startswith(name) or name.startswith(topic) for topic in endpoint.topics for name in topic_names)
+            if matches:
+                subscriber.connect(endpoint.address)
+
+    def endpoints(self) -> List[Tuple]:
+        """ Returns the registry of bound publishers (brokerless topology), e.g. to send it to remote services """
+        return [endpoint.to_tuple() for endpoint in self._endpoints]
+
+    def add_endpoints(self, endpoints: List[Tuple]):
+        """ Adds publishers registered by another node (brokerless topology) """
+        for address, topics, control, owner in endpoints:
+            if address not in [endpoint.address for endpoint in self._endpoints]:
+                self._endpoints.append(_Endpoint(address, topics, control, owner))
+
+    def wire(self):
+        """ Connects all subscribers created so far to the registered publishers (brokerless topology, second setup phase) """
+        if self.kind != BROKERLESS:
+            return
+        for entry in self._unwired:
+            self._connect(*entry)
+        self._unwired = []
+        self._wired = True
@@ -18,5 +18,7 @@
 ###############################################################################
 
 from .console import ConsoleInput, ConsoleOutput
+from .gui import GUIServer
+from .outbox import WebsocketOutbox
 
-__all__ = [ConsoleInput, ConsoleOutput]
\ No newline at end of file
+__all__ = [ConsoleInput, ConsoleOutput, GUIServer, WebsocketOutbox]
\ No newline at end of file
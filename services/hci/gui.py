@@ -0,0 +1,151 @@
+"""Service connecting the dialog system to the chat widget of the moodle frontend (websocket connections, see run_server.py)."""
+import logging
+import threading
+import time
+import traceback
+from typing import Any, Callable, List
+
+import config
+from services.hci.outbox import WebsocketOutbox
+from services.service import PublishSubscribe, Service
+from utils import metrics, tracing
+
+
+TURN_LATENCY = metrics.histogram("ds_turn_latency_seconds", "Time from receiving a user utterance on the websocket until the answer was written")
+
+
+class GUIServer(Service):
+    """
+    Forwards user utterances, moodle events and settings from the frontend to the dialog system
+    and delivers system utterances / control events to the user's websocket (via the user's WebsocketOutbox).
+
+    `schedule` hands websocket writes over to the IO loop of the websockets (thread-safe),
+    e.g. `asyncio_loop.call_soon_threadsafe` (see WebsocketOutbox).
+    """
+    NOT_FIRST_TURN = "NOT_FIRST_TURN"
+    OUTBOX = "OUTBOX"
+
+    def __init__(self, domains, schedule: Callable[..., Any]):
+        super().__init__(domain="")
+        self.websockets = {}
+        self.domains = domains
+        self._schedule = schedule
+        self._outbox_lock = threading.Lock()
+        self._turn_started = {}  # user id -> time.perf_counter() of the oldest unanswered user utterance
+
+    def get_outbox(self, user_id: int) -> WebsocketOutbox:
+        """ Returns the outbound message queue for the given user (creates it, if it doesn't exist yet) """
+        with self._outbox_lock:
+            outbox = self.get_state(user_id, GUIServer.OUTBOX)
+            if outbox is None:
+                outbox = WebsocketOutbox(schedule=self._schedule,
+                                         max_buffered=config.WS_OUTBOX_MAX_BUFFERED,
+                                         drop_policy=config.WS_OUTBOX_DROP_POLICY,
+                                         on_turn_delivered=TURN_LATENCY.observe)
+                if user_id in self.websockets:
+                    outbox.attach(self.websockets[user_id])
+                self.set_state(user_id, GUIServer.OUTBOX, outbox)
+            return outbox
+
+    def attach_websocket(self, user_id: int, websocket):
+        """ Makes the given websocket the active connection of the user and delivers all buffered messages """
+        self.websockets[user_id] = websocket
+        self.get_outbox(user_id).attach(websocket)
+
+    def detach_websocket(self, user_id: int, websocket):
+        """ Removes the given websocket, if it is the active connection of the user. Messages will be buffered until the next connection. """
+        if self.websockets.get(user_id) is websocket:
+            del self.websockets[user_id]
+            self.get_outbox(user_id).detach(websocket)
+
+    def has_session(self, user_id: int) -> bool:
+        """ Returns True if a dialog was started for the user and the chat history wasn't cleared since (e.g. by a new login) """
+        return bool(self.get_state(user_id, GUIServer.NOT_FIRST_TURN))
+
+    @PublishSubscribe(sub_topics=['socket_opened'], pub_topics=['user_utterance', 'sys_state'])
+    def on_socket_opened(self, user_id: str, socket_opened: bool = True):
+        """ If page (re-)load/transition is registered (websocket (re-)connected),
+            we check if the current session state contains chat history for the given user already.
+            If not, we start a new dialog by publishing an empty user_utterance and sys_state message to the backend.
+            Messages missed during the page transition are delivered by the user's outbox as soon as the websocket is attached.
+        """
+        try:
+            if not socket_opened:
+                return
+
+            not_first_turn = self.get_state(user_id, GUIServer.NOT_FIRST_TURN)
+            if not not_first_turn:
+                # chat history not found, start new dialog in backend
+                self.set_state(user_id, GUIServer.NOT_FIRST_TURN, True)
+                return {f'user_utterance/{self.domains[0]}': '', f'sys_state/{self.domains[0]}': {}}
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    def user_utterance(self, user_id, domain_idx = 0, courseid=0, message = ""):
+        """ Starts a new turn: the turn is traced (if sampled, see utils.tracing) through all services """
+        self._turn_started.setdefault(user_id, time.perf_counter())
+        with tracing.trace("turn", user_id=user_id):
+            return self._publish_user_utterance(user_id=user_id, domain_idx=domain_idx, courseid=courseid, message=message)
+
+    @PublishSubscribe(pub_topics=['user_utterance', 'courseid'])
+    def _publish_user_utterance(self, user_id, domain_idx = 0, courseid=0, message = ""):
+        try:
+            # forward message from moodle frontend to dialog system backend
+            return {f'user_utterance/{self.domains[domain_idx]}': message,
+                    f'courseid/{self.domains[domain_idx]}': courseid}
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+        
+    @PublishSubscribe(pub_topics=['moodle_event'])
+    def moodle_event(self, user_id, domain_idx=0, event_data: dict = None):
+        try:
+            if 'eventname' in event_data and event_data['eventname'].lower().strip() == "\\core\\event\\user_loggedin":
+                # clear chat history when user logs back in
+                self.clear_memory(user_id)
+            return {f'moodle_event/{self.domains[domain_idx]}': event_data}
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+    
+    @PublishSubscribe(pub_topics=['settings'])
+    def settings_changed(self, user_id, domain_idx=0, settings: dict = None):
+        return {f'settings/{self.domains[domain_idx]}': settings} 
+
+    @PublishSubscribe(sub_topics=['control_event'])
+    def forward_control_event_to_websocket(self, user_id, control_event: str = None):
+        try:
+            user_id = int(user_id)
+            # forward message to moodle frontend (control events are only relevant for the current page, so don't buffer them)
+            self.get_outbox(user_id).send([{"content": control_event, "format": "text", "party": "control"}], buffer_offline=False)
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    @PublishSubscribe(sub_topics=['sys_utterance'])
+    def forward_message_to_websocket(self, user_id, sys_utterance: List[str] = None):
+        try:
+            user_id = int(user_id)
+            # forward all messages of this turn to moodle frontend in one frame
+            # (stored by the outbox during page transition where socket is closed)
+            self.get_outbox(user_id).send([{"content": message, "format": "text", "party": "system"} for message in sys_utterance],
+                                          turn_started=self._turn_started.pop(user_id, None))
+        except:
+            # Log error
+            logging.getLogger("error_log").error(traceback.format_exc())
+
+    def outbox_stats(self) -> dict:
+        """ Returns delivery latency and buffer occupancy, aggregated over the outboxes of all resident users """
+        stats = [outbox.stats() for outbox in self._memory.get_values(GUIServer.OUTBOX)]
+        delivered = sum(stat['delivered'] for stat in stats)
+        return {
+            "users": len(stats),
+            "delivered": delivered,
+            "frames": sum(stat['frames'] for stat in stats),
+            "dropped": sum(stat['dropped'] for stat in stats),
+            "buffered": sum(stat['buffered'] for stat in stats),
+            "max_buffered": max([stat['max_buffered'] for stat in stats], default=0),
+            "avg_latency": sum(stat['avg_latency'] * stat['delivered'] for stat in stats) / delivered if delivered > 0 else 0.0,
+            "max_latency": max([stat['max_latency'] for stat in stats], default=0.0)
+        }
@@ -0,0 +1,141 @@
+"""Per-user outbound message queue for the websocket connection to the moodle frontend."""
+from collections import deque
+import json
+import logging
+from threading import Lock
+import time
+import traceback
+from typing import Any, Callable, Dict, List
+
+
+DROP_OLDEST = "drop_oldest"  # buffer full: discard the oldest buffered message to make room for the new one
+DROP_NEWEST = "drop_newest"  # buffer full: discard the new message, keep the buffered ones
+
+
+class WebsocketOutbox:
+    """
+    Delivers all messages for one user over the currently attached websocket.
+
+    * All messages handed to `send` in one call (e.g. all system utterances of a turn) are delivered
+      as one websocket frame.
+    * While no websocket is attached (e.g. during a page transition), messages are kept in a bounded
+      ring buffer. If the buffer is full, messages are discarded according to the drop policy.
+    * Attaching a websocket flushes the buffer with a single write.
+
+    Writing is done on the websocket's IO loop: `schedule` has to hand a callable (and its arguments)
+    over to that loop in a thread-safe way, e.g. `asyncio_loop.call_soon_threadsafe`.
+
+    If `on_turn_delivered` is given, it is called on the IO loop with the turn latency (seconds, from the `turn_started`
+    time passed to `send` until the frame was written), e.g. to record a histogram.
+    """
+
+    def __init__(self, schedule: Callable[..., Any], max_buffered: int = 50, drop_policy: str = DROP_OLDEST,
+                 on_turn_delivered: Callable[[float], Any] = None):
+        assert drop_policy in (DROP_OLDEST, DROP_NEWEST), f"unknown drop policy {drop_policy}"
+        self._schedule = schedule
+        self._on_turn_delivered = on_turn_delivered
+        self._lock = Lock()
+        self._websocket = None
+        self._buffer = deque()  # entries: (enqueue time, message)
+        self.max_buffered = max_buffered
+        self.drop_policy = drop_policy
+
+        # statistics
+        self.delivered = 0          # number of delivered messages
+        self.frames = 0             # number of websocket frames written
+        self.dropped = 0            # number of messages discarded because the buffer was full
+        self.max_occupancy = 0      # highest number of buffered messages so far
+        self.total_latency = 0.0    # sum of delivery latencies (enqueue -> write) in seconds
+        self.max_latency = 0.0      # highest delivery latency in seconds
+
+    def attach(self, websocket):
+        """ Makes `websocket` the delivery target and flushes all buffered messages in one write. """
+        with self._lock:
+            self._websocket = websocket
+            if len(self._buffer) == 0:
+                return
+            buffered = list(self._buffer)
+            self._buffer.clear()
+        self._schedule(self._write, websocket, buffered, True, None)
+
+    def detach(self, websocket=None):
+        """ Stops delivering to the attached websocket (only if it is `websocket`, if given) and starts buffering. """
+        with self._lock:
+            if websocket is None or self._websocket is websocket:
+                self._websocket = None
+
+    def send(self, messages: List[dict], buffer_offline: bool = True, turn_started: float = None):
+        """
+        Delivers `messages` as one websocket frame.
+
+        Args:
+            messages (List[dict]): messages in the frontend format, e.g. {"content": ..., "format": "text", "party": "system"}
+            buffer_offline (bool): if True, messages are buffered while no websocket is attached, otherwise they are discarded
+            turn_started (float): time.perf_counter() when the user input of this turn was received (for `on_turn_delivered`)
+        """
+        if len(messages) == 0:
+            return
+        now = time.perf_counter()
+        entries = [(now, message) for message in messages]
+        with self._lock:
+            websocket = self._websocket
+            if websocket is None:
+                if buffer_offline:
+                    self._buffer_entries(entries)
+                return
+        self._schedule(self._write, websocket, entries, buffer_offline, turn_started)
+
+    def _buffer_entries(self, entries: list):
+        """ Appends entries to the ring buffer, applying the drop policy. Expects the lock to be held. """
+        for entry in entries:
+            if len(self._buffer) >= self.max_buffered:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    continue
+                self._buffer.popleft()
+            self._buffer.append(entry)
+        self.max_occupancy = max(self.max_occupancy, len(self._buffer))
+
+    def _write(self, websocket, entries: list, buffer_offline: bool, turn_started: float):
+        """ Writes entries as one frame. Runs on the websocket's IO loop. """
+        try:
+            websocket.write_message(json.dumps([message for _, message in entries]))
+        except:
+            # websocket was closed in the meantime - keep messages for the next connection
+            with self._lock:
+                if self._websocket is websocket:
+                    self._websocket = None
+                if buffer_offline:
+                    # put messages back in front of messages buffered in the meantime
+                    pending = list(self._buffer)
+                    self._buffer.clear()
+                    self._buffer_entries(entries + pending)
+            logging.getLogger("error_log").error(traceback.format_exc())
+            return
+        now = time.perf_counter()
+        with self._lock:
+            self.frames += 1
+            self.delivered += len(entries)
+            for enqueued, _ in entries:
+                latency = now - enqueued
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+        if turn_started is not None and self._on_turn_delivered is not None:
+            self._on_turn_delivered(now - turn_started)
+
+    def occupancy(self) -> int:
+        """ Returns the number of currently buffered messages """
+        return len(self._buffer)
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns delivery latency and buffer occupancy statistics """
+        with self._lock:
+            return {
+                "delivered": self.delivered,
+                "frames": self.frames,
+                "dropped": self.dropped,
+                "buffered": len(self._buffer),
+                "max_buffered": self.max_occupancy,
+                "avg_latency": self.total_latency / self.delivered if self.delivered > 0 else 0.0,
+                "max_latency": self.max_latency
+            }
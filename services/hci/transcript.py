@@ -0,0 +1,183 @@
+"""
+Headless replay of scripted conversations (transcripts) for turn regression tests and timing.
+
+Builds the ELearning services with a GUIServer (without tornado) and feeds the turns of a transcript through
+`GUIServer.user_utterance` / `GUIServer.moodle_event`. The system messages are captured from the user's outbox
+(by a stand-in for the websocket) and compared with the expected outputs, the turn latency and the time spent in each
+PublishSubscribe function (per stage, from the `ds_callback_duration_seconds` histogram) are checked against budgets.
+
+Transcript format (JSON):
+    {
+        "name": "search",
+        "courseid": 2,
+        "budget_ms": 2000,                                      # optional: latency budget of every turn
+        "stage_budgets_ms": {"ELearningNLU.extract_user_acts": 100},  # optional: time budget of functions per turn
+        "turns": [
+            {"start": true},                                    # start dialog (like start_dialog on the websocket)
+            {"user": "Wo finde ich Infos zu Regression?",       # user utterance
+             "expect": ["..."],                                 # optional: exact system messages of the turn
+             "expect_contains": ["..."],                        # optional: substrings that have to occur in the answer
+             "budget_ms": 500},                                 # optional: latency budget of this turn
+            {"event": {"eventname": "\\\\core\\\\event\\\\course_module_completion_updated", "contextinstanceid": 5},
+             "reply": false}                                    # moodle event (reply: false - don't wait for an answer)
+        ]
+    }
+
+Usage: see benchmarks/replay_transcripts.py
+"""
+import json
+import queue
+import time
+from typing import Dict, List, Tuple
+
+from services.hci.gui import GUIServer
+from services.service import DialogSystem, _CALLBACK_DURATION
+
+
+class _CapturingWebsocket:
+    """ Stands in for the websocket of a user: collects the frames written by the outbox """
+
+    def __init__(self):
+        self.frames = queue.Queue()
+
+    def write_message(self, message: str):
+        self.frames.put((time.perf_counter(), json.loads(message)))
+
+
+class TurnResult:
+    def __init__(self, index: int, kind: str, text: str):
+        self.index = index
+        self.kind = kind            # start, user or event
+        self.text = text            # user utterance / event name
+        self.messages = []          # system messages of the turn
+        self.control = []           # control events of the turn
+        self.latency = None         # seconds until the first system message (None: no answer)
+        self.stages = {}            # function -> seconds spent during the turn
+        self.failures = []          # failed checks
+
+    def to_dict(self) -> dict:
+        return {"turn": self.index, "kind": self.kind, "text": self.text, "messages": self.messages, "control": self.control,
+                "latency_ms": self.latency * 1000.0 if self.latency is not None else None,
+                "stages_ms": {name: seconds * 1000.0 for name, seconds in self.stages.items()}, "failures": self.failures}
+
+
+class TranscriptRunner:
+    """
+    Replays transcripts through a dialog system with a GUIServer.
+
+    Args:
+        domain (str): domain name of the services
+        services (list): dialog system services (e.g. from `elearning.load_elearning_domain`)
+        wstoken (str): moodle webservice token of the simulated users
+        turn_timeout (float): max. seconds to wait for the answer of a turn
+        settle (float): seconds to wait for further messages after the first answer of a turn (or after turns without answer)
+    """
+
+    def __init__(self, domain: str, services: list, wstoken: str = "transcript", turn_timeout: float = 30.0, settle: float = 0.3):
+        self.domain = domain
+        self.services = services
+        self.wstoken = wstoken
+        self.turn_timeout = turn_timeout
+        self.settle = settle
+        self.gui = GUIServer([domain], schedule=lambda func, *args: func(*args))  # no IO loop: write on the publishing thread
+        self.ds = DialogSystem(services=[self.gui] + services)
+
+    def _stage_totals(self) -> Dict[str, float]:
+        return {labelvalues[0]: total for labelvalues, (total, _) in _CALLBACK_DURATION.totals().items()}
+
+    def _start(self, user_id: int, courseid: int):
+        from elearning import configure_moodle_session
+        configure_moodle_session(self.services, user_id, self.wstoken, user_id, int(time.time()), 0)
+        self.ds._start_dialog(start_signals={f'socket_opened/{self.domain}': True, f'courseid/{self.domain}': courseid}, user_id=user_id)
+
+    def _collect(self, websocket: _CapturingWebsocket, result: TurnResult, sent: float, wait_for_answer: bool):
+        deadline = sent + (self.turn_timeout if wait_for_answer else self.settle)
+        while True:
+            try:
+                received, frame = websocket.frames.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                return
+            for message in frame:
+                if message.get("party") == "control":
+                    result.control.append(message["content"])
+                else:
+                    result.messages.append(message["content"])
+                    if result.latency is None:
+                        result.latency = received - sent
+                        # answer received: only wait a short time for further messages of this turn
+                        deadline = time.perf_counter() + self.settle
+
+    def run(self, transcript: dict, user_id: int) -> List[TurnResult]:
+        """ Replays one transcript as user `user_id` (use a new user id for every run). Returns the results of all turns. """
+        courseid = transcript.get("courseid", 2)
+        websocket = _CapturingWebsocket()
+        self.gui.attach_websocket(user_id, websocket)
+        results = []
+        for index, turn in enumerate(transcript["turns"]):
+            if "start" in turn:
+                result = TurnResult(index, "start", "")
+            elif "event" in turn:
+                result = TurnResult(index, "event", turn["event"].get("eventname", ""))
+            else:
+                result = TurnResult(index, "user", turn["user"])
+            stages_before = self._stage_totals()
+            sent = time.perf_counter()
+            if result.kind == "start":
+                self._start(user_id, courseid)
+            elif result.kind == "event":
+                self.gui.moodle_event(user_id=user_id, event_data={"userid": user_id, "courseid": courseid, **turn["event"]})
+            else:
+                self.gui.user_utterance(user_id=user_id, courseid=courseid, message=turn["user"])
+            self._collect(websocket, result, sent, wait_for_answer=turn.get("reply", True))
+            stages_after = self._stage_totals()
+            result.stages = {name: total - stages_before.get(name, 0.0) for name, total in stages_after.items()
+                             if total - stages_before.get(name, 0.0) > 0.0}
+            result.failures = self.check(transcript, turn, result)
+            results.append(result)
+        self.gui.detach_websocket(user_id, websocket)
+        self.ds.end_dialogs([user_id])
+        return results
+
+    @staticmethod
+    def check(transcript: dict, turn: dict, result: TurnResult) -> List[str]:
+        """ Compares the result of a turn with the expected outputs and budgets of the transcript """
+        failures = []
+        if turn.get("reply", True) and result.latency is None:
+            failures.append("no answer")
+        if "expect" in turn and result.messages != turn["expect"]:
+            failures.append(f"output differs: expected {turn['expect']}, got {result.messages}")
+        for substring in turn.get("expect_contains", []):
+            if not any(substring in message for message in result.messages):
+                failures.append(f"output does not contain '{substring}'")
+        budget = turn.get("budget_ms", transcript.get("budget_ms"))
+        if budget is not None and result.latency is not None and result.latency * 1000.0 > budget:
+            failures.append(f"latency {result.latency * 1000.0:.0f} ms > budget {budget} ms")
+        for stage, stage_budget in transcript.get("stage_budgets_ms", {}).items():
+            if result.stages.get(stage, 0.0) * 1000.0 > stage_budget:
+                failures.append(f"{stage} {result.stages[stage] * 1000.0:.0f} ms > budget {stage_budget} ms")
+        return failures
+
+
+def record_expectations(transcript: dict, results: List[TurnResult]) -> dict:
+    """ Returns a copy of the transcript with the captured outputs as expected outputs (baseline for later runs) """
+    recorded = dict(transcript, turns=[])
+    for turn, result in zip(transcript["turns"], results):
+        turn = dict(turn)
+        if turn.get("reply", True):
+            turn["expect"] = result.messages
+        recorded["turns"].append(turn)
+    return recorded
+
+
+def summarize(results: List[TurnResult]) -> Tuple[dict, Dict[str, float]]:
+    """ Returns latency statistics of the answered turns and the mean time per turn of every stage """
+    latencies = sorted(result.latency for result in results if result.latency is not None)
+    stages = {}
+    for result in results:
+        for name, seconds in result.stages.items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    stats = {"turns": len(results), "answered": len(latencies),
+             "p50_ms": latencies[len(latencies) // 2] * 1000.0 if latencies else None,
+             "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000.0 if latencies else None,
+             "max_ms": latencies[-1] * 1000.0 if latencies else None}
+    return stats, {name: seconds * 1000.0 / max(1, len(results)) for name, seconds in sorted(stages.items(), key=lambda item: -item[1])}
@@ -18,7 +18,6 @@
 ###############################################################################
 
 import re
-import time
 from typing import List
 from utils.utterance_mapper import Utterance_Mapper
 from services.service import PublishSubscribe
@@ -96,8 +95,6 @@ class ELearningNLU(Service):
 
     @PublishSubscribe(sub_topics=["user_utterance"], pub_topics=["user_acts"])
     def extract_user_acts(self, user_id: str, user_utterance: str = None) -> dict(user_acts=List[UserAct]):
-        print("extract_user_acts")
-
         """
         Responsible for detecting user acts with their respective slot-values from the user
         utterance through regular expressions.
@@ -110,7 +107,6 @@ class ELearningNLU(Service):
             dict of str: UserAct - a dictionary with the key "user_acts" and the value
                                             containing a list of user actions
         """
-        start = time.time()
         result = {}
         #print(self.uttance_mapper.get_labels())
         if user_utterance is not None and len(user_utterance) > 0:
@@ -153,8 +149,6 @@ class ELearningNLU(Service):
                                 user_act.value = matches.get(key)
         
             result["user_acts"] = [user_act]
-            end = time.time()
-            print("extract_user_acts took: ", end-start)
         else:
             result = {"user_acts": []}
         return result
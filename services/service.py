@@ -1,4 +1,6 @@
 import copy
+import functools
+from collections import OrderedDict
 import inspect
 import logging
 import pickle
@@ -7,18 +9,21 @@ import time
 import json
 from threading import Thread, RLock
 import traceback
-from typing import List, Dict, Union, Iterable, Any
+from typing import List, Dict, Tuple, Union, Iterable, Any
 from datetime import datetime, timedelta
 import importlib
-from config import DS_SERVER_IP_ADDR
+from config import DS_SERVER_IP_ADDR, DS_BUS_SUB_PORT, DS_BUS_PUB_PORT, DS_BUS_REG_PORT, DS_BUS_CTRL_PORT, DS_BUS_TOPOLOGY, \
+    DS_BUS_OVERFLOW_ERROR_TOPIC, DS_JOIN_TIMEOUT, DS_JOIN_STALE_POLICY, DS_JOIN_MAX_PARTIALS
 
 import zmq
 from zmq import Context
-from zmq.devices import ThreadProxy, ProcessProxy
 
+from services.bus import BusTopology, BoundedPublisher, PublishOverflowError, BROKERLESS, BLOCK, REJECT, high_water_mark, overflow_policy
 from utils.domain.domain import Domain
+from utils.sysact import SysAct, SysActionType
 from utils.topics import Topic
 from utils.transmittable import Transmittable
+from utils import metrics, profiling, tracing
 
 def _deserialize_content(content: dict) -> Any:
     """
@@ -27,6 +32,7 @@ def _deserialize_content(content: dict) -> Any:
         type: str,
         content: Union[dict, primitive type]
     }
+    NOTE: dictionaries and lists are updated in place (content is freshly decoded from a received message)
     """
     if isinstance(content, dict):
         if len(content.keys()) == 2 and '_type' in content and 'value' in content:
@@ -36,22 +42,39 @@ def _deserialize_content(content: dict) -> Any:
             prototype_class = getattr(mod, class_name)
             return prototype_class.deserialize(obj=content['value'])
         else:
-            return {
-                key: _deserialize_content(content[key]) for key in content
-            }
+            for key, value in content.items():
+                if isinstance(value, (dict, list)):
+                    content[key] = _deserialize_content(value)
+            return content
     elif isinstance(content, list):
-        return [_deserialize_content(item) for item in content]
+        for idx, item in enumerate(content):
+            if isinstance(item, (dict, list)):
+                content[idx] = _deserialize_content(item)
+        return content
     else:
         return content
 
 
 def _serialize_content(content: Any) -> dict:
+    """ Converts all Transmittable objects in content. Containers without Transmittables are returned as they are (not copied). """
     if isinstance(content, dict):
-        return {
-            key: _serialize_content(content[key]) for key in content
-        }
+        serialized = None
+        for key, value in content.items():
+            item = _serialize_content(value)
+            if item is not value:
+                if serialized is None:
+                    serialized = dict(content)
+                serialized[key] = item
+        return content if serialized is None else serialized
     elif isinstance(content, list):
-        return [_serialize_content(item) for item in content]
+        serialized = None
+        for idx, value in enumerate(content):
+            item = _serialize_content(value)
+            if item is not value:
+                if serialized is None:
+                    serialized = list(content)
+                serialized[idx] = item
+        return content if serialized is None else serialized
     elif isinstance(content, Transmittable):
         return {
             '_type': inspect.getmodule(content).__name__ + '.' + content.__class__.__name__,
@@ -60,29 +83,65 @@ def _serialize_content(content: Any) -> dict:
     else:
         return content
 
-def _send_msg(pub_channel, topic, content, user_id="default"):
-    """ Serializes message, appends current timespamp and sends it over the specified channel to the specified topic. """
+def _send_msg(pub_channel, topic: Union[str, bytes], content, user_id="default"):
+    """ Serializes message, appends current timespamp (and the active trace context, see utils.tracing)
+        and sends it over the specified channel to the specified topic.
+        The topic may be passed pre-encoded (ascii bytes) to avoid encoding it for every message. """
     timestamp = datetime.now().timestamp()  # current timestamp as POSIX float
-    data = json.dumps({
+    envelope = {
         'timestamp': timestamp,
         'content': content,
         'user_id': user_id
-    })
-    pub_channel.send_multipart((bytes(topic, encoding="ascii"), bytes(data, encoding='ascii')))
+    }
+    trace_context = tracing.current()
+    if trace_context is not None:
+        envelope['trace'] = trace_context
+    data = json.dumps(envelope)
+    if isinstance(topic, str):
+        topic = bytes(topic, encoding="ascii")
+    # NOTE: pyzmq still copies bodies below its copy threshold (which is cheaper for small messages)
+    pub_channel.send_multipart((topic, bytes(data, encoding='ascii')), copy=False)
+
+
+def _recv_msg(sub_channel) -> Tuple[bytes, dict]:
+    """
+    Receives a message sent by `_send_msg`.
+    The topic is copied (it is short and used for routing), the body is received without copying and decoded
+    straight from the frame buffer.
+
+    Returns:
+        topic (bytes), data (dict with keys 'timestamp', 'content', 'user_id' and optionally 'trace')
+    """
+    topic = sub_channel.recv(copy=True)
+    body = sub_channel.recv(copy=False)
+    return topic, json.loads(str(body.buffer, "ascii"))
+
+
+async def _recv_msg_async(sub_channel) -> Tuple[bytes, dict]:
+    """ Same as `_recv_msg` for zmq.asyncio sockets """
+    topic = await sub_channel.recv(copy=True)
+    body = await sub_channel.recv(copy=False)
+    return topic, json.loads(str(body.buffer, "ascii"))
 
 
 def _send_ack(pub_channel, topic, content=True, user_id="default"):
     """ Sends an acknowledge-message to the specified channel (ACK). """
-    _send_msg(pub_channel, f"ACK/{topic}", content, user_id)
+    if isinstance(topic, bytes):
+        _send_msg(pub_channel, b"ACK/" + topic, content, user_id)
+    else:
+        _send_msg(pub_channel, f"ACK/{topic}", content, user_id)
+
+
+def _control_reply_payload(failed: Dict[Any, str]) -> bytes:
+    """ Encodes the failed users of a control command (JSON object keys are strings, so send a list of pairs) """
+    return bytes(json.dumps(list(failed.items())), encoding="ascii")
 
 
 def _recv_ack(sub_channel, topic, expected_content=True, expected_user="default"):
     """ Blocks until an acknowledge-message for the specified topic with the expected content is received via the specified subscriber channel. """
-    ack_topic = topic if topic.startswith("ACK/") else f"ACK/{topic}"
+    ack_topic = bytes(topic if topic.startswith("ACK/") else f"ACK/{topic}", encoding="ascii")
     while True:
-        msg = sub_channel.recv_multipart(copy=True)
-        recv_topic = msg[0].decode("ascii")
-        data = json.loads(msg[1])  # pickle.loads(msg) -> tuple(timestamp, content, user_id)
+        recv_topic, data = _recv_msg(sub_channel)
         content = data['content']
         user_id = data['user_id']
         if recv_topic == ack_topic:
@@ -90,6 +149,32 @@ def _recv_ack(sub_channel, topic, expected_content=True, expected_user="default"
                 return
 
 
+# routing table entries for received topics: (route kind, function argument name)
+_ROUTE_TERMINATE = 2    # control message: shut down listener
+_ROUTE_LATEST = 3       # subscribed topic: keep only the latest value
+_ROUTE_QUEUED = 4       # queued subscribed topic: keep all values
+
+# control plane (DialogSystem ROUTER <-> Service DEALER) messages:
+#   request:  [correlation id, command, json payload]
+#   reply:    [correlation id, status, json payload]
+# services send [b"", CTRL_READY, b"null"] once after connecting
+CTRL_READY = b"READY"
+CTRL_START = b"START"           # payload: list of user ids
+CTRL_END = b"END"               # payload: list of user ids
+CTRL_TERMINATE = b"TERMINATE"   # payload: user id
+CTRL_TRAIN = b"TRAIN"
+CTRL_EVAL = b"EVAL"
+CTRL_OK = b"OK"                 # reply payload: {user id: error message} for users where the command failed
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_topic_key(key: str) -> Tuple[str, str]:
+    """ Splits a key returned by a publishing function into topic and domain, e.g. 'user_utterance/ELearning' -> ('user_utterance', 'ELearning') """
+    # fix! (user could have multiple "/" characters in topic - only use last one )
+    parts = key.split("/")
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
 class RemoteService:
     def __init__(self, identifier: str):
         self.identifier = identifier
@@ -103,9 +188,11 @@ class Service:
     for this purpose.
     """
 
+    _async_handlers = False  # True, if functions decorated with PublishSubscribe may be coroutines (async def)
+
     def __init__(self, domain: Union[str, Domain] = "", sub_topic_domains: Dict[str, str] = {}, pub_topic_domains: Dict[str, str] = {},
-                 ds_host_addr: str = DS_SERVER_IP_ADDR, sub_port: int = 65533, pub_port: int = 65534, protocol: str = "tcp",
-                 debug_logger: str = None, identifier: str = None):
+                 ds_host_addr: str = DS_SERVER_IP_ADDR, sub_port: int = DS_BUS_SUB_PORT, pub_port: int = DS_BUS_PUB_PORT, protocol: str = "tcp",
+                 debug_logger: str = None, identifier: str = None, ctrl_port: int = DS_BUS_CTRL_PORT):
 
         self.is_training = False
         self.domain = domain
@@ -121,6 +208,7 @@ class Service:
         self._host_addr = ds_host_addr
         self._sub_port = sub_port
         self._pub_port = pub_port
+        self._ctrl_port = ctrl_port
         self._protocol = protocol
         self._identifier = identifier
 
@@ -128,10 +216,14 @@ class Service:
 
         self._sub_topics = set()
         self._pub_topics = set()
-        self._publish_sockets = dict()
-
-        self._internal_start_topics = dict()
-        self._internal_end_topics = dict()
+        self._publish_sockets = dict()    # function -> services.bus.BoundedPublisher
+        self._overflow_error_pub = None  # publisher for error acts (only if a published topic has overflow policy REJECT or BLOCK)
+        self._pub_topic_bytes = dict()  # (topic, domain) -> encoded topic string for publishing
+
+        self._bus = None            # services.bus.BusTopology (set by the dialog system, or created from the config in _init_pubsub)
+        self._listener_names = []   # names of all functions with a listener (subscribing to at least one topic)
+        self._join_buffers = {}     # function name -> _JoinBuffer (partially received inputs per user)
+        self._listener_threads = []
         self._internal_terminate_topics = dict()
 
         # NOTE: class name + memory pointer make topic unique (required, e.g. for running mutliple instances of same module!)
@@ -152,22 +244,63 @@ class Service:
 
     def clear_memory(self, user_id: str):
         self._memory.delete_values(user_id)
+        for join_buffer in self._join_buffers.values():
+            join_buffer.discard(user_id)
+
+    def join_stats(self) -> Dict[str, Dict[str, int]]:
+        """ Returns the join counters (completed, expired, evicted, partials) of each function subscribing to topics """
+        return {func_name: join_buffer.stats() for func_name, join_buffer in self._join_buffers.items()}
+
+    def num_resident_users(self) -> int:
+        """ Returns the number of users that currently have state stored in this service's memory """
+        return self._memory.num_users()
 
     def _init_pubsub(self): 
+        """ Creates all bus sockets of this service (listeners are started by `_register_with_dialogsystem`) """
+        if self._bus is None:
+            self._bus = BusTopology(kind=DS_BUS_TOPOLOGY, protocol=self._protocol, host=self._host_addr,
+                                    sub_port=self._sub_port, pub_port=self._pub_port)
+        # setup sender for listener shutdown messages
+        self._control_channel_pub = self._bus.publisher(Context.instance(), control=True, owner=self._start_topic)
         # search for all functions decorated with PublishSubscribe decorator 
         for func_name in dir(self):
             func_inst = getattr(self, func_name)
             if hasattr(func_inst, "pubsub"):
+                assert self._async_handlers or not inspect.iscoroutinefunction(func_inst), \
+                    f"{type(self).__name__}.{func_name}: async def functions require services.async_service.AsyncService"
                 # found decorated publisher / subscriber function -> setup sockets and listeners
+                profiling.register(f"{type(self).__name__}.{func_name}")
                 self._setup_listener(func_inst, getattr(func_inst, "sub_topics"),
                                      getattr(func_inst, 'queued_sub_topics'))
                 self._setup_publishers(func_inst, getattr(func_inst, "pub_topics"))
+        if any(overflow_policy(topic) in (REJECT, BLOCK) for topic in self._pub_topics):
+            self._overflow_error_pub = BoundedPublisher(
+                self._bus.publisher(Context.instance(), topics=[DS_BUS_OVERFLOW_ERROR_TOPIC], owner=self._start_topic), BLOCK)
+        self._setup_dialog_ctrl_msg_listener()
 
     def _register_with_dialogsystem(self):
+        """ Starts all listeners and the control channel listener (bus sockets have to be connected, see services.bus) """
+        for listener_thread in self._listener_threads:
+            listener_thread.start()
         # start listening to dialog system control channel messages
-        self._setup_dialog_ctrl_msg_listener()
         Thread(target=self._control_channel_listener).start()
 
+    def _start_listeners(self, user_id):
+        """ Resets the collected values of all listeners for the given user and lets them process messages """
+        for func_name in self._listener_names:
+            self._join_buffers[func_name].discard(user_id)
+            self.set_state(user_id, f"_{func_name}_active", True)
+
+    def is_listening(self, user_id) -> bool:
+        """ Returns True if all listeners process messages for the given user (dialog started, state not cleared since) """
+        return all(self.get_state(user_id, f"_{func_name}_active") for func_name in self._listener_names)
+
+    def _stop_listeners(self, user_id):
+        """ Lets all listeners ignore messages for the given user """
+        for func_name in self._listener_names:
+            self.set_state(user_id, f"_{func_name}_active", False)
+            self._join_buffers[func_name].discard(user_id)
+
     def _setup_listener(self, func_instance, topics: List[str], queued_topics: List[str]):
         """
         Starts a new subscription thread for a function decorated with services.service.PublishSubscribe.
@@ -184,132 +317,198 @@ class Service:
             # ensure that sub_topics and queued_sub_topics don't intersect (otherwise, both would set same function argument value)
         assert set(topics).isdisjoint(queued_topics), "sub_topics and queued_sub_topics have to be disjoint!"
 
-        # setup socket
+        # setup sockets: subscribe to all listed topics and
+        # to the shutdown channel (dialog start / end are handled by the control plane, see `_start_listeners`)
         ctx = Context.instance()
-        subscriber = ctx.socket(zmq.SUB)
-        # subscribe to all listed topics
-        for topic in topics + queued_topics:
-            topic_domain_str = f"{topic}/{self._domain_name}" if self._domain_name else topic
-            if topic in self._sub_topic_domains:
-                # overwrite domain for this specific topic and service instance
-                topic_domain_str = f"{topic}/{self._sub_topic_domains[topic]}" if self._sub_topic_domains[topic] else topic
-            subscriber.setsockopt(zmq.SUBSCRIBE, bytes(topic_domain_str, encoding="ascii"))
-        # subscribe to control channels
-        subscriber.setsockopt(zmq.SUBSCRIBE, bytes(f"{func_instance}/START", encoding="ascii"))
-        subscriber.setsockopt(zmq.SUBSCRIBE, bytes(f"{func_instance}/END", encoding="ascii"))
-        subscriber.setsockopt(zmq.SUBSCRIBE, bytes(f"{func_instance}/TERMINATE", encoding="ascii"))
-        subscriber.connect(f"{self._protocol}://{self._host_addr}:{self._sub_port}")
-        self._internal_start_topics[f"{str(func_instance)}/START"] = str(func_instance)
-        self._internal_end_topics[f"{str(func_instance)}/END"] = str(func_instance)
+        subscriber = self._bus.subscriber(ctx, subscriptions=[self._get_sub_topic_str(topic) for topic in topics + queued_topics],
+                                          control_subscriptions=[f"{func_instance}/TERMINATE"], owner=self._start_topic)
+        control_channel_pub = self._bus.publisher(ctx, control=True, owner=self._start_topic)
+        self._listener_names.append(func_instance.func_name)
+        self._join_buffers[func_instance.func_name] = _JoinBuffer(len(topics) + len(queued_topics))
         self._internal_terminate_topics[f"{str(func_instance)}/TERMINATE"] = str(func_instance)
 
-        # register and run listener thread
-        listener_thread = Thread(target=self._receiver_thread, args=(subscriber, func_instance,
+        # register listener thread (started by _register_with_dialogsystem)
+        listener_thread = Thread(target=self._receiver_thread, args=(subscriber, control_channel_pub, func_instance,
                                                                      topics, queued_topics,
-                                                                     f"{str(func_instance)}/START",
-                                                                     f"{str(func_instance)}/END",
                                                                      f"{str(func_instance)}/TERMINATE"))
-        listener_thread.start()
+        self._listener_threads.append(listener_thread)
 
         # add to list of local topics
         # TODO maybe add topic_domain_str instead for more clarity?
         self._sub_topics.update(topics + queued_topics)
 
+    def _get_sub_topic_str(self, topic: str) -> str:
+        """ Returns the subscription string (topic + domain) for a subscribed topic """
+        topic_domain_str = f"{topic}/{self._domain_name}" if self._domain_name else topic
+        if topic in self._sub_topic_domains:
+            # overwrite domain for this specific topic and service instance
+            topic_domain_str = f"{topic}/{self._sub_topic_domains[topic]}" if self._sub_topic_domains[topic] else topic
+        return topic_domain_str
+
+    def _make_routing_table(self, topics: List[str], queued_topics: List[str], terminate_topic: str) -> Dict[bytes, Tuple[int, str]]:
+        """
+        Creates the routing table of a listener: maps received topics (as bytes) to (route kind, function argument name).
+        Contains the shutdown topic and the subscription strings of all subscribed topics.
+        Other received topics (subscription prefix matches, e.g. with a different domain suffix)
+        are added on first reception by `_resolve_route`.
+        """
+        routes = {
+            bytes(terminate_topic, encoding="ascii"): (_ROUTE_TERMINATE, None)
+        }
+        for topic in topics + queued_topics:
+            topic_bytes = bytes(self._get_sub_topic_str(topic), encoding="ascii")
+            routes[topic_bytes] = self._resolve_route(routes, topic_bytes, topics, queued_topics)
+        return routes
+
+    @staticmethod
+    def _resolve_route(routes: Dict[bytes, Tuple[int, str]], topic: bytes, topics: List[str], queued_topics: List[str]) -> Tuple[int, str]:
+        """ Finds the function argument for a received topic and caches the result in the routing table """
+        # problem: routing based on prefixes -> function argument names may differ
+        # solution: find longest common prefix of argument name and received topic
+        topic_str = topic.decode("ascii")
+        common_prefix = ""
+        for key in topics + queued_topics:
+            if topic_str.startswith(key) and len(key) > len(common_prefix):
+                common_prefix = key
+        route = (_ROUTE_LATEST if common_prefix in topics else _ROUTE_QUEUED, common_prefix)
+        routes[topic] = route
+        return route
+
+    def _get_pub_topic_bytes(self, topic: str, domain: str) -> bytes:
+        """ Returns the encoded topic string (topic + domain) for publishing (cached) """
+        key = (topic, domain)
+        if key not in self._pub_topic_bytes:
+            topic_domain_str = f"{topic}/{domain}" if domain else topic
+            if topic in self._pub_topic_domains:
+                # overwrite domain for this specific topic and service instance
+                topic_domain_str = f"{topic}/{self._pub_topic_domains[topic]}" if self._pub_topic_domains[topic] else topic
+            self._pub_topic_bytes[key] = bytes(topic_domain_str, encoding="ascii")
+        return self._pub_topic_bytes[key]
+
     def _setup_publishers(self, func_instance, topics):
-        """ Creates a publish socket for a function decorated with services.service.PublishSubscribe. """
+        """
+        Creates a publish socket for a function decorated with services.service.PublishSubscribe.
+        The send queue size is the smallest configured size of its topics, the overflow policy is applied per topic (see services.bus).
+        """
         if len(topics) == 0:
             return
 
-        # setup publish socket
-        ctx = Context.instance()
-        publisher = ctx.socket(zmq.PUB)
-        publisher.sndhwm = 1100000
-        publisher.connect(f"{self._protocol}://{self._host_addr}:{self._pub_port}")
-        self._publish_sockets[func_instance] = publisher
+        # setup publish socket (one per function, so messages of one call are received in order)
+        hwm = min(high_water_mark(topic) for topic in topics)
+        socket = self._bus.publisher(Context.instance(), topics=list(topics), owner=self._start_topic, hwm=hwm)
+        self._publish_sockets[func_instance] = BoundedPublisher(socket, buffer_size=hwm)
+
+        # pre-encode topic strings for the service domain
+        for topic in topics:
+            self._get_pub_topic_bytes(topic, self._domain_name)
 
         # add to list of local topics
         self._pub_topics.update(topics)
 
-    def _setup_dialog_ctrl_msg_listener(self):
-        ctx = Context.instance()
-
-        # setup receiver for dialog system control messages
-        self._control_channel_sub = ctx.socket(zmq.SUB)
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(self._start_topic, encoding="ascii"))
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(self._end_topic, encoding="ascii"))
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(self._terminate_topic, encoding="ascii"))
-        self._control_channel_sub.connect(f"{self._protocol}://{self._host_addr}:{self._sub_port}")
-
-        # setup sender for dialog system control message acknowledgements 
-        self._control_channel_pub = ctx.socket(zmq.PUB)
-        self._control_channel_pub.sndhwm = 1100000
-        self._control_channel_pub.connect(f"{self._protocol}://{self._host_addr}:{self._pub_port}")
-
-        # setup receiver for internal ACK messages
-        self._internal_control_channel_sub = ctx.socket(zmq.SUB)
-        for internal_ctrl_topic in list(self._internal_end_topics.keys()) + list(
-                self._internal_start_topics.keys()) + list(self._internal_terminate_topics.keys()):
-            self._internal_control_channel_sub.setsockopt(zmq.SUBSCRIBE,
-                                                          bytes(f"ACK/{internal_ctrl_topic}", encoding="ascii"))
-        self._internal_control_channel_sub.connect(f"{self._protocol}://{self._host_addr}:{self._sub_port}")
+    def _send_overflow_error(self, user_id, topic: bytes):
+        """
+        Informs the user that a message was not sent because the send queue of `topic` (encoded, with domain) is full
+        (overflow policy REJECT, or BLOCK after the block timeout).
+        The error act is sent to the domain of the lost message, like the acts of the policy.
+        """
+        topic_str = topic.decode("ascii")
+        logging.getLogger("error_log").warning(f"bus overflow: message of user {user_id} for topic {topic_str} was not sent")
+        if self._overflow_error_pub is not None:
+            _, _, domain = topic_str.partition("/")
+            try:
+                _send_msg(self._overflow_error_pub, self._get_pub_topic_bytes(DS_BUS_OVERFLOW_ERROR_TOPIC, domain if domain else self._domain_name),
+                          _serialize_content([SysAct(act_type=SysActionType.Bad)]), user_id)
+            except PublishOverflowError:
+                logging.getLogger("error_log").error(f"bus overflow: error act for user {user_id} could not be sent")
+
+    def _setup_dialog_ctrl_msg_listener(self, ctx=None):
+        # setup receiver for internal ACK messages (listener shutdown)
+        self._internal_control_channel_sub = self._bus.subscriber(
+            ctx if ctx is not None else Context.instance(),
+            control_subscriptions=[f"ACK/{internal_ctrl_topic}" for internal_ctrl_topic in self._internal_terminate_topics],
+            owner=self._start_topic)
+
+    def _connect_control_plane(self, ctx):
+        """ Connects a DEALER socket to the dialog system's control plane and announces this service (READY) """
+        control_socket = ctx.socket(zmq.DEALER)
+        # NOTE: the start topic is unique per service instance and known to the dialog system (also for remote services)
+        control_socket.setsockopt(zmq.ROUTING_ID, bytes(self._start_topic, encoding="ascii"))
+        control_socket.connect(f"{self._protocol}://{self._host_addr}:{self._ctrl_port}")
+        return control_socket
+
+    def _handle_dialog_start(self, user_ids: List[Any]) -> Dict[Any, str]:
+        """ Initializes the dialog state and starts all listeners for the given users. Returns the users that could not be started. """
+        failed = {}
+        for user_id in user_ids:
+            try:
+                # only start listening if dialog start was executed successfully.
+                # if it throws an exception, wait for the next try of start_dialog
+                self.dialog_start(user_id=user_id)
+                self._start_listeners(user_id)
+            except:
+                logging.getLogger("error_log").error(traceback.format_exc())
+                failed[user_id] = traceback.format_exc(limit=1)
+        return failed
+
+    def _handle_dialog_end(self, user_ids: List[Any]) -> Dict[Any, str]:
+        """ Stops all listeners for the given users and records their dialogs. Returns the users where `dialog_end` failed. """
+        failed = {}
+        for user_id in user_ids:
+            self._stop_listeners(user_id)
+            try:
+                self.dialog_end(user_id)
+            except:
+                logging.getLogger("error_log").error(traceback.format_exc())
+                failed[user_id] = traceback.format_exc(limit=1)
+        return failed
 
     def _control_channel_listener(self):
+        # control socket is only used by this thread
+        control_socket = self._connect_control_plane(Context.instance())
+        control_socket.send_multipart((b"", CTRL_READY, b"null"))
         # listen for control channel messages
         listen = True
         while listen:
             try:
-                # receive message for subscribed control topic
-                msg = self._control_channel_sub.recv_multipart(copy=True)
-                topic = msg[0].decode("ascii")
-                data = json.loads(msg[1])
-                timestamp = data['timestamp']
-                content = data['content']
-                user_id = data['user_id']
-
-                if topic == self._start_topic:
-                    # initialize dialog state
-                    self.dialog_start(user_id=user_id)
-                    # set all listeners of this service to listening mode (block until they are listening)
-                    # only start listening if dialog start was executed successful.
-                    # if it throws an exception, wait for the next try of start_dialog 
-                    for internal_start_topic in self._internal_start_topics:
-                        _send_msg(self._control_channel_pub, internal_start_topic, True, user_id)
-                        _recv_ack(self._internal_control_channel_sub, internal_start_topic, True, user_id)
-                    _send_ack(self._control_channel_pub, self._start_topic, True, user_id)
-                elif topic == self._end_topic:
-                    # stop all listeners of this service (block until they stopped)
-                    for internal_end_topic in self._internal_end_topics:
-                        _send_msg(self._control_channel_pub, internal_end_topic, True, user_id)
-                        _recv_ack(self._internal_control_channel_sub, internal_end_topic, True, user_id)
-                    self.dialog_end(user_id)
-                    _send_ack(self._control_channel_pub, self._end_topic, True, user_id)
-                elif topic == self._terminate_topic:
+                correlation_id, command, payload = control_socket.recv_multipart(copy=True)
+                payload = json.loads(payload)
+                failed = {}
+
+                if command == CTRL_START:
+                    failed = self._handle_dialog_start(payload)
+                elif command == CTRL_END:
+                    failed = self._handle_dialog_end(payload)
+                elif command == CTRL_TERMINATE:
                     # terminate all listeners of this service (block until they stopped)
                     for internal_terminate_topic in self._internal_terminate_topics:
-                        _send_msg(self._control_channel_pub, internal_terminate_topic, True, user_id)
-                        _recv_ack(self._internal_control_channel_sub, internal_terminate_topic, True, user_id)
-                    self.dialog_exit(user_id)
-                    _send_ack(self._control_channel_pub, self._terminate_topic, True, user_id)
+                        _send_msg(self._control_channel_pub, internal_terminate_topic, True, payload)
+                        _recv_ack(self._internal_control_channel_sub, internal_terminate_topic, True, payload)
+                    self.dialog_exit(payload)
                     listen = False
-                elif topic == self._train_topic:
+                elif command == CTRL_TRAIN:
                     self.train()
-                    _send_ack(self._control_channel_pub, self._train_topic, True, user_id)
-                elif topic == self._eval_topic:
+                elif command == CTRL_EVAL:
                     self.eval()
-                    _send_ack(self._control_channel_pub, self._eval_topic, True, user_id)
                 else:
                     if self.debug_logger:
-                        self.debug_logger.info(f"- (Service): received unknown control message from user {user_id} topic {topic} with content {content}")
+                        self.debug_logger.info(f"- (Service): received unknown control command {command}")
+                control_socket.send_multipart((correlation_id, CTRL_OK, _control_reply_payload(failed)))
             except KeyboardInterrupt:
                 break
             except:
                 logging.getLogger("error_log").error(traceback.format_exc())
+        control_socket.close()
 
     def dialog_start(self, user_id: str):
         """ This function is called before the first message to a new dialog is published.
             You should overwrite this function to set/reset dialog-level variables. """
         pass
 
+    def dialog_started(self, user_id: str) -> bool:
+        """ Returns True if the dialog state of the user was initialized by `dialog_start`.
+            Overwrite this function if `dialog_start` can fail without raising an exception (see `DialogSystem.resume_dialog`). """
+        return True
+
     def dialog_end(self, user_id: str):
         """ This function is called after a dialog ended (Topics.DIALOG_END message was received).
             You should overwrite this function to record dialog-level information. """
@@ -328,7 +527,7 @@ class Service:
         """ Sets module to eval mode """
         self.is_training = False
 
-    def run_standalone(self, host_reg_port: int = 65535):
+    def run_standalone(self, host_reg_port: int = DS_BUS_REG_PORT):
         assert self._identifier is not None, "running a service on a remote node requires a unique identifier"
         print("Waiting for dialog system host...")
 
@@ -338,7 +537,7 @@ class Service:
         sync_endpoint = ctx.socket(zmq.REQ)
         sync_endpoint.connect(f"tcp://{self._host_addr}:{host_reg_port}")
         data = pickle.dumps((self._domain_name, self._sub_topics, self._pub_topics, self._start_topic, self._end_topic,
-                             self._terminate_topic))
+                             self._terminate_topic, self._bus.endpoints()))
         sync_endpoint.send_multipart((bytes(f"REGISTER_{self._identifier}", encoding="ascii"), data))
 
         # TODO thread this waiting loop?
@@ -350,21 +549,65 @@ class Service:
             if msg.startswith("ACK_REGISTER_"):
                 remote_service_identifier = msg[len("ACK_REGISTER_"):]
                 if remote_service_identifier == self._identifier:
-                    self._register_with_dialogsystem()
                     sync_endpoint.send_multipart(
                         (bytes(f"CONF_REGISTER_{self._identifier}", encoding="ascii"), pickle.dumps(True)))
+                    sync_endpoint.recv()
+                    if self._bus.kind == BROKERLESS:
+                        self._receive_bus_endpoints(sync_endpoint)
+                    self._register_with_dialogsystem()
                     registered = True
                     print(f"Done")
 
+    def _receive_bus_endpoints(self, sync_endpoint):
+        """ Brokerless topology: requests the publisher registry from the dialog system node and connects all subscribers """
+        while True:
+            sync_endpoint.send_multipart((bytes(f"WIRE_{self._identifier}", encoding="ascii"), pickle.dumps(True)))
+            endpoints = sync_endpoint.recv()
+            if len(endpoints) > 0:
+                break
+            # not all services registered yet
+            time.sleep(0.1)
+        self._bus.add_endpoints(pickle.loads(endpoints))
+        self._bus.wire()
+
     def get_all_subscribed_topics(self):
         return copy.deepcopy(self._sub_topics)
 
     def get_all_published_topics(self):
         return copy.deepcopy(self._pub_topics)
 
-    def _receiver_thread(self, subscriber, func_instance,
-                         topics: Iterable[str], queued_topics: Iterable[str],
-                         start_topic, end_topic, terminate_topic):
+    def _dispatch(self, func_instance, user_id, kind: int, arg_name: str, value: Any, timestamp: float, join_buffer: "_JoinBuffer"):
+        """
+        Stores a received value for the function argument `arg_name`.
+        Calls the function as soon as values for all of its arguments are available.
+
+        Returns:
+            The return value of the function call (a coroutine for `async def` functions), or None if the function was not called
+        """
+        # simple synchronization mechanism: remember only newest values,
+        # store them until there was at least 1 new value received per topic.
+        # Then call callback function with complete set of values.
+        # The join buffer forgets the values afterwards and starts collecting again.
+        joined = join_buffer.add(user_id, kind == _ROUTE_QUEUED, arg_name, value, timestamp)
+        if joined is not None:
+            values, timestamps = joined
+            # received a new value for each topic -> call callback function
+            if func_instance.timestamp_enabled:
+                # append timestamps, if required
+                values['timestamps'] = timestamps
+            if self.debug_logger:
+                self.debug_logger.info(
+                    f"- (DS): received all messages for user {user_id}, function {func_instance}\n   -> CALLING function")
+            if self.__class__ == Service:
+                # NOTE workaround for publisher / subscriber without being an instance method
+                result = func_instance(user_id, **values)
+            else:
+                result = func_instance(self, user_id, **values)
+            return result
+        return None
+
+    def _receiver_thread(self, subscriber, control_channel_pub, func_instance,
+                         topics: Iterable[str], queued_topics: Iterable[str], terminate_topic):
         """
         Loop for receiving messages.
         Will continue until a message for `terminate_topic` is received.
@@ -373,98 +616,37 @@ class Service:
         service function keyword mapping.
         """
 
-        ctx = Context.instance()
-        control_channel_pub = ctx.socket(zmq.PUB)
-        control_channel_pub.sndhwm = 1100000
-        control_channel_pub.connect(f"{self._protocol}://{self._host_addr}:{self._pub_port}")
-
-        all_sub_topics = topics + queued_topics
-        num_topics = len(all_sub_topics)
+        routes = self._make_routing_table(topics, queued_topics, terminate_topic)
         terminating = False
         func_name = func_instance.func_name # get function name from delegate
+        active_attr = f"_{func_name}_active"
+        join_buffer = self._join_buffers[func_name]
 
         while not terminating:
             try:
-                msg = subscriber.recv_multipart(copy=True)
-                topic = msg[0].decode("ascii")
-                data = json.loads(msg[1])
+                topic, data = _recv_msg(subscriber)
+                route = routes.get(topic)
+                if route is None:
+                    # topic received for the first time (prefix match of a subscription)
+                    route = self._resolve_route(routes, topic, topics, queued_topics)
+                kind, arg_name = route
                 timestamp = data['timestamp']
                 content = data['content']
                 user_id = data['user_id']
-                
-                # print('recv', topic, user_id, content)
 
-                # print("RECV MSG", user_id, topic)
                 # based on topic, decide what to do
-                if topic == start_topic:
-                    # reset values and start listening to non-control messages
-                    self.set_state(user_id, f"_{func_name}_values", {})
-                    self.set_state(user_id, f"_{func_name}_timestamps", {})
-                    self.set_state(user_id, f"_{func_name}_active", True)
-                    _send_ack(control_channel_pub, start_topic, True, user_id)
-                elif topic == end_topic:
-                    # ignore all non-control messages
-                    self.set_state(user_id, f"_{func_name}_active", False)
-                    _send_ack(control_channel_pub, end_topic, True, user_id)
-                elif topic == terminate_topic:
+                if kind == _ROUTE_TERMINATE:
                     # shutdown listener thread by exiting loop
-                    self.set_state(user_id, f"_{func_name}_active", False)
-                    _send_ack(control_channel_pub, terminate_topic, user_id)
+                    self.set_state(user_id, active_attr, False)
+                    _send_ack(control_channel_pub, terminate_topic, True, user_id)
                     terminating = True
-                else:
+                elif self.get_state(user_id, active_attr):
                     # non-control message
-                    active = self.get_state(user_id, f"_{func_name}_active")
-                    if active:
-                        # process message
-                        if self.debug_logger:
-                            self.debug_logger.info(
-                                f"- (DS): listener thread for user {user_id}, function {func_instance}:\n   received for topic {topic}:\n   {content}")
-
-                        # simple synchronization mechanism: remember only newest values,
-                        # store them until there was at least 1 new value received per topic.
-                        # Then call callback function with complete set of values.
-                        # Reset values afterwards and start collecting again.
-
-                        # problem: routing based on prefixes -> function argument names may differ
-                        # solution: find longest common prefix of argument name and received topic
-                        common_prefix = ""
-                        values = self.get_state(user_id, f"_{func_name}_values")
-                        timestamps = self.get_state(user_id, f"_{func_name}_timestamps")
-                        for key in all_sub_topics:
-                            if topic.startswith(key) and len(topic) > len(common_prefix):
-                                common_prefix = key
-                        if common_prefix in topics:
-                            # store only latest value
-                            values[common_prefix] = _deserialize_content(content)  # set value for received topic
-                            timestamps[common_prefix] = timestamp  # set timestamp for received value
-                            self.set_state(user_id, f"_{func_name}_values", values)
-                            self.set_state(user_id, f"_{func_name}_timestamps", timestamps)
-                        else:
-                            # topic is a queued_topic - queue all values and their timestamps
-                            if not common_prefix in values:
-                                values[common_prefix] = []
-                                timestamps[common_prefix] = []
-                            values[common_prefix].append(_deserialize_content(content))
-                            timestamps[common_prefix].append(timestamp)
-                            self.set_state(user_id, f"_{func_name}_values", values)
-                            self.set_state(user_id, f"_{func_name}_timestamps", timestamps)
-
-                        if len(values) == num_topics:
-                            # received a new value for each topic -> call callback function
-                            if func_instance.timestamp_enabled:
-                                # append timestamps, if required
-                                values['timestamps'] = timestamps
-                            if self.debug_logger:
-                                self.debug_logger.info(
-                                    f"- (DS): received all messages for user {user_id}, function {func_instance}\n   -> CALLING function")
-                            if self.__class__ == Service:
-                                # NOTE workaround for publisher / subscriber without being an instance method
-                                func_instance(user_id, **values)
-                            else:
-                                func_instance(self, user_id, **values)
-                            # reset values
-                            self.set_state(user_id, f"_{func_name}_values", {})
-                            self.set_state(user_id, f"_{func_name}_timestamps", {})
+                    if self.debug_logger:
+                        self.debug_logger.info(
+                            f"- (DS): listener thread for user {user_id}, function {func_instance}:\n   received for topic {topic.decode('ascii')}:\n   {content}")
+                    with tracing.use_context(data.get('trace')):
+                        self._dispatch(func_instance, user_id, kind, arg_name, _deserialize_content(content), timestamp, join_buffer)
             except KeyboardInterrupt:
                 break
             except:
@@ -473,6 +655,10 @@ class Service:
         subscriber.close()
 
 
+_CALLBACK_DURATION = metrics.histogram("ds_callback_duration_seconds", "Duration of functions decorated with PublishSubscribe",
+                                       ["function"])
+
+
 # Each decorated function should return a dictonary with the keys matching the pub_topics names
 def PublishSubscribe(sub_topics: List[str] = [], pub_topics: List[str] = [], queued_sub_topics: List[str] = []):
     """
@@ -513,40 +699,75 @@ def PublishSubscribe(sub_topics: List[str] = [], pub_topics: List[str] = [], que
     """
 
     def wrapper(func):
-        def delegate(self, *args, **kwargs):
-            func_inst = getattr(self, func.__name__)
-
-            callargs = list(args)
-            if self in callargs:    # remove self when in *args, because already known to function
-                callargs.remove(self)
-            result = func(self, *callargs, **kwargs)
+        def publish(self, func_inst, callargs, kwargs, result):
             if result:
-                # fix! (user could have multiple "/" characters in topic - only use last one )
-                domains = {res.split("/")[0]: res.split("/")[1] if "/" in res else "" for res in result}
-                result = {key.split("/")[0]: result[key] for key in result}
+                domains = {}
+                split_result = {}
+                for key in result:
+                    topic, topic_domain = _split_topic_key(key)
+                    domains[topic] = topic_domain
+                    split_result[topic] = result[key]
+                result = split_result
 
             if func_inst not in self._publish_sockets:
                 # not a publisher, just normal function
                 return result
 
             socket = self._publish_sockets[func_inst]
-            domain = self._domain_name
             user_id = kwargs['user_id'] if 'user_id' in kwargs else callargs[0]
             if socket and result:
                 # publish messages
                 for topic in pub_topics:
                 # for topic in result: # NOTE publish any returned value in dict with it's key as topic
                     if topic in result:
-                        domain = domain if domain else domains[topic]
-                        topic_domain_str = f"{topic}/{domain}" if domain else topic
-                        if topic in self._pub_topic_domains:
-                            topic_domain_str = f"{topic}/{self._pub_topic_domains[topic]}" if self._pub_topic_domains[topic] else topic
-                        _send_msg(socket, topic_domain_str, _serialize_content(result[topic]), user_id)
+                        topic_bytes = self._get_pub_topic_bytes(topic, self._domain_name if self._domain_name else domains[topic])
+                        try:
+                            _send_msg(socket, topic_bytes, _serialize_content(result[topic]), user_id)
+                        except PublishOverflowError:
+                            self._send_overflow_error(user_id, topic_bytes)
+                            continue
                         if self.debug_logger:
                             self.debug_logger.info(
-                                f"- (DS): sent data from user {result['user_id']}, {func} to topic {topic_domain_str}:\n   {result[topic]}")
+                                f"- (DS): sent data from user {user_id}, {func} to topic {topic_bytes.decode('ascii')}:\n   {result[topic]}")
             return result
 
+        if inspect.iscoroutinefunction(func):
+            # async def handler (requires a services.async_service.AsyncService instance)
+            async def delegate(self, *args, **kwargs):
+                func_inst = getattr(self, func.__name__)
+                callargs = list(args)
+                if self in callargs:    # remove self when in *args, because already known to function
+                    callargs.remove(self)
+                user_id = kwargs['user_id'] if 'user_id' in kwargs else (callargs[0] if callargs else None)
+                name = f"{type(self).__name__}.{func.__name__}"
+                profile = profiling.session(name)
+                start = time.perf_counter()
+                with tracing.span(name, user_id=user_id):
+                    if profile is None:
+                        result = await func(self, *callargs, **kwargs)
+                    else:
+                        result = await profile.call_async(func, self, *callargs, **kwargs)
+                    _CALLBACK_DURATION.labels(name).observe(time.perf_counter() - start)
+                    return publish(self, func_inst, callargs, kwargs, result)
+        else:
+            def delegate(self, *args, **kwargs):
+                func_inst = getattr(self, func.__name__)
+                callargs = list(args)
+                if self in callargs:    # remove self when in *args, because already known to function
+                    callargs.remove(self)
+                user_id = kwargs['user_id'] if 'user_id' in kwargs else (callargs[0] if callargs else None)
+                name = f"{type(self).__name__}.{func.__name__}"
+                profile = profiling.session(name)
+                start = time.perf_counter()
+                with tracing.span(name, user_id=user_id):
+                    if profile is None:
+                        result = func(self, *callargs, **kwargs)
+                    else:
+                        # on-demand profiling (see utils.profiling)
+                        result = profile.call(func, self, *callargs, **kwargs)
+                    _CALLBACK_DURATION.labels(name).observe(time.perf_counter() - start)
+                    return publish(self, func_inst, callargs, kwargs, result)
+
         # declare function as publish / subscribe functions and attach the respective topics
         delegate.func_name = func.__name__
         delegate.pubsub = True
@@ -569,11 +790,14 @@ class DialogSystem:
     Later, this class will also be used to communicate / synchronize with services running on different nodes.
     """
 
-    def __init__(self, services: List[Union[Service, RemoteService]], sub_port: int = 65533, pub_port: int = 65534,
-                 reg_port: int = 65535, protocol: str = 'tcp', debug_logger: str = None):
+    def __init__(self, services: List[Union[Service, RemoteService]], sub_port: int = DS_BUS_SUB_PORT, pub_port: int = DS_BUS_PUB_PORT,
+                 reg_port: int = DS_BUS_REG_PORT, protocol: str = 'tcp', debug_logger: str = None, ctrl_port: int = DS_BUS_CTRL_PORT,
+                 topology: str = DS_BUS_TOPOLOGY):
         """
         Args:
             sub_port(int): subscriber port
+            ctrl_port(int): control plane port (dialog start / end requests to services)
+            topology(str): message bus topology, see services.bus ("proxy", "sharded" or "brokerless")
             sub_addr(str): IP-address or domain name of proxy subscriber interface (e.g. 193.196.53.252 for your local machine)
             pub_port(str): publisher port
             pub_addr(str): IP-address or domain name of proxy publisher interface (e.g. 193.196.53.252 for your local machine) 
@@ -592,11 +816,9 @@ class DialogSystem:
         # node-local sockets
         self._domains = set()
 
-        # start proxy thread
-        self._proxy_dev = ThreadProxy(in_type=zmq.XSUB, out_type=zmq.XPUB)  # , mon_type=zmq.XSUB)
-        self._proxy_dev.bind_in(f"{protocol}://{DS_SERVER_IP_ADDR}:{pub_port}")
-        self._proxy_dev.bind_out(f"{protocol}://{DS_SERVER_IP_ADDR}:{sub_port}")
-        self._proxy_dev.start()
+        # start proxy thread(s)
+        self._bus = BusTopology(kind=topology, protocol=protocol, host=DS_SERVER_IP_ADDR, sub_port=sub_port, pub_port=pub_port)
+        self._bus.start_brokers()
         time.sleep(2)
         self._sub_port = sub_port
         self._pub_port = pub_port
@@ -610,26 +832,39 @@ class DialogSystem:
 
         # control channels
         ctx = Context.instance()
-        self._control_channel_pub = ctx.socket(zmq.PUB)
-        self._control_channel_pub.sndhwm = 1100000
-        self._control_channel_pub.connect(f"{protocol}://{DS_SERVER_IP_ADDR}:{pub_port}")
-        self._control_channel_sub = ctx.socket(zmq.SUB)
+        # start signals (any topic), never rejected (a full queue fails the dialog start after the block timeout)
+        self._control_channel_pub = BoundedPublisher(self._bus.publisher(ctx), BLOCK)
+        # control plane: request-reply with every service (identified by its start topic), separate from the data bus
+        self._control_ids = set()
+        self._control_router = ctx.socket(zmq.ROUTER)
+        self._control_router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self._control_router.bind(f"{protocol}://{DS_SERVER_IP_ADDR}:{ctrl_port}")
+        self._control_lock = threading.Lock()  # one control request at a time (socket is shared by all callers)
+        self._ready_ids = set()
+        self._next_correlation_id = 0
 
         # register services (local and remote)
+        # two phases: 1. create the sockets of all services, 2. connect them (brokerless topology) and start listening
         remote_services = {}
+        local_services = []
         for service in services:
             if isinstance(service, Service):
                 # register local service
                 service_name = type(service).__name__ if service._identifier is None else service._identifier
+                service._bus = self._bus
                 service._init_pubsub()
                 self._add_service_info(service_name, service._domain_name, service._sub_topics, service._pub_topics,
                                        service._start_topic, service._end_topic, service._terminate_topic)
-                service._register_with_dialogsystem()
+                local_services.append(service)
+                self._services.append(service)
             elif isinstance(service, RemoteService):
                 remote_services[getattr(service, 'identifier')] = service
         self._register_remote_services(remote_services, reg_port)
+        self._bus.wire()
+        for service in local_services:
+            service._register_with_dialogsystem()
 
-        self._control_channel_sub.connect(f"{protocol}://{DS_SERVER_IP_ADDR}:{sub_port}")
+        self._wait_for_services_ready()
         self._setup_dialog_end_listener()
 
         time.sleep(0.25)
@@ -653,17 +888,27 @@ class DialogSystem:
         reg_service = ctx.socket(zmq.REP)
         reg_service.bind(f'tcp://{DS_SERVER_IP_ADDR}:{reg_port}')
 
-        while len(remote_services) > 0:
+        unwired = set(remote_services.keys()) if self._bus.kind == BROKERLESS else set()
+        while len(remote_services) > 0 or len(unwired) > 0:
             # call next remote service
             msg, data = reg_service.recv_multipart()
             msg = msg.decode("utf-8")
-            if msg.startswith("REGISTER_"):
+            if msg.startswith("WIRE_"):
+                # brokerless topology: send publisher registry, once all services are registered
+                if len(remote_services) > 0:
+                    reg_service.send(b"")
+                else:
+                    unwired.discard(msg[len("WIRE_"):])
+                    reg_service.send(pickle.dumps(self._bus.endpoints()))
+            elif msg.startswith("REGISTER_"):
                 # make sure we have a register message
                 remote_service_identifier = msg[len("REGISTER_"):]
                 if remote_service_identifier in remote_services:
                     print(f"registering service {remote_service_identifier}...")
                     # add remote service interface info
-                    domain_name, sub_topics, pub_topics, start_topic, end_topic, terminate_topic = pickle.loads(data)
+                    domain_name, sub_topics, pub_topics, start_topic, end_topic, terminate_topic = pickle.loads(data)[:6]
+                    if self._bus.kind == BROKERLESS:
+                        self._bus.add_endpoints(pickle.loads(data)[6])
                     self._add_service_info(remote_service_identifier, domain_name, sub_topics, pub_topics, start_topic,
                                            end_topic, terminate_topic)
                     self._remote_identifiers.add(remote_service_identifier)
@@ -692,17 +937,84 @@ class DialogSystem:
         self._end_topics.add(end_topic)
         self._terminate_topics.add(terminate_topic)
 
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(f"ACK/{start_topic}", encoding="ascii"))
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(f"ACK/{end_topic}", encoding="ascii"))
-        self._control_channel_sub.setsockopt(zmq.SUBSCRIBE, bytes(f"ACK/{terminate_topic}", encoding="ascii"))
+        self._control_ids.add(bytes(start_topic, encoding="ascii"))
+
+    def _wait_for_services_ready(self):
+        """ Blocks until all services connected to the control plane """
+        while not self._control_ids.issubset(self._ready_ids):
+            control_id, correlation_id, command, payload = self._control_router.recv_multipart(copy=True)
+            if command == CTRL_READY:
+                self._ready_ids.add(control_id)
+
+    def _control_request(self, command: bytes, payload: Any) -> Dict[Any, str]:
+        """
+        Sends a control command to all services and blocks until every service replied.
+
+        Returns:
+            users for which the command failed in at least one service (user id -> error message)
+        """
+        failed = {}
+        data = bytes(json.dumps(payload), encoding="ascii")
+        with self._control_lock:
+            self._next_correlation_id += 1
+            correlation_id = bytes(str(self._next_correlation_id), encoding="ascii")
+            for control_id in self._control_ids:
+                self._control_router.send_multipart((control_id, correlation_id, command, data))
+            pending = set(self._control_ids)
+            while len(pending) > 0:
+                control_id, reply_id, status, reply = self._control_router.recv_multipart(copy=True)
+                if reply_id != correlation_id:
+                    # READY of a (re-)connecting service or reply to an earlier request
+                    continue
+                pending.discard(control_id)
+                for user_id, error in json.loads(reply):
+                    failed[user_id] = error
+        return failed
+
+    def start_dialogs(self, user_ids: List[Any]) -> Dict[Any, str]:
+        """
+        Lets all services start listening for the given users (one request-reply round trip per service).
+
+        Returns:
+            users whose `dialog_start` failed in at least one service (user id -> error message)
+        """
+        failed = self._control_request(CTRL_START, list(user_ids))
+        # only running dialogs can be resumed, failed starts are retried on the next connect
+        self._active_user_ids.update(user_id for user_id in user_ids if user_id not in failed)
+        self._active_user_ids.difference_update(failed)
+        if self.debug_logger:
+            self.debug_logger.info(f"- (DS): all services STARTED listening for users {user_ids}")
+        return failed
+
+    def resume_dialog(self, user_id) -> bool:
+        """
+        Fast path for reconnects of running dialogs (e.g. page transitions): returns True if the user's dialog was started
+        successfully (`dialog_started` of every local service) and every local service still listens for the user, i.e. the dialog can continue with the state kept by the services
+        without a control request (no `dialog_start` calls, collected listener values are kept).
+        Returns False if the dialog has to be (re-)started with `_start_dialog`.
+        Remote services can't be checked, so dialogs of systems with remote services are never resumed.
+        """
+        if user_id not in self._active_user_ids or len(self._remote_identifiers) > 0:
+            return False
+        return all(service.is_listening(user_id) and service.dialog_started(user_id) for service in self._services)
+
+    def end_dialogs(self, user_ids: List[Any]) -> Dict[Any, str]:
+        """
+        Lets all services stop listening for the given users and calls their `dialog_end`.
+
+        Returns:
+            users whose `dialog_end` failed in at least one service (user id -> error message)
+        """
+        self._active_user_ids.difference_update(user_ids)
+        failed = self._control_request(CTRL_END, list(user_ids))
+        if self.debug_logger:
+            self.debug_logger.info(f"- (DS): all services STOPPED listening for users {user_ids}")
+        return failed
 
     def _setup_dialog_end_listener(self):
         """ Creates socket for listening to Topic.DIALOG_END messages """
-        ctx = Context.instance()
-        self._end_socket = ctx.socket(zmq.SUB)
         # subscribe to dialog end from all domains
-        self._end_socket.setsockopt(zmq.SUBSCRIBE, bytes(Topic.DIALOG_END, encoding="ascii"))
-        self._end_socket.connect(f"{self.protocol}://{DS_SERVER_IP_ADDR}:{self._sub_port}")
+        self._end_socket = self._bus.subscriber(Context.instance(), subscriptions=[Topic.DIALOG_END])
 
         # # add to list of local topics
         # if Topic.DIALOG_END not in self._local_sub_topics:
@@ -734,10 +1046,9 @@ class DialogSystem:
         # listen for Topic.DIALOG_END messages
         while True:
             try:
-                msg = self._end_socket.recv_multipart(copy=True)
                 # receive message for subscribed topic
-                topic = msg[0].decode("ascii")
-                data = json.loads(msg[1])
+                topic, data = _recv_msg(self._end_socket)
+                topic = topic.decode("ascii")
                 timestamp = data['timestamp']
                 content = data['content']
                 user_id = data['user_id']
@@ -752,24 +1063,17 @@ class DialogSystem:
                 logging.getLogger("error_log").error(traceback.format_exc())
 
         # stop receivers (blocking)
-        for end_topic in self._end_topics:
-            _send_msg(self._control_channel_pub, end_topic, True, user_id)
-            _recv_ack(self._control_channel_sub, end_topic, True, user_id)
-        if self.debug_logger:
-            self.debug_logger.info(f"- (DS): all services STOPPED listening for user {user_id}")
+        self.end_dialogs([user_id])
 
     def _start_dialog(self, start_signals: dict, user_id: str):
         """ Block until all receivers started listening.
             Then, call `dialog_start`on all registered services.
             Finally, publish all start signals given. """
-        self._active_user_ids.add(user_id)
         # self._stopEvent.clear() # TODO 
         # start receivers (blocking)
-        for start_topic in self._start_topics:
-            _send_msg(self._control_channel_pub, start_topic, True, user_id)
-            _recv_ack(self._control_channel_sub, start_topic, True, user_id)
-        if self.debug_logger:
-            self.debug_logger.info(f"- (DS): all services STARTED listening for user {user_id}")
+        failed = self.start_dialogs([user_id])
+        if user_id in failed:
+            raise RuntimeError(f"dialog start failed for user {user_id}: {failed[user_id]}")
         # publish first turn trigger
         # for domain in self._domains:
         # "wildcard" mechanism: publish start messages to all known domains
@@ -960,6 +1264,83 @@ class DialogSystem:
         return len(self.list_inconsistencies()[0]) == 0
 
 
+class _JoinBuffer:
+    """
+    Collects the inputs of one function (subscribing to several topics) per user until a value for each topic was received.
+
+    Partial joins are kept in insertion order (or order of the latest update, see `config.DS_JOIN_STALE_POLICY`),
+    so stale partials (`config.DS_JOIN_TIMEOUT`) are found at the front and swept on every update.
+    If there are more than `config.DS_JOIN_MAX_PARTIALS` partials, the oldest one is evicted.
+    """
+
+    def __init__(self, num_topics: int, timeout: float = DS_JOIN_TIMEOUT, stale_policy: str = DS_JOIN_STALE_POLICY,
+                 max_partials: int = DS_JOIN_MAX_PARTIALS):
+        assert stale_policy in ("first", "latest"), f"unknown join stale policy {stale_policy}"
+        self.num_topics = num_topics
+        self.timeout = timeout
+        self.refresh = stale_policy == "latest"
+        self.max_partials = max_partials
+        self._partials = OrderedDict()  # user id -> [values, timestamps, time of first / latest value]
+        self._lock = threading.Lock()   # used by the listener and the control channel (dialog start / end)
+        # counters
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def add(self, user_id, queued: bool, arg_name: str, value: Any, timestamp: float) -> Union[Tuple[dict, dict], None]:
+        """
+        Adds a received value (appended to a list for queued topics, otherwise replacing the previous value).
+
+        Returns:
+            (values, timestamps) by argument name if the join is complete, otherwise None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            partial = self._partials.get(user_id)
+            if partial is None:
+                if len(self._partials) >= self.max_partials:
+                    self._partials.popitem(last=False)
+                    self.evicted += 1
+                partial = [{}, {}, now]
+                self._partials[user_id] = partial
+            elif self.refresh:
+                partial[2] = now
+                self._partials.move_to_end(user_id)
+            values, timestamps, _ = partial
+            if queued:
+                values.setdefault(arg_name, []).append(value)
+                timestamps.setdefault(arg_name, []).append(timestamp)
+            else:
+                values[arg_name] = value
+                timestamps[arg_name] = timestamp
+
+            if len(values) < self.num_topics:
+                return None
+            del self._partials[user_id]
+            self.completed += 1
+            return values, timestamps
+
+    def _sweep(self, now: float):
+        """ Discards stale partial joins (oldest first) """
+        while self._partials:
+            partial = next(iter(self._partials.values()))
+            if now - partial[2] <= self.timeout:
+                break
+            self._partials.popitem(last=False)
+            self.expired += 1
+
+    def discard(self, user_id):
+        """ Forgets the partial join of a user (e.g. on dialog start / end) """
+        with self._lock:
+            self._partials.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._sweep(time.monotonic())
+            return {"completed": self.completed, "expired": self.expired, "evicted": self.evicted, "partials": len(self._partials)}
+
+
 GC_INTERVAL = 420 # garbabe collection interval (in seconds): 300 ~ run GC every 7 minutes
 KEEP_DATA_FOR_N_SECONDS = timedelta(seconds=300) # duration to store user data in memory (5 minutes)
 
@@ -998,6 +1379,22 @@ class _Memory:
         self.lock.release()
         return None
 
+    def get_values(self, attribute_name: str) -> List[Any]:
+        """
+        Returns the stored values for the provided attribute across all users.
+        Will not update any timestamps.
+        """
+        self.lock.acquire()
+        values = [self.mem[user_id][attribute_name] for user_id in self.mem if attribute_name in self.mem[user_id]]
+        self.lock.release()
+        return values
+
+    def num_users(self) -> int:
+        """
+        Returns the number of users with stored values.
+        """
+        return len(self.mem)
+
     def delete_values(self, user_id: str):
         """
         Will delete all values for the provided user.
@@ -1043,6 +1440,11 @@ class _MemoryPool:
             _MemoryPool.__instances[type(cls).__name__] = _Memory(lock)
         return _MemoryPool.__instances[type(cls).__name__]
     
+    @staticmethod
+    def num_users() -> Dict[str, int]:
+        """ Returns the number of users with stored values per service class """
+        return {service_type: memory.num_users() for service_type, memory in list(_MemoryPool.__instances.items())}
+
     @staticmethod
     def gc():
         while True:
@@ -1050,3 +1452,7 @@ class _MemoryPool:
             # sweep & clean memory
             for service_type in _MemoryPool.__instances:
                 _MemoryPool.__instances[service_type].gc()
+
+
+metrics.gauge("ds_resident_users", "Number of users with state in memory, per service class",
+              lambda: {(service_type,): num_users for service_type, num_users in _MemoryPool.num_users().items()}, ["service"])
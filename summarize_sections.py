@@ -1,86 +1,262 @@
-import time
-import traceback
-from elearning.moodledb import Base, MCourseSection, connect_to_moodle_db
-from sqlalchemy.orm import sessionmaker
-import re
+"""
+Shortens the (long form, HTML) summaries of the course sections with a chat completion model
+and merges them into a JSON file with the mapping: section name -> shortened summary
+(we can't rely on ID's here, because they will be different across moodle installations).
+
+Sections are read from moodle (web service, `--course ID --wstoken TOKEN`) and / or from course backups (`--mbz FILE`).
+Only sections whose cleaned summary changed since the last run are summarized again: the content hash of each summarized
+section (summary text, prompt and model) is stored next to the output file (`<output>.hashes.json`).
+Requests run concurrently (`--concurrency`), limited to `--rate` requests per second, against any OpenAI compatible
+chat completion endpoint (`--llm-url`, default: OpenAI, API key from OPENAI_API_KEY / .env), e.g. the local stub
+tools/llm_stub.py. The output file is updated after every finished summary, so an interrupted run keeps its results.
+
+Usage:
+    python summarize_sections.py --mbz course.mbz [--output resources/summarized.json] [--concurrency 4] [--rate 2]
+    MOODLE_SERVER_SSL=true python summarize_sections.py --course 2 --wstoken <token>
+    python tools/llm_stub.py --port 8090 & python summarize_sections.py --mbz course.mbz --llm-url http://localhost:8090/v1
+"""
+import argparse
+import hashlib
 import html
-from dotenv import load_dotenv
-from openai import OpenAI
 import json
+import os
+import re
+import sys
+import tarfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List
+import xml.etree.ElementTree as ET
+
+import requests
 
-# 1. Connect to DB
-session = None
-def _init_db():
-    global session
-    success = False
-    while not success:
-        try:
-            engine, conn = connect_to_moodle_db()
-            Session = sessionmaker()
-            Session.configure(bind=engine)
-            session = Session()
-            Base.metadata.create_all(engine)
-            success = True
-            print("====== SUCCESS ======")
-        except:
-            print("===== ERROR CONNECTING TO DB (Potentially have to wait for moodle setup to finish), RETRY IN 10 SECONDS ===== ")
-            traceback.print_exc()
-            time.sleep(10)
-_init_db()
-
-# 2. Loop over all sections, shortening their (long form) summaries
 
 RE_REMOVE_TAGS = re.compile('<.*?>') # summaries are in HTML format - remoe the tags to get only user-readable text
+RE_SECTION_XML = re.compile(r'^(\./)?sections/section_\d+/section\.xml$')
+SYSTEM_PROMPT = "Du bist ein Lehrer und hilfst eine Texte zu schreiben. Der Text soll kurz sein, aber trotzdem alle wichtigen Informationen enthalten."
+USER_PROMPT = "Fasse den Abschnitt {name} kurz zusammen: {summary}"
+
+
+@dataclass
+class Section:
+    name: str
+    summary: str  # text only
+
+    def is_quiz_section(self) -> bool:
+        return "quiz" in self.name.lower()
+
+    def digest(self, model: str) -> str:
+        """ Content hash of everything the shortened summary depends on """
+        content = "\n".join([model, SYSTEM_PROMPT, USER_PROMPT, self.name, self.summary])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def clean_summary(summary_html: str) -> str:
+    # remove all HMTL tags, replace escapted tokens like &nbsp;
+    return html.unescape(re.sub(RE_REMOVE_TAGS, '', summary_html or '')).strip()
+
+
+def sections_from_moodle(wstoken: str, courseid: int) -> List[Section]:
+    from elearning.moodledb import fetch_course_section_summaries
+    return [Section(name=section.name, summary=clean_summary(section.summary))
+            for section in fetch_course_section_summaries(wstoken=wstoken, courseid=courseid)]
+
+
+def sections_from_mbz(path: str) -> List[Section]:
+    """ Sections of a course backup, read from the archive stream (in course order) """
+    sections = []
+    with tarfile.open(path, 'r|gz') as archive:
+        for member in archive:
+            if member.isfile() and RE_SECTION_XML.match(member.name):
+                root = ET.fromstring(archive.extractfile(member).read())
+                name = root.find('name').text
+                summary = root.find('summary').text
+                if name is None or name == "$@NULL@$":
+                    continue
+                sections.append((int(root.find('number').text), Section(name=name, summary=clean_summary(summary if summary != "$@NULL@$" else ''))))
+    return [section for _, section in sorted(sections, key=lambda entry: entry[0])]
+
+
+class RateLimiter:
+    """ Spaces the start of requests (of all threads) at least 1 / `rate` seconds apart """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+    def pause(self, seconds: float):
+        """ Delays all further requests (e.g. the endpoint answered 429 Too Many Requests) """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class ChatCompletionClient:
+    """ Client of an OpenAI compatible chat completion endpoint (POST <base_url>/chat/completions) """
+
+    def __init__(self, base_url: str, api_key: str, model: str, limiter: RateLimiter, retries: int = 3, timeout: float = 120.0):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.model = model
+        self.limiter = limiter
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def complete(self, messages: List[dict]) -> str:
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                response = self.session.post(self.url, json={"model": self.model, "messages": messages}, headers=self.headers, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    # back off (all threads), then retry
+                    self.limiter.pause(float(response.headers.get('Retry-After', 2 ** attempt)))
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                response.raise_for_status()
+                return response.json()['choices'][0]['message']['content']
+            except (requests.RequestException, ValueError, KeyError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def summarize(self, section: Section) -> str:
+        return self.complete([
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": USER_PROMPT.format(name=section.name, summary=section.summary)}
+        ])
+
+
+class SummaryStore:
+    """
+    Output file (section name -> shortened summary) and content hashes of the summarized sections (<output>.hashes.json).
+    Both files are rewritten (atomically) after every new summary.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hash_path = path + '.hashes.json'
+        self.summaries = self._load(self.path)
+        self.hashes = self._load(self.hash_path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(path: str) -> Dict[str, str]:
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as json_file:
+            return json.load(json_file)
+
+    @staticmethod
+    def _dump(data: dict, path: str):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as json_file:
+            json.dump(data, json_file, indent=4)
+        os.replace(tmp_path, path)
+
+    def is_current(self, name: str, digest: str) -> bool:
+        return name in self.summaries and self.hashes.get(name) == digest
+
+    def put(self, name: str, summary: str, digest: str):
+        with self._lock:
+            self.summaries[name] = summary
+            self.hashes[name] = digest
+            self._dump(self.summaries, self.path)
+            self._dump(self.hashes, self.hash_path)
+
+    def prune(self, names: List[str]) -> List[str]:
+        """ Removes the summaries of all sections not in `names`, returns the removed names """
+        with self._lock:
+            removed = [name for name in self.summaries if name not in names]
+            for name in removed:
+                self.summaries.pop(name)
+                self.hashes.pop(name, None)
+            if removed:
+                self._dump(self.summaries, self.path)
+                self._dump(self.hashes, self.hash_path)
+        return removed
+
+
+def summarize_sections(sections: List[Section], store: SummaryStore, client: ChatCompletionClient, concurrency: int = 4, force: bool = False) -> dict:
+    """ Summarizes all changed content sections concurrently, returns counts of summarized / unchanged / failed sections """
+    todo = {}
+    skipped = 0
+    for section in sections:
+        if section.is_quiz_section():
+            # only look at summaries for content sections, not quiz sections
+            continue
+        digest = section.digest(client.model)
+        if section.name in todo:
+            print(f"WARNING: section name {section.name} occurs more than once, only the first section is summarized")
+        elif not force and store.is_current(section.name, digest):
+            skipped += 1
+        else:
+            todo[section.name] = (section, digest)
+
+    summarized = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(client.summarize, section): (section, digest) for section, digest in todo.values()}
+        for future in as_completed(futures):
+            section, digest = futures[future]
+            try:
+                store.put(section.name, future.result(), digest)
+                summarized += 1
+                print(f"[{summarized + failed}/{len(todo)}] {section.name}")
+            except Exception:
+                failed += 1
+                print(f"ERROR: could not summarize section {section.name}")
+                traceback.print_exc()
+    return {"summarized": summarized, "unchanged": skipped, "failed": failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="shorten the section summaries of courses with a chat completion model")
+    parser.add_argument("--mbz", nargs="*", default=[], help="course backups to read the sections from")
+    parser.add_argument("--course", type=int, nargs="*", default=[], help="ids of courses to read the sections from (moodle web service)")
+    parser.add_argument("--wstoken", help="web service token (--course)")
+    parser.add_argument("--output", default="resources/summarized.json", help="JSON file: section name -> shortened summary (merged)")
+    parser.add_argument("--llm-url", default=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"), help="OpenAI compatible API")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--concurrency", type=int, default=4, help="max. number of requests in parallel")
+    parser.add_argument("--rate", type=float, default=2.0, help="max. number of requests per second (0: unlimited)")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--force", action="store_true", help="summarize all sections, also the unchanged ones")
+    parser.add_argument("--prune", action="store_true", help="remove summaries of sections that are not part of the given courses")
+    args = parser.parse_args()
+    if not args.mbz and not args.course:
+        parser.error("no sections: use --mbz and / or --course")
+
+    try:
+        # Load environment variables (OPENAI_API_KEY) from .env file
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    sections = []
+    for path in args.mbz:
+        sections += sections_from_mbz(path)
+    for courseid in args.course:
+        sections += sections_from_moodle(args.wstoken, courseid)
+
+    store = SummaryStore(args.output)
+    client = ChatCompletionClient(args.llm_url, os.environ.get("OPENAI_API_KEY"), args.model, RateLimiter(args.rate), retries=args.retries)
+    counts = summarize_sections(sections, store, client, concurrency=args.concurrency, force=args.force)
+    if args.prune:
+        counts["removed"] = len(store.prune([section.name for section in sections]))
+    print(f"{len(store.summaries)} summaries in {args.output}: {counts}")
+    sys.exit(1 if counts["failed"] > 0 else 0)
 
-# Load environment variables from .env file
-load_dotenv()
-client = OpenAI()
-# json file with the mapping: section.name -> shortened summary
-# create json file if it doesn't exist yet
-
-data = {}
-
-for i, section in enumerate(session.query(MCourseSection).all()):
-    if section.is_quiz_section():
-        # only look at summaries for content sections, not quiz sections
-        continue
-
-    name = section.name
-    long_summary_html = section.summary
-    textonly_long_summary = html.unescape(re.sub(RE_REMOVE_TAGS, '', long_summary_html)) # remove all HMTL tags, replace escapted tokens like &nbsp;
-    
-    # debugging output: check that we actually get what we expect :)
-    #print(f"""========== Section {name} ==========
-    #      {textonly_long_summary}
-    #      """)
-    
-    # summarize textonly_long_summary using the ChatGPT API
-    # (we can't rely on ID's here, because they will be different across moodle installations)
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Du bist ein Lehrer und hilfst eine Texte zu schreiben. Der Text soll kurz sein, aber trotzdem alle wichtigen Informationen enthalten."},
-            {"role": "user", "content": "Fasse den Abschnitt " + name + " kurz zusammen: " + textonly_long_summary}
-        ]
-    )
-    
-    #print(f"""========== Section {name} ==========
-    #{textonly_long_summary}
-    #""")
-    #print(completion.choices[0].message.content)
-        
-    data[name] = completion.choices[0].message.content
-print(len(data))
-# save data to a json file with the mapping:
-# section.name -> shortened summary
-with open('summarized.json', 'w') as outfile:
-    json.dump(data, outfile, indent=4)
-print(len(data))
-        
-        
-
-   
-# 3. disconnect
-session.close()
-    
 
+if __name__ == "__main__":
+    main()
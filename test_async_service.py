@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import zmq
+
+from elearning import moodledb
+from services.async_service import AsyncService
+from services.service import CTRL_TERMINATE, DialogSystem, PublishSubscribe, _recv_msg, _send_msg, _serialize_content
+
+MOODLE_LATENCY_MS = 200
+NUM_USERS = 5
+
+
+class SettingsService(AsyncService):
+    """ Answers every request with the user's settings, fetched from moodle without blocking the event loop """
+
+    @PublishSubscribe(sub_topics=["settings_request"], pub_topics=["settings_reply"])
+    async def fetch_settings(self, user_id: int, settings_request: bool):
+        settings = await moodledb.api_call_async(wstoken="token", wsfunction="block_chatbot_get_usersettings", params=dict(userid=user_id))
+        return {"settings_reply": settings["userid"]}
+
+
+class UserSettingsHandler(tornado.web.RequestHandler):
+    """ moodle web service answering block_chatbot_get_usersettings after MOODLE_LATENCY_MS """
+
+    async def post(self):
+        await asyncio.sleep(MOODLE_LATENCY_MS / 1000.0)
+        self.write({"userid": int(self.get_body_argument("userid"))})
+
+
+@pytest.fixture
+def moodle(monkeypatch):
+    """ fake moodle web service (runs on its own event loop) """
+    ready = threading.Event()
+    stub = {}
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        sock, stub["port"] = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/webservice/rest/server.php", UserSettingsHandler)]))
+        server.add_sockets([sock])
+        stub["loop"] = asyncio.get_event_loop()
+        ready.set()
+        stub["loop"].run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    monkeypatch.setattr(moodledb, "API_ENDPOINT", f"http://127.0.0.1:{stub['port']}/webservice/rest/server.php")
+    yield
+    stub["loop"].call_soon_threadsafe(stub["loop"].stop)
+
+
+def test_async_handler_awaits_moodle(moodle):
+    ds = DialogSystem([SettingsService(protocol="inproc", ctrl_port=19403)], protocol="inproc", sub_port=19401, pub_port=19402, ctrl_port=19403)
+    replies = ds._bus.subscriber(zmq.Context.instance(), subscriptions=["settings_reply"])
+    try:
+        user_ids = list(range(1, NUM_USERS + 1))
+        assert ds.start_dialogs(user_ids) == {}
+        time.sleep(0.3)  # subscription has to reach the proxy
+        start = time.perf_counter()
+        for user_id in user_ids:
+            _send_msg(ds._control_channel_pub, "settings_request", _serialize_content(True), user_id)
+        received = {}
+        while len(received) < NUM_USERS and replies.poll(5000):
+            _, data = _recv_msg(replies)
+            received[data["user_id"]] = data["content"]
+        duration = time.perf_counter() - start
+        assert received == {user_id: user_id for user_id in user_ids}
+        # the moodle calls of all users are awaited concurrently on the service loop
+        assert duration < NUM_USERS * MOODLE_LATENCY_MS / 1000.0
+    finally:
+        replies.close()
+        ds._control_request(CTRL_TERMINATE, "default")
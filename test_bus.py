@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+import uuid
+
+import pytest
+import zmq
+
+import config
+from services.bus import BusTopology, BoundedPublisher, PublishOverflowError, PublishTimeoutError, BLOCK, DROP_OLDEST, PROXY, REJECT, SHARDED, publish_stats
+from services.service import PublishSubscribe, Service, _deserialize_content
+from utils.sysact import SysActionType
+
+
+def _topology(kind: str) -> BusTopology:
+    # inproc addresses are unique per topology, so tests don't share proxies
+    bus = BusTopology(kind=kind, protocol="inproc", host=f"bus-{uuid.uuid4().hex}",
+                      shard_families=["user_utterance", "sys_acts"])
+    bus.start_brokers()
+    return bus
+
+
+def _received(subscriber, timeout_ms: int = 200) -> list:
+    topics = []
+    while subscriber.poll(timeout_ms):
+        topics.append(subscriber.recv_multipart()[0])
+    return topics
+
+
+def _deliver(kind: str, pub_topics: list, subscriptions: list, messages: list) -> list:
+    ctx = zmq.Context.instance()
+    bus = _topology(kind)
+    publisher = bus.publisher(ctx, topics=pub_topics)
+    subscriber = bus.subscriber(ctx, subscriptions=subscriptions)
+    time.sleep(0.3)  # subscriptions have to reach the publisher
+    for topic in messages:
+        publisher.send_multipart([topic, b"{}"])
+    received = _received(subscriber)
+    publisher.close()
+    subscriber.close()
+    return received
+
+
+def test_sharded_delivers_each_message_once():
+    # GUIServer publishes user utterances and course ids, DBLoggingHandler subscribes to both
+    messages = [b"user_utterance/ELearning", b"courseid"] * 3
+    for kind in (PROXY, SHARDED):
+        received = _deliver(kind, ["user_utterance", "courseid"], ["courseid", "user_utterance"], messages)
+        assert sorted(received) == sorted(messages), kind
+
+
+def test_sharded_prefix_subscription_spans_shards():
+    # 'sys' matches the family 'sys_acts' (own shard) and 'sys_state' (default shard)
+    messages = [b"sys_acts/ELearning", b"sys_state/ELearning", b"beliefstate"]
+    received = _deliver(SHARDED, ["sys_acts", "sys_state", "beliefstate"], ["sys"], messages)
+    assert sorted(received) == [b"sys_acts/ELearning", b"sys_state/ELearning"]
+
+
+def test_subscription_shards():
+    bus = BusTopology(kind=SHARDED, shard_families=["user_utterance", "sys_acts"])
+    # shards: 0 user_utterance, 1 sys_acts, 2 control, 3 default
+    assert bus._subscription_shards(["user_utterance"]) == [0]
+    assert bus._subscription_shards(["sys"]) == [1, 3]
+    assert bus._subscription_shards(["courseid", "sys_acts"]) == [1, 3]
+    assert bus._subscription_shards([""]) == [0, 1, 3]
+
+
+def test_slow_subscriber_does_not_stall_proxy(monkeypatch):
+    monkeypatch.setattr(config, "DS_BUS_HWM", 10)
+    ctx = zmq.Context.instance()
+    bus = _topology(PROXY)
+    publisher = BoundedPublisher(bus.publisher(ctx, topics=["sys_acts"], hwm=10), policy=BLOCK, block_timeout=1.0)
+    slow = bus.subscriber(ctx, subscriptions=["sys_acts"])  # never receives
+    fast = bus.subscriber(ctx, subscriptions=["sys_acts"])
+    time.sleep(0.3)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(_received(fast, timeout_ms=500)))
+    reader.start()
+    for idx in range(200):
+        publisher.send_multipart([b"sys_acts/ELearning", bytes(str(idx), encoding="ascii")])
+    reader.join()
+    assert len(received) == 200
+    for socket in (publisher, slow, fast):
+        socket.close()
+
+
+class FakeSocket:
+    """ PUB socket with a send queue of `capacity` messages (raises zmq.Again like a full XPUB_NODROP socket) """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.sent = []
+
+    def send_multipart(self, frames, flags: int = 0, copy: bool = True):
+        if len(self.sent) >= self.capacity:
+            raise zmq.Again()
+        self.sent.append(frames)
+
+    def close(self):
+        pass
+
+
+def test_bounded_publisher_reject():
+    socket = FakeSocket(capacity=2)
+    publisher = BoundedPublisher(socket, policy=REJECT)
+    publisher.send_multipart([b"test_reject", b"1"])
+    publisher.send_multipart([b"test_reject", b"2"])
+    with pytest.raises(PublishOverflowError):
+        publisher.send_multipart([b"test_reject", b"3"])
+    assert len(socket.sent) == 2
+    assert publish_stats()["test_reject"]["rejected"] == 1
+
+
+def test_bounded_publisher_drop_oldest():
+    socket = FakeSocket(capacity=1)
+    publisher = BoundedPublisher(socket, policy=DROP_OLDEST, buffer_size=2)
+    for idx in range(4):
+        publisher.send_multipart([b"test_drop_oldest", bytes([idx])])
+    # message 0 was sent, 1 was dropped, 2 and 3 wait for space
+    assert publish_stats()["test_drop_oldest"]["dropped"] == 1
+    socket.capacity = 10
+    assert publisher.flush()
+    assert [frames[1] for frames in socket.sent] == [bytes([0]), bytes([2]), bytes([3])]
+    assert publish_stats()["test_drop_oldest"]["queued"] == 0
+
+
+def test_bounded_publisher_block_timeout():
+    socket = FakeSocket(capacity=0)
+    publisher = BoundedPublisher(socket, policy=BLOCK, block_timeout=0.05)
+    with pytest.raises(PublishTimeoutError):
+        publisher.send_multipart([b"test_block", b"1"])
+    stats = publish_stats()["test_block"]
+    assert stats["timed_out"] == 1 and stats["dropped"] == 0 and stats["blocked_seconds"] >= 0.05
+
+
+def test_block_timeout_sends_error_act():
+    class Publisher(Service):
+        @PublishSubscribe(pub_topics=["sys_state"])
+        def publish_state(self, user_id):
+            return {"sys_state": "state"}
+
+    service = Publisher(domain="ELearning")
+    service._publish_sockets[service.publish_state] = BoundedPublisher(FakeSocket(capacity=0), policy=BLOCK, block_timeout=0.01)
+    service._overflow_error_pub = FakeSocket(capacity=10)
+    service.publish_state(user_id=1)
+    topic, body = service._overflow_error_pub.sent[0]
+    assert bytes(topic) == b"sys_acts/ELearning"
+    assert json.loads(bytes(body))["user_id"] == 1
+
+
+def test_overflow_error_act_reaches_domain():
+    class Publisher(Service):
+        pass
+
+    service = Publisher(domain="")
+    service._overflow_error_pub = FakeSocket(capacity=10)
+    service._send_overflow_error(1, b"user_utterance/ELearning")
+    topic, body = service._overflow_error_pub.sent[0]
+    assert bytes(topic) == b"sys_acts/ELearning"
+    sys_acts = _deserialize_content(json.loads(bytes(body))["content"])
+    assert isinstance(sys_acts, list) and sys_acts[0].type == SysActionType.Bad
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from elearning import coursecache
+from elearning.coursecache import CONTENT_LINK, H5P_QUIZ, SECTION, CourseCache
+
+
+class Loader:
+    """ replaces the moodle webservice calls of the cache, counts the calls per key """
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.module_types = {5: "book", 6: "h5pactivity"}
+
+    def course_modules(self, wstoken, courseid):
+        with self.lock:
+            self.calls.append(("course_modules", courseid))
+        return self.module_types
+
+    def __call__(self, kind):
+        def load(wstoken, key):
+            with self.lock:
+                self.calls.append((kind, key))
+            return f"{kind}-{key}"
+        return load
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    loader = Loader()
+    monkeypatch.setattr(coursecache, "_LOADERS", {kind: loader(kind) for kind in coursecache._LOADERS})
+    monkeypatch.setattr(coursecache, "_COURSE_MODULES_LOADER", loader.course_modules)
+    monkeypatch.setattr(coursecache.moodledb.moodle_health, "is_down", lambda: False)
+    return loader
+
+
+def _wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_first_access_warms_all_course_modules(loader):
+    cache = CourseCache(ttl=60.0)
+    assert cache.get("token", 2, CONTENT_LINK, 5) == "content_link-5"
+    # the warmup may also fetch the content link of module 5 again, if it runs before the lookup stored it
+    _wait_for(lambda: cache.warmed >= 4)
+    assert {("course_modules", 2), (SECTION, 5), (CONTENT_LINK, 6), (SECTION, 6), (H5P_QUIZ, 6)} <= set(loader.calls)
+    cache.get("token", 2, H5P_QUIZ, 6)
+    assert cache.hits == 1
+
+
+def test_hits_share_course_ids(loader):
+    cache = CourseCache(ttl=60.0, first_access_warmup=False)
+    cache.get("token", 2, CONTENT_LINK, 5)
+    # course ids of moodle events are strings
+    cache.get("token-of-other-user", "2", CONTENT_LINK, 5)
+    assert loader.calls == [(CONTENT_LINK, 5)]
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.stats()["courses"] == 1
+
+
+def test_module_event_drops_module_entries(loader):
+    cache = CourseCache(ttl=60.0, first_access_warmup=False)
+    cache.get("token", 2, CONTENT_LINK, 5)
+    cache.get("token", 2, SECTION, 6)
+    cache.handle_event({"eventname": "\\core\\event\\course_module_updated", "courseid": "2", "objectid": "5"})
+    cache.get("token", 2, CONTENT_LINK, 5)
+    cache.get("token", 2, SECTION, 6)
+    assert loader.calls == [(CONTENT_LINK, 5), (SECTION, 6), (CONTENT_LINK, 5)]
+
+
+def test_event_keyed_lookups_share_entries(loader):
+    # the policy looks up the section of the course module of a completion event (ids as strings)
+    cache = CourseCache(ttl=60.0, first_access_warmup=False)
+    cache.warmup("token", 2, cmids=[5])
+    _wait_for(lambda: cache.warmed == 2)
+    assert cache.get("token", "2", SECTION, "5") == "section-5"
+    assert cache.hits == 1
+    cache.handle_event({"eventname": "\\core\\event\\course_module_updated", "courseid": "2", "objectid": "5"})
+    cache.get("token", "2", SECTION, "5")
+    assert loader.calls.count((SECTION, 5)) == 2
+    assert cache.get("token", 2, SECTION, 5) == "section-5"
+    assert cache.hits == 2
+
+
+def test_course_event_rewarms_cached_keys(loader):
+    cache = CourseCache(ttl=60.0, warmup_workers=2, first_access_warmup=False)
+    cache.get("token", 2, CONTENT_LINK, 5)
+    cache.get("token", 2, SECTION, 6)
+    cache.handle_event({"eventname": "\\core\\event\\course_updated", "courseid": 2})
+    assert cache.stats()["courses"] == 0
+    # next access starts the warmup of the keys cached before
+    cache.get("token", 2, CONTENT_LINK, 7)
+    _wait_for(lambda: cache.warmed == 2)
+    calls = len(loader.calls)
+    cache.get("token", 2, SECTION, 6)
+    assert len(loader.calls) == calls
+
+
+def test_expired_course_is_dropped(loader):
+    cache = CourseCache(ttl=0.05, first_access_warmup=False)
+    cache.get("token", 2, CONTENT_LINK, 5)
+    time.sleep(0.1)
+    cache.get("token", 2, CONTENT_LINK, 8)
+    assert cache.invalidations == 1
+
+
+def test_warmup(loader):
+    cache = CourseCache(ttl=60.0)
+    cache.warmup("token", "2", cmids=[1, 2], h5p_cmids=[2])
+    _wait_for(lambda: cache.warmed == 5)
+    cache.get("token", 2, CONTENT_LINK, 1)
+    assert cache.hits == 1
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from elearning import coursegraph, moodledb
+from elearning.coursegraph import COMPLETION_UPDATED_EVENT, CourseGraph, CourseNavigator
+
+
+# two sections with a book and two h5p quizzes each, the second quiz of section 11 is hidden
+GRAPH = {
+    "courseid": 2,
+    "sections": [
+        {"id": 10, "section": 1, "name": "Thema A", "branch": "A", "modules": [1, 2, 3]},
+        {"id": 11, "section": 2, "name": "Thema B", "branch": "B", "modules": [4, 5, 6]},
+        {"id": 12, "section": 3, "name": "Versteckt", "branch": "C", "visible": False, "modules": [7]},
+    ],
+    "modules": {
+        "1": {"type": "book", "name": "Buch A"},
+        "2": {"type": "h5pactivity", "name": "Quiz A1"},
+        "3": {"type": "h5pactivity", "name": "Quiz A2"},
+        "4": {"type": "book", "name": "Buch B"},
+        "5": {"type": "h5pactivity", "name": "Quiz B1"},
+        "6": {"type": "h5pactivity", "name": "Quiz B2", "visible": False},
+        "7": {"type": "h5pactivity", "name": "Quiz C1"},
+    },
+}
+
+
+@pytest.fixture
+def graph() -> CourseGraph:
+    return CourseGraph.from_dict(GRAPH)
+
+
+def test_next_module_stays_in_section(graph):
+    assert graph.next_module(2, ["h5pactivity"], set()) == 3
+    # last quiz of the section: no quiz of the next section
+    assert graph.next_module(3, ["h5pactivity"], set()) is None
+    # hidden modules are skipped
+    assert graph.next_module(5, ["h5pactivity"], set()) is None
+    assert graph.next_module(1, ["h5pactivity"], {2}, allow_only_unfinished=True) == 3
+    assert graph.next_module(1, ["h5pactivity"], {2, 3}, allow_only_unfinished=True) is None
+    assert graph.next_module(99, ["h5pactivity"], set()) is None
+
+
+def test_first_module(graph):
+    assert graph.first_module(10, ["h5pactivity"], set()) == 2
+    assert graph.first_module(10, ["h5pactivity"], {2}, allow_only_unfinished=True) == 3
+    assert graph.first_module(12, ["h5pactivity"], set()) is None
+
+
+def test_new_sections(graph):
+    assert [section.id for section in graph.new_sections(set())] == [10, 11]
+    sections = graph.new_sections({2})
+    assert [(section.id, section.firstcmid) for section in sections] == [(11, 4)]
+
+
+@pytest.fixture
+def navigator(tmp_path, monkeypatch):
+    with open(tmp_path / "course_2.json", "w") as graph_file:
+        json.dump(GRAPH, graph_file)
+    navigator = CourseNavigator(graph_dir=str(tmp_path), completion_ttl=60.0, verify_rate=0.0)
+    monkeypatch.setattr(coursegraph, "course_navigator", navigator)
+    monkeypatch.setattr(coursegraph.course_cache, "warmup", lambda *args, **kwargs: None)
+    fetches = []
+
+    def completionstates(wstoken, userid, courseid):
+        fetches.append((userid, courseid))
+        return {2: 1, 3: 0}
+    monkeypatch.setattr(moodledb, "fetch_course_module_completionstates", completionstates)
+    navigator.fetches = fetches
+    return navigator
+
+
+def test_navigator_reuses_completion_states(navigator):
+    assert coursegraph.fetch_next_available_course_module_id("token", 5, "2", 1, "h5pactivity", allow_only_unfinished=True) == 3
+    assert coursegraph.fetch_first_available_course_module_id("token", 5, 2, 11, "h5pactivity", allow_only_unfinished=True) == 5
+    assert navigator.fetches == [(5, 2)]
+    assert navigator.local_lookups == 2
+
+    # a completion event (ids as strings) drops the cached states of the user
+    navigator.handle_event({"eventname": COMPLETION_UPDATED_EVENT, "userid": "5", "courseid": "2"})
+    coursegraph.fetch_available_new_course_section_ids("token", 5, 2)
+    assert navigator.fetches == [(5, 2), (5, 2)]
+
+
+def test_navigator_normalises_course_id(navigator):
+    assert navigator.graph("2") is navigator.graph(2)
+    assert navigator.graph(3) is None
+
+
+def test_navigator_verifies_lookups_with_moodle(navigator, monkeypatch):
+    navigator.verify_rate = 1.0
+    moodle_next = {3: None}
+    monkeypatch.setattr(moodledb, "fetch_next_available_course_module_id", lambda current_cmid, **kwargs: moodle_next[current_cmid])
+    monkeypatch.setattr(moodledb, "fetch_first_available_course_module_id", lambda sectionid, **kwargs: 5)
+    assert coursegraph.fetch_next_available_course_module_id("token", 5, 2, 3, "h5pactivity") is None
+    assert coursegraph.fetch_first_available_course_module_id("token", 5, 2, 11, "h5pactivity") == 5
+    assert navigator.verified == 2 and navigator.mismatches == {}
+
+    # moodle knows better (e.g. a module restricted for the user): its answer is used and the difference counted
+    moodle_next[3] = 4
+    assert coursegraph.fetch_next_available_course_module_id("token", 5, 2, 3, "book") == 4
+    assert navigator.mismatches == {"next_module": 1}
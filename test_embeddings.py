@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+from sentence_transformers import util
+
+import embeddings
+
+
+class FakeEmbedder:
+    """ Deterministic random embedding per sentence (and model name), counts the encoded sentences """
+
+    class _Module:
+        def __init__(self, name):
+            self.auto_model = type("AutoModel", (), {"config": type("Config", (), {"_name_or_path": name})})
+
+    def __init__(self, name: str = "fake-model", dim: int = 8):
+        self.name = name
+        self.dim = dim
+        self.device = torch.device("cpu")
+        self.encoded = 0
+
+    def __getitem__(self, idx):
+        return FakeEmbedder._Module(self.name)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, convert_to_tensor=True):
+        self.encoded += len(sentences)
+        return torch.stack([self._vector(random.Random(f"{self.name}/{sentence}")) for sentence in sentences])
+
+    def _vector(self, rng):
+        return torch.tensor([rng.gauss(0, 1) for _ in range(self.dim)])
+
+
+CORPUS = [
+    ("Hello", ["Hallo", "Hi", "Guten Tag", "Moin"]),
+    ("RequestHelp", ["Hilfe", "Ich brauche Hilfe", "Hi"]),  # "Hi" belongs to two informs
+    ("RequestProgress", ["Wie weit bin ich", "Mein Fortschritt", "Fortschritt bitte"]),
+]
+
+
+def _baseline_within(embedder, corpus_per_inform):
+    scores = []
+    for inform in corpus_per_inform:
+        for sentence in inform[1]:
+            corpus_test = inform[1].copy()
+            corpus_test.remove(sentence)
+            cos_scores = util.cos_sim(embedder.encode([sentence]), embedder.encode(corpus_test))[0]
+            scores.append(torch.max(cos_scores).item())
+    return scores
+
+
+def _baseline_across(embedder, corpus_per_inform, corpus_full):
+    scores = []
+    for inform in corpus_per_inform:
+        corpus_test = corpus_full.copy()
+        for sentence in inform[1]:
+            corpus_test.remove(sentence)
+        for sentence in inform[1]:
+            cos_scores = util.cos_sim(embedder.encode([sentence]), embedder.encode(corpus_test))[0]
+            scores.append(torch.max(cos_scores).item())
+    return scores
+
+
+def test_leave_one_out_matches_baseline():
+    embedder = FakeEmbedder()
+    scores = embeddings.cross_validation(CORPUS, embedder=embedder, cache_path=None)
+    assert scores.tolist() == pytest.approx(_baseline_within(FakeEmbedder(), CORPUS), abs=1e-5)
+    assert embedder.encoded == 9  # distinct sentences
+
+
+def test_leave_one_inform_out_matches_baseline():
+    corpus = [(name, [sentence for sentence in sentences if name == "Hello" or sentence != "Hi"]) for name, sentences in CORPUS]
+    corpus_full = [sentence for _, sentences in corpus for sentence in sentences] + ["Danke"]
+    scores = embeddings.cross_validation_across_informs(corpus, corpus_full, embedder=FakeEmbedder(), cache_path=None)
+    assert scores.tolist() == pytest.approx(_baseline_across(FakeEmbedder(), corpus, corpus_full), abs=1e-5)
+
+
+def test_leave_one_inform_out_masks_all_informs_of_a_sentence():
+    # "Hi" is part of two informs (and twice in the full corpus): it must not match itself for either of them
+    corpus_full = [sentence for _, sentences in CORPUS for sentence in sentences] + ["Danke"]
+    scores = embeddings.cross_validation_across_informs(CORPUS, corpus_full, embedder=FakeEmbedder(), cache_path=None).tolist()
+    embedder = FakeEmbedder()
+    for position in (1, 6):  # "Hi" in Hello, "Hi" in RequestHelp
+        inform = CORPUS[0][1] if position == 1 else CORPUS[1][1]
+        allowed = [sentence for sentence in corpus_full if sentence not in inform and sentence != "Hi"]
+        expected = torch.max(util.cos_sim(embedder.encode(["Hi"]), embedder.encode(allowed))[0]).item()
+        assert scores[position] == pytest.approx(expected, abs=1e-5)
+    assert max(scores) < 0.9999
+
+
+def test_cache_is_kept_per_model(tmp_path):
+    cache_path = str(tmp_path / "embeddings.pt")
+    sentences = ["Hallo", "Hilfe"]
+    first = FakeEmbedder()
+    expected = embeddings.encode_once(first, sentences, cache_path)
+    again = FakeEmbedder()
+    assert torch.equal(embeddings.encode_once(again, sentences + ["Hallo"], cache_path), torch.cat([expected, expected[:1]]))
+    assert again.encoded == 0
+    # another model (or dimension) does not use the cached embeddings
+    other = FakeEmbedder(name="other-model", dim=4)
+    assert embeddings.encode_once(other, sentences, cache_path).shape == (2, 4)
+    assert other.encoded == 2
+
+
+def test_masked_nearest_neighbours_without_candidates():
+    vectors = torch.eye(3)
+    scores, indices = embeddings.masked_nearest_neighbours(vectors, vectors, [0, 1, 1], [0, 1, 1], same_group=True, exclude_self=True, batch_size=2)
+    assert scores[0] == float("-inf") and indices[0] == -1
+    assert indices[1:].tolist() == [2, 1]
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from elearning.eventqueue import COMPLETION_UPDATED_EVENT, MoodleEventQueue, validate_event
+
+
+VIEWED_EVENT = "\\mod_book\\event\\course_module_viewed"
+
+
+class Recorder:
+    """ publish function of the queue, records (user id, event) """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, user_id: int, event: dict):
+        with self.lock:
+            self.events.append((user_id, event))
+
+
+def _event(userid, eventname=VIEWED_EVENT, cmid=1, **fields) -> dict:
+    return dict(userid=userid, eventname=eventname, contextinstanceid=cmid, **fields)
+
+
+def _wait_idle(event_queue: MoodleEventQueue, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while event_queue.pending() > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert event_queue.pending() == 0
+
+
+def test_publishes_in_order():
+    recorder = Recorder()
+    event_queue = MoodleEventQueue(publish=recorder, debounce_window=0)
+    events = [_event(userid=idx % 3, seq=idx) for idx in range(20)]
+    assert event_queue.offer(events)
+    _wait_idle(event_queue)
+    assert [event["seq"] for _, event in recorder.events] == list(range(20))
+    assert event_queue.published == 20
+
+
+def test_rejects_batch_when_full():
+    blocked = threading.Event()
+    event_queue = MoodleEventQueue(publish=lambda user_id, event: blocked.wait(), max_pending=3, debounce_window=0)
+    assert event_queue.offer([_event(1), _event(1)])
+    assert not event_queue.offer([_event(1), _event(1)])
+    assert event_queue.rejected == 2
+    blocked.set()
+    _wait_idle(event_queue)
+
+
+@pytest.mark.parametrize("event", [
+    {"userid": 1, "eventname": None},
+    {"userid": "abc", "eventname": VIEWED_EVENT},
+    {"eventname": VIEWED_EVENT},
+    ["not", "an", "event"],
+])
+def test_malformed_event_does_not_stop_worker(event):
+    recorder = Recorder()
+    event_queue = MoodleEventQueue(publish=recorder, debounce_window=0)
+    with pytest.raises(ValueError):
+        validate_event(event)
+    assert event_queue.offer([event, _event(userid=2)])
+    _wait_idle(event_queue)
+    assert recorder.events == [(2, _event(userid=2))]
+    assert event_queue.failed == 1
+
+
+def test_debounces_completion_bursts():
+    recorder = Recorder()
+    event_queue = MoodleEventQueue(publish=recorder, debounce_window=0.1, max_debounce_delay=1.0)
+    burst = [_event(userid=1, eventname=COMPLETION_UPDATED_EVENT, cmid=5, state=state) for state in range(5)]
+    assert event_queue.offer(burst + [_event(userid=2, eventname=COMPLETION_UPDATED_EVENT, cmid=5)])
+    _wait_idle(event_queue)
+    assert sorted((user_id, event.get("state")) for user_id, event in recorder.events) == [(1, 4), (2, None)]
+    assert event_queue.coalesced == 4
+
+
+def test_other_event_of_user_flushes_held_completion():
+    recorder = Recorder()
+    event_queue = MoodleEventQueue(publish=recorder, debounce_window=10.0, max_debounce_delay=10.0)
+    completion = _event(userid=1, eventname=COMPLETION_UPDATED_EVENT, cmid=5)
+    viewed = _event(userid=1, cmid=6)
+    assert event_queue.offer([completion, viewed])
+    _wait_idle(event_queue, timeout=2.0)
+    assert recorder.events == [(1, completion), (1, viewed)]
@@ -0,0 +1,36 @@
+from collections import Counter
+
+import pytest
+
+from utils.hashring import ConsistentHashRing
+
+
+def test_assignment_is_stable():
+    ring = ConsistentHashRing(nodes=[0, 1, 2])
+    other = ConsistentHashRing(nodes=[2, 0, 1])
+    assert all(ring.get_node(user_id) == other.get_node(user_id) for user_id in range(1000))
+    # user ids arrive as int (websocket) and as str (moodle events)
+    assert all(ring.get_node(user_id) == ring.get_node(str(user_id)) for user_id in range(100))
+
+
+def test_keys_are_spread():
+    ring = ConsistentHashRing(nodes=[0, 1, 2, 3])
+    counts = Counter(ring.get_node(user_id) for user_id in range(4000))
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 500
+
+
+def test_only_keys_of_changed_node_move():
+    ring = ConsistentHashRing(nodes=[0, 1, 2])
+    before = {user_id: ring.get_node(user_id) for user_id in range(1000)}
+    ring.add_node(3)
+    after = {user_id: ring.get_node(user_id) for user_id in range(1000)}
+    assert all(after[user_id] in (before[user_id], 3) for user_id in before)
+    ring.remove_node(3)
+    assert {user_id: ring.get_node(user_id) for user_id in range(1000)} == before
+
+
+def test_empty_ring():
+    ring = ConsistentHashRing()
+    with pytest.raises(AssertionError):
+        ring.get_node(1)
@@ -0,0 +1,65 @@
+import time
+
+from services.service import _JoinBuffer
+
+
+def test_join_completes_when_all_topics_arrived():
+    join_buffer = _JoinBuffer(num_topics=2)
+    assert join_buffer.add(1, False, "user_acts", "a", 1.0) is None
+    # newer value of the same topic replaces the older one
+    assert join_buffer.add(1, False, "user_acts", "b", 2.0) is None
+    values, timestamps = join_buffer.add(1, False, "beliefstate", "c", 3.0)
+    assert values == {"user_acts": "b", "beliefstate": "c"}
+    assert timestamps == {"user_acts": 2.0, "beliefstate": 3.0}
+    assert join_buffer.stats() == {"completed": 1, "expired": 0, "evicted": 0, "partials": 0}
+
+
+def test_queued_topic_collects_values():
+    join_buffer = _JoinBuffer(num_topics=2)
+    join_buffer.add(1, True, "sys_utterance", "a", 1.0)
+    join_buffer.add(1, True, "sys_utterance", "b", 2.0)
+    values, _ = join_buffer.add(1, False, "user_id", 1, 3.0)
+    assert values["sys_utterance"] == ["a", "b"]
+
+
+def test_users_are_joined_separately():
+    join_buffer = _JoinBuffer(num_topics=2)
+    join_buffer.add(1, False, "x", 1, 1.0)
+    assert join_buffer.add(2, False, "y", 2, 1.0) is None
+    assert join_buffer.add(1, False, "y", 3, 1.0) == ({"x": 1, "y": 3}, {"x": 1.0, "y": 1.0})
+    assert join_buffer.stats()["partials"] == 1
+
+
+def test_stale_partials_expire():
+    join_buffer = _JoinBuffer(num_topics=2, timeout=0.05)
+    join_buffer.add(1, False, "x", 1, 1.0)
+    time.sleep(0.1)
+    # the partial of user 1 expired, so this value starts a new join
+    assert join_buffer.add(1, False, "y", 2, 2.0) is None
+    assert join_buffer.stats()["expired"] == 1
+
+
+def test_latest_policy_refreshes_partials():
+    join_buffer = _JoinBuffer(num_topics=3, timeout=0.15, stale_policy="latest")
+    join_buffer.add(1, False, "x", 1, 1.0)
+    time.sleep(0.1)
+    join_buffer.add(1, False, "y", 2, 2.0)
+    time.sleep(0.1)
+    assert join_buffer.add(1, False, "z", 3, 3.0) is not None
+
+
+def test_oldest_partial_is_evicted():
+    join_buffer = _JoinBuffer(num_topics=2, max_partials=2)
+    for user_id in range(3):
+        join_buffer.add(user_id, False, "x", user_id, 1.0)
+    assert join_buffer.stats()["evicted"] == 1
+    # user 0 was evicted
+    assert join_buffer.add(0, False, "y", 0, 1.0) is None
+    assert join_buffer.add(2, False, "y", 2, 1.0) is not None
+
+
+def test_discard():
+    join_buffer = _JoinBuffer(num_topics=2)
+    join_buffer.add(1, False, "x", 1, 1.0)
+    join_buffer.discard(1)
+    assert join_buffer.add(1, False, "y", 2, 2.0) is None
@@ -0,0 +1,79 @@
+import json
+
+from services.hci.outbox import DROP_NEWEST, DROP_OLDEST, WebsocketOutbox
+
+
+class FakeWebsocket:
+    def __init__(self, closed: bool = False):
+        self.closed = closed
+        self.frames = []
+
+    def write_message(self, message: str):
+        if self.closed:
+            raise RuntimeError("websocket closed")
+        self.frames.append(json.loads(message))
+
+
+def _outbox(**kwargs) -> WebsocketOutbox:
+    # writes run immediately instead of on the IO loop
+    return WebsocketOutbox(schedule=lambda func, *args: func(*args), **kwargs)
+
+
+def _message(content: str) -> dict:
+    return {"content": content, "format": "text", "party": "system"}
+
+
+def test_turn_is_one_frame():
+    outbox = _outbox()
+    websocket = FakeWebsocket()
+    outbox.attach(websocket)
+    outbox.send([_message("a"), _message("b")])
+    assert websocket.frames == [[_message("a"), _message("b")]]
+    assert outbox.stats()["frames"] == 1 and outbox.stats()["delivered"] == 2
+
+
+def test_buffers_while_detached_and_flushes_on_attach():
+    outbox = _outbox()
+    outbox.send([_message("a")])
+    outbox.send([_message("b")])
+    # control messages are not buffered
+    outbox.send([_message("control")], buffer_offline=False)
+    assert outbox.occupancy() == 2
+    websocket = FakeWebsocket()
+    outbox.attach(websocket)
+    assert websocket.frames == [[_message("a"), _message("b")]]
+    assert outbox.occupancy() == 0
+
+
+def test_drop_policies():
+    for policy, kept in ((DROP_OLDEST, ["c", "d"]), (DROP_NEWEST, ["a", "b"])):
+        outbox = _outbox(max_buffered=2, drop_policy=policy)
+        outbox.send([_message(content) for content in "abcd"])
+        websocket = FakeWebsocket()
+        outbox.attach(websocket)
+        assert [message["content"] for message in websocket.frames[0]] == kept
+        assert outbox.stats()["dropped"] == 2
+
+
+def test_failed_write_keeps_messages():
+    outbox = _outbox()
+    closed = FakeWebsocket(closed=True)
+    outbox.attach(closed)
+    outbox.send([_message("a")])
+    assert outbox.occupancy() == 1
+    # only the websocket that is attached can be detached
+    outbox.detach(FakeWebsocket())
+    websocket = FakeWebsocket()
+    outbox.attach(websocket)
+    outbox.detach(closed)
+    outbox.send([_message("b")])
+    assert websocket.frames == [[_message("a")], [_message("b")]]
+
+
+def test_turn_latency_callback():
+    latencies = []
+    outbox = _outbox(on_turn_delivered=latencies.append)
+    outbox.attach(FakeWebsocket())
+    outbox.send([_message("a")], turn_started=0.0)
+    outbox.send([_message("b")])
+    assert len(latencies) == 1 and latencies[0] > 0
@@ -0,0 +1,28 @@
+import pytest
+
+from services.bus import BusTopology
+from services.service import PublishSubscribe, Service
+from utils import profiling
+
+
+class ProfiledService(Service):
+    @PublishSubscribe(sub_topics=["user_utterance"], pub_topics=["user_acts"])
+    def extract_user_acts(self, user_id, user_utterance):
+        return {"user_acts": user_utterance}
+
+
+def test_start_rejects_unknown_targets(tmp_path):
+    service = ProfiledService(protocol="inproc")
+    service._bus = BusTopology(protocol="inproc", host="profiling-test")
+    service._init_pubsub()
+    assert "ProfiledService.extract_user_acts" in profiling.status()["targets"]
+
+    # misspelled function: the session would never see a call
+    with pytest.raises(ValueError):
+        profiling.start("ProfiledService.extract_user_act", calls=1)
+    assert profiling.session("ProfiledService.extract_user_act") is None
+
+    session = profiling.start("ProfiledService.extract_user_acts", calls=1)
+    session.output_dir = str(tmp_path)
+    assert profiling.session("ProfiledService.extract_user_acts") is session
+    profiling.stop("ProfiledService.extract_user_acts")
@@ -0,0 +1,53 @@
+import pytest
+
+from services.service import CTRL_TERMINATE, DialogSystem, PublishSubscribe, Service
+
+USER_ID = 7
+
+
+class SettingsPolicy(Service):
+    """ Like ELearningPolicy: the first `dialog_start` can't fetch the settings and only logs the error """
+
+    def __init__(self, raise_error: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.raise_error = raise_error
+        self.starts = 0
+
+    def dialog_start(self, user_id):
+        self.starts += 1
+        if self.starts == 1:
+            if self.raise_error:
+                raise ConnectionError("moodle not reachable")
+            return
+        self.set_state(user_id, "settings", {"enabled": True})
+
+    def dialog_started(self, user_id) -> bool:
+        return self.get_state(user_id, "settings") is not None
+
+    @PublishSubscribe(sub_topics=["user_utterance"], pub_topics=["sys_acts"])
+    def choose_sys_act(self, user_id, user_utterance):
+        return {"sys_acts": user_utterance}
+
+
+@pytest.fixture
+def dialog_system(request):
+    # one address set per test (inproc), the ports only name the endpoints
+    port = 19500 + 10 * request.param
+    policy = SettingsPolicy(raise_error=request.param == 1, protocol="inproc", ctrl_port=port + 2)
+    ds = DialogSystem([policy], protocol="inproc", sub_port=port, pub_port=port + 1, ctrl_port=port + 2)
+    yield ds, policy
+    ds._control_request(CTRL_TERMINATE, "default")
+
+
+@pytest.mark.parametrize("dialog_system", [0, 1], indirect=True, ids=["silent_failure", "exception"])
+def test_failed_start_is_not_resumed(dialog_system):
+    ds, policy = dialog_system
+    assert not ds.resume_dialog(USER_ID)
+    ds.start_dialogs([USER_ID])
+    # the start failed: the next connect has to do the full start again
+    assert not ds.resume_dialog(USER_ID)
+    assert ds.start_dialogs([USER_ID]) == {}
+    assert policy.starts == 2
+    assert ds.resume_dialog(USER_ID)
+    ds.end_dialogs([USER_ID])
+    assert not ds.resume_dialog(USER_ID)
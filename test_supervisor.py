@@ -0,0 +1,43 @@
+import pytest
+import tornado.web
+
+import run_supervisor
+from run_supervisor import merge_metrics, worker_argument
+
+WORKER_0 = """# HELP ds_requests_total handled requests
+# TYPE ds_requests_total counter
+ds_requests_total{topic="user_acts"} 3.0
+ds_uptime 12.5
+"""
+
+WORKER_1 = """# HELP ds_requests_total handled requests
+# TYPE ds_requests_total counter
+ds_requests_total{topic="user_acts"} 4.0
+"""
+
+
+def test_merge_metrics_labels_samples_with_worker():
+    merged = merge_metrics({0: WORKER_0, 1: WORKER_1}).splitlines()
+    assert merged == [
+        "# HELP ds_requests_total handled requests",
+        "# TYPE ds_requests_total counter",
+        'ds_requests_total{worker="0",topic="user_acts"} 3.0',
+        'ds_requests_total{worker="1",topic="user_acts"} 4.0',
+        'ds_uptime{worker="0"} 12.5',
+    ]
+
+
+class _Handler:
+    def __init__(self, worker):
+        self.worker = worker
+
+    def get_argument(self, name, default=None):
+        return self.worker if self.worker is not None else default
+
+
+def test_worker_argument():
+    assert worker_argument(_Handler(None)) is None
+    assert worker_argument(_Handler("0")) is run_supervisor.workers[0]
+    for invalid in ("-1", "x", str(len(run_supervisor.workers))):
+        with pytest.raises(tornado.web.HTTPError):
+            worker_argument(_Handler(invalid))
@@ -0,0 +1,94 @@
+import time
+
+import pytest
+import requests
+
+from elearning import tokencache
+from elearning.moodledb import MoodleHealth
+from elearning.tokencache import InvalidTokenError, MoodleUnavailableError, TokenValidationCache, validate_token
+
+
+def test_cache_lookup_and_expiry():
+    cache = TokenValidationCache(ttl=0.05, negative_ttl=60.0)
+    assert cache.lookup(1, "token") is None
+    cache.store(1, "token", True)
+    cache.store(2, "bad", False)
+    assert cache.lookup(1, "token") is True
+    assert cache.lookup(2, "bad") is False
+    # other token of the same user is not trusted
+    assert cache.lookup(1, "other") is None
+    time.sleep(0.1)
+    assert cache.lookup(1, "token") is None
+    assert cache.stats() == {"entries": 1, "hits": 2, "misses": 3}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TokenValidationCache(max_entries=2)
+    cache.store(1, "a", True)
+    cache.store(2, "b", True)
+    cache.lookup(1, "a")
+    cache.store(3, "c", True)
+    assert cache.lookup(2, "b") is None
+    assert cache.lookup(1, "a") is True
+
+
+def test_moodle_health():
+    health = MoodleHealth(failure_threshold=2, retry_interval=0.05)
+    health.record_failure()
+    assert not health.is_down()
+    health.record_failure()
+    assert health.is_down()
+    # after the retry interval, the next call may probe moodle again
+    time.sleep(0.1)
+    assert not health.is_down()
+    health.record_failure()
+    assert health.is_down()
+    health.record_success()
+    assert not health.is_down() and health.stats()["failures"] == 3
+
+
+@pytest.fixture
+def moodle(monkeypatch):
+    """ replaces the moodle call of validate_token, `moodle.answer` is returned (or raised) """
+    class Moodle:
+        answer = None
+        calls = 0
+
+        def fetch_user_settings(self, wstoken, userid):
+            self.calls += 1
+            if isinstance(self.answer, Exception):
+                raise self.answer
+            return self.answer
+    moodle = Moodle()
+    monkeypatch.setattr(tokencache, "fetch_user_settings", moodle.fetch_user_settings)
+    return moodle
+
+
+def test_validate_token_caches_valid_tokens(moodle):
+    cache = TokenValidationCache()
+    validate_token("token", 1, cache=cache, health=MoodleHealth())
+    validate_token("token", 1, cache=cache, health=MoodleHealth())
+    assert moodle.calls == 1
+
+
+def test_validate_token_rejects_invalid_tokens(moodle):
+    cache = TokenValidationCache()
+    moodle.answer = AssertionError()  # settings of another user / error answer
+    for _ in range(2):
+        with pytest.raises(InvalidTokenError):
+            validate_token("bad", 1, cache=cache, health=MoodleHealth())
+    assert moodle.calls == 1
+
+
+def test_validate_token_moodle_unavailable(moodle):
+    cache = TokenValidationCache()
+    health = MoodleHealth(failure_threshold=1, retry_interval=60.0)
+    moodle.answer = requests.ConnectionError()
+    with pytest.raises(MoodleUnavailableError):
+        validate_token("token", 1, cache=cache, health=health)
+    # connection errors are not cached as invalid tokens
+    assert cache.lookup(1, "token") is None
+    health.record_failure()
+    with pytest.raises(MoodleUnavailableError):
+        validate_token("token", 1, cache=cache, health=health)
+    assert moodle.calls == 1
@@ -0,0 +1,98 @@
+"""
+Local stand-in for an OpenAI compatible chat completion endpoint (`POST /v1/chat/completions`) for offline runs
+and tests of summarize_sections.py.
+
+Answers with the first sentences of the text after the last ": " of the last message (an extractive "summary"),
+with configurable latency, a request rate limit (HTTP 429 with Retry-After above the limit) and error rate.
+Request counts and the max. number of concurrent requests are reported at /stub/stats.
+
+Usage (from the repository root):
+    python tools/llm_stub.py --port 8090 --latency 500 --rate-limit 5
+    python summarize_sections.py --mbz course.mbz --llm-url http://localhost:8090/v1
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+import tornado.ioloop
+import tornado.web
+
+
+RE_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def summarize(text: str, num_sentences: int) -> str:
+    text = text.rsplit(": ", 1)[-1].strip()
+    return " ".join(RE_SENTENCE_END.split(text)[:num_sentences])
+
+
+class ChatCompletionHandler(tornado.web.RequestHandler):
+    def initialize(self, args, stats: dict):
+        self.args = args
+        self.stats = stats
+
+    async def post(self):
+        self.stats["requests"] += 1
+        now = time.monotonic()
+        # rate limit: sliding window of one second
+        self.stats["window"] = [start for start in self.stats["window"] if start > now - 1.0]
+        if self.args.rate_limit > 0 and len(self.stats["window"]) >= self.args.rate_limit:
+            self.stats["rate_limited"] += 1
+            self.set_status(429)
+            self.set_header("Retry-After", "1")
+            return self.write({"error": {"message": "Rate limit reached", "type": "requests"}})
+        self.stats["window"].append(now)
+
+        self.stats["active"] += 1
+        self.stats["max_concurrent"] = max(self.stats["max_concurrent"], self.stats["active"])
+        try:
+            await asyncio.sleep(random.expovariate(1000.0 / self.args.latency) if self.args.latency > 0 else 0.0)
+        finally:
+            self.stats["active"] -= 1
+        if random.random() < self.args.error_rate:
+            self.stats["errors"] += 1
+            self.set_status(500)
+            return self.write({"error": {"message": "injected error", "type": "server_error"}})
+
+        request = json.loads(self.request.body)
+        content = summarize(request["messages"][-1]["content"], self.args.sentences)
+        self.write({
+            "id": f"chatcmpl-stub-{self.stats['requests']}", "object": "chat.completion", "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, stats: dict):
+        self.stats = stats
+
+    def get(self):
+        self.write({key: value for key, value in self.stats.items() if key != "window"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local chat completion endpoint stub")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=200.0, help="mean response latency in ms (exponentially distributed)")
+    parser.add_argument("--rate-limit", type=float, default=0, help="max. requests per second, more are answered with HTTP 429 (0: unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--sentences", type=int, default=2, help="number of sentences of the answers")
+    args = parser.parse_args()
+
+    stats = {"requests": 0, "rate_limited": 0, "errors": 0, "active": 0, "max_concurrent": 0, "window": []}
+    app = tornado.web.Application([
+        (r"/v1/chat/completions", ChatCompletionHandler, dict(args=args, stats=stats)),
+        (r"/stub/stats", StatsHandler, dict(stats=stats)),
+    ])
+    app.listen(args.port)
+    print(f"llm stub listening on port {args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+Local stand-in for the moodle web service (`webservice/rest/server.php`) for offline benchmarking and testing.
+
+Implements all `block_chatbot_*` functions used in elearning/moodledb.py (and elearning/dbloggerhandler.py) and
+`block_booksearch_get_searched_locations` (elearning/booksearch.py) on top of synthetic courses, users, completions,
+grades, badges, glossaries and books. The data is generated from a seed, so runs are reproducible.
+Latency and error rates can be configured (globally and per web service function).
+
+Usage (from the repository root):
+    python tools/moodle_stub.py --port 8081 --latency 40 --latency-dist lognormal --error-rate 0.01
+    MOODLE_SERVER_WEB_HOST=localhost:8081 MOODLE_SERVER_SSL=false python run_server.py
+
+Also answers `core_completion_get_activities_completion_status`, `core_course_get_contents` and writes the course graphs of the synthetic courses
+(`--write-graphs resources/course_graphs`), so the local course navigation of elearning/coursegraph.py can be tested.
+
+Tokens starting with "invalid" are rejected like moodle does for unknown tokens (errorcode "invalidtoken").
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import time
+from typing import Dict, List
+
+import tornado.ioloop
+import tornado.web
+
+
+INCLUDE_TYPES = ["url", "book", "resource", "h5pactivity", "quiz", "icecreamgame"]
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class _Module:
+    def __init__(self, cmid: int, course, section, typename: str, name: str):
+        self.cmid = cmid
+        self.course = course
+        self.section = section
+        self.typename = typename
+        self.name = name
+
+
+class _Section:
+    def __init__(self, sectionid: int, course, index: int, name: str, branch: str):
+        self.id = sectionid
+        self.course = course
+        self.index = index  # position of the section in the course
+        self.name = name
+        self.branch = branch  # topic letter
+        self.modules: List[_Module] = []
+
+
+class _Course:
+    def __init__(self, courseid: int):
+        self.id = courseid
+        self.sections: List[_Section] = []
+        self.badges = []     # (badge id, name, required cmids)
+        self.glossary = []   # (entry id, concept, definition)
+        self.book_pages = [] # (filename, page number, chapter url, text)
+
+    def modules(self, include_types: List[str] = INCLUDE_TYPES) -> List[_Module]:
+        return [module for section in self.sections for module in section.modules if module.typename in include_types]
+
+
+class _UserProgress:
+    """ Completion state, access times and quiz grades of one user (generated on first access) """
+
+    def __init__(self, userid: int, world: "SyntheticMoodle", completion_rate: float):
+        rng = random.Random(f"{world.seed}-user-{userid}")
+        now = int(time.time())
+        self.created = now - rng.randint(0, 60) * SECONDS_PER_DAY
+        self.completion = {}  # cmid -> completion state (1: completed)
+        self.timeaccess = {}  # cmid -> last access (unix timestamp)
+        self.grades = {}      # quiz cmid -> (grade in percent, attempt timestamp)
+        for course in world.courses.values():
+            # users work through a course in order: complete a prefix of the modules, with some gaps
+            modules = course.modules()
+            num_done = int(len(modules) * min(1.0, max(0.0, rng.gauss(completion_rate, 0.2))))
+            for idx, module in enumerate(modules):
+                if idx < num_done or rng.random() < 0.05:
+                    self.timeaccess[module.cmid] = now - rng.randint(1, 40 * SECONDS_PER_DAY)
+                    self.completion[module.cmid] = 1 if idx < num_done else 0
+                    if module.typename in ("quiz", "h5pactivity"):
+                        self.grades[module.cmid] = (round(rng.uniform(20.0, 100.0), 1), self.timeaccess[module.cmid])
+
+
+class SyntheticMoodle:
+    """ Synthetic moodle site answering the web service functions of the chatbot plugin """
+
+    def __init__(self, num_courses: int = 2, num_sections: int = 6, modules_per_section: int = 6,
+                 completion_rate: float = 0.4, seed: int = 0, host: str = "localhost"):
+        self.seed = seed
+        self.host = host
+        self.completion_rate = completion_rate
+        self.courses: Dict[int, _Course] = {}
+        self.sections: Dict[int, _Section] = {}
+        self.modules: Dict[int, _Module] = {}
+        self.badges: Dict[int, tuple] = {}
+        self.users: Dict[int, _UserProgress] = {}
+        rng = random.Random(seed)
+
+        cmid = 1
+        sectionid = 1
+        for courseid in range(2, 2 + num_courses):
+            course = _Course(courseid)
+            for index in range(num_sections):
+                branch = string.ascii_uppercase[index % 26]
+                section = _Section(sectionid, course, index + 1, f"Thema {branch}: Abschnitt {index + 1}", branch)
+                for position in range(modules_per_section):
+                    # every section ends with a quiz, the course contains one ice cream game
+                    if position == modules_per_section - 1:
+                        typename = "quiz" if index != num_sections - 1 else "icecreamgame"
+                    else:
+                        typename = rng.choice(["url", "book", "resource", "h5pactivity"])
+                    module = _Module(cmid, course, section, typename, f"{typename.capitalize()} {branch}{position + 1}")
+                    section.modules.append(module)
+                    self.modules[cmid] = module
+                    cmid += 1
+                course.sections.append(section)
+                self.sections[sectionid] = section
+                sectionid += 1
+            # badges: one per two sections, requires all modules of these sections
+            for badge_idx in range(0, num_sections, 2):
+                badgeid = len(self.badges) + 1
+                required = [module.cmid for section in course.sections[badge_idx:badge_idx + 2] for module in section.modules]
+                badge = (badgeid, f"Badge {course.sections[badge_idx].branch}", required, courseid)
+                course.badges.append(badge)
+                self.badges[badgeid] = badge
+            for entry_idx in range(30):
+                concept = f"Begriff{courseid}x{entry_idx}"
+                course.glossary.append((courseid * 1000 + entry_idx, concept,
+                                        f"{concept} bezeichnet ein Konzept aus {course.sections[entry_idx % num_sections].name}."))
+            for module in course.modules(["book"]):
+                for page in range(1, 4):
+                    course.book_pages.append((f"{module.name}.pdf", page,
+                                              f"http://{self.host}/mod/book/view.php?id={module.cmid}&chapterid={page}",
+                                              f"Seite {page} von {module.name}: " +
+                                              " ".join(concept for _, concept, _ in rng.sample(course.glossary, 5))))
+            self.courses[courseid] = course
+
+    # helpers
+    def _user(self, userid: int) -> _UserProgress:
+        if userid not in self.users:
+            self.users[userid] = _UserProgress(userid, self, self.completion_rate)
+        return self.users[userid]
+
+    @staticmethod
+    def _types(includetypes: str) -> List[str]:
+        return [typename.strip() for typename in includetypes.split(",") if typename.strip()] if includetypes else INCLUDE_TYPES
+
+    def _next_module(self, user: _UserProgress, modules: List[_Module], allow_only_unfinished: bool):
+        for module in modules:
+            if not allow_only_unfinished or user.completion.get(module.cmid, 0) != 1:
+                return module
+        return None
+
+    def _course_progress(self, user: _UserProgress, course: _Course, include_types: List[str]) -> float:
+        modules = course.modules(include_types)
+        if len(modules) == 0:
+            return 0.0
+        return 100.0 * sum(1 for module in modules if user.completion.get(module.cmid, 0) == 1) / len(modules)
+
+    # web service functions (name without the "block_chatbot_" prefix)
+    def get_usersettings(self, userid: int):
+        return {"userid": userid, "preferedcontenttype": "book", "preferedcontenttypeid": 1, "enabled": True, "firstturn": False,
+                "logging": True, "numsearchresults": 5, "numreviewquizzes": 3, "openonlogin": True, "openonquiz": True,
+                "openonsection": True, "openonbranch": True, "openonbadge": True}
+
+    def get_branch_quizes_if_complete(self, userid: int, sectionid: int, includetypes: str = ""):
+        user = self._user(userid)
+        section = self.sections[sectionid]
+        branch_sections = [other for other in section.course.sections if other.branch == section.branch]
+        modules = [module for other in branch_sections for module in other.modules if module.typename in self._types(includetypes)]
+        completed = all(user.completion.get(module.cmid, 0) == 1 for module in modules)
+        candidates = [{"cmid": module.cmid, "grade": user.grades.get(module.cmid, (None,))[0]}
+                      for module in modules if module.typename in ("quiz", "h5pactivity")]
+        return {"completed": completed, "branch": section.branch, "candidates": candidates if completed else []}
+
+    def get_section_id(self, cmid: int):
+        section = self.modules[cmid].section
+        return {"id": section.id, "name": section.name}
+
+    def get_section_completionstate(self, userid: int, sectionid: int, includetypes: str = ""):
+        user = self._user(userid)
+        modules = [module for module in self.sections[sectionid].modules if module.typename in self._types(includetypes)]
+        return {"completed": all(user.completion.get(module.cmid, 0) == 1 for module in modules)}
+
+    def has_seen_any_course_modules(self, userid: int, courseid: int):
+        user = self._user(userid)
+        return {"seen": any(module.cmid in user.timeaccess for module in self.courses[courseid].modules())}
+
+    def get_last_viewed_course_modules(self, userid: int, courseid: int, completed: int = 0, includetypes: str = ""):
+        user = self._user(userid)
+        viewed = [module for module in self.courses[courseid].modules(self._types(includetypes))
+                  if module.cmid in user.timeaccess and user.completion.get(module.cmid, 0) == completed]
+        viewed.sort(key=lambda module: user.timeaccess[module.cmid], reverse=True)
+        return [{"cmid": module.cmid, "section": module.section.id, "timeaccess": user.timeaccess[module.cmid],
+                 "completionstate": user.completion.get(module.cmid, 0)} for module in viewed[:1]]
+
+    def get_first_available_course_module(self, userid: int, courseid: int, sectionid: int, includetypes: str = "",
+                                          allowonlyunfinished: int = 0):
+        modules = [module for module in self.sections[sectionid].modules if module.typename in self._types(includetypes)]
+        module = self._next_module(self._user(userid), modules, bool(allowonlyunfinished))
+        return {"cmid": module.cmid if module is not None else None}
+
+    def get_course_module_content_link(self, cmid: int):
+        module = self.modules[cmid]
+        return {"url": f"http://{self.host}/mod/{module.typename}/view.php?id={cmid}", "name": module.name, "typename": module.typename}
+
+    def get_available_new_course_sections(self, userid: int, courseid: int):
+        user = self._user(userid)
+        sections = []
+        for section in self.courses[courseid].sections:
+            if any(module.cmid in user.timeaccess for module in section.modules):
+                continue
+            sections.append({"id": section.id, "section": section.index, "name": section.name,
+                             "url": f"http://{self.host}/course/view.php?id={courseid}#section-{section.index}",
+                             "firstcmid": section.modules[0].cmid if section.modules else None})
+        return sections
+
+    def get_icecreamgame_course_module_id(self, courseid: int):
+        games = self.courses[courseid].modules(["icecreamgame"])
+        return {"id": games[0].cmid if games else None}
+
+    def core_completion_get_activities_completion_status(self, courseid: int, userid: int):
+        # moodle core function (used with the course graphs of elearning/coursegraph.py)
+        user = self._user(userid)
+        return {"statuses": [{"cmid": module.cmid, "modname": module.typename, "instance": module.cmid,
+                              "state": user.completion.get(module.cmid, 0), "tracking": 1,
+                              "timecompleted": user.timeaccess[module.cmid] if user.completion.get(module.cmid, 0) else 0}
+                             for module in self.courses[courseid].modules()], "warnings": []}
+
+    def core_course_get_contents(self, courseid: int):
+        # moodle core function (used by summarize_sections.py)
+        return [{"id": section.id, "section": section.index, "name": section.name, "visible": 1, "summaryformat": 1,
+                 "summary": f"<p>In diesem Abschnitt lernen Sie <strong>Thema {section.branch}</strong> kennen.</p>"
+                            f"<p>{' '.join(concept for _, concept, _ in section.course.glossary[section.index::len(section.course.sections)])}</p>",
+                 "modules": [{"id": module.cmid, "name": module.name, "modname": module.typename} for module in section.modules]}
+                for section in self.courses[courseid].sections]
+
+    def course_graph(self, courseid: int) -> dict:
+        """ Course structure in the course graph format written by tools/tag_mbz.py --graph """
+        course = self.courses[courseid]
+        return {
+            "format": 1,
+            "courseid": courseid,
+            "sections": [{"id": section.id, "section": section.index, "name": section.name, "branch": section.branch, "visible": True,
+                          "modules": [module.cmid for module in section.modules]} for section in course.sections],
+            "modules": {str(module.cmid): {"type": module.typename, "name": module.name, "topic": module.section.branch,
+                                           "tags": [f"Thema:{module.section.branch}"], "visible": True, "completion": 1}
+                        for module in course.modules()},
+        }
+
+    def get_next_available_course_module_id(self, userid: int, cmid: int, includetypes: str = "", allowonlyunfinished: int = 0,
+                                            currentcoursemodulecompletion: int = 0):
+        current = self.modules[cmid]
+        modules = current.course.modules(self._types(includetypes))
+        following = [module for module in modules if module.cmid > cmid]
+        module = self._next_module(self._user(userid), following, bool(allowonlyunfinished))
+        return {"cmid": module.cmid if module is not None else None}
+
+    def count_completed_course_modules(self, userid: int, courseid: int, includetypes: str = "", starttime: int = 0, endtime: int = 0):
+        user = self._user(userid)
+        return {"count": sum(1 for module in self.courses[courseid].modules(self._types(includetypes))
+                             if user.completion.get(module.cmid, 0) == 1 and starttime <= user.timeaccess.get(module.cmid, -1) <= endtime)}
+
+    def get_user_statistics(self, userid: int, courseid: int, includetypes: str = "", updatedb: int = 0):
+        user = self._user(userid)
+        quizzes = [module for module in self.courses[courseid].modules(["quiz", "h5pactivity"]) if module.cmid in user.grades]
+        repeated = [module for module in quizzes if user.grades[module.cmid][0] >= 80.0]
+        return {"course_completion_percentage": self._course_progress(user, self.courses[courseid], self._types(includetypes)),
+                "quiz_repetition_percentage": 100.0 * len(repeated) / len(quizzes) if quizzes else 0.0}
+
+    def get_last_user_weekly_summary(self, userid: int, courseid: int, includetypes: str = "", updatedb: int = 0):
+        user = self._user(userid)
+        return {"first_turn_ever": False, "first_week": time.time() - user.created < 7 * SECONDS_PER_DAY,
+                "timecreated": user.created,
+                "course_progress_percentage": self._course_progress(user, self.courses[courseid], self._types(includetypes))}
+
+    def get_closest_badge(self, userid: int, courseid: int):
+        user = self._user(userid)
+        best = None
+        for badgeid, name, required, _ in self.courses[courseid].badges:
+            open_modules = [cmid for cmid in required if user.completion.get(cmid, 0) != 1]
+            completion = 100.0 * (len(required) - len(open_modules)) / len(required)
+            if open_modules and (best is None or completion > best["completion_percentage"]):
+                best = {"id": badgeid, "name": name, "completion_percentage": completion, "open_modules": open_modules}
+        return best
+
+    def get_badge_info(self, badgeid: int, contextid: int = 0):
+        badgeid, name, _, _ = self.badges[badgeid]
+        return {"id": badgeid, "name": name, "url": f"http://{self.host}/pluginfile.php/{contextid}/badges/badgeimage/{badgeid}/f1"}
+
+    def get_h5pquiz_params(self, cmid: int):
+        return {"host": f"http://{self.host}", "context": 1000 + cmid, "filearea": "package", "itemid": 0,
+                "filename": f"{self.modules[cmid].name}.h5p"}
+
+    def get_oldest_worst_grade_attempts(self, userid: int, courseid: int, max_results: int = 3):
+        user = self._user(userid)
+        attempts = [(grade, timestamp, module.cmid) for module in self.courses[courseid].modules(["quiz", "h5pactivity"])
+                    if module.cmid in user.grades for grade, timestamp in [user.grades[module.cmid]]]
+        attempts.sort()
+        return [{"cmid": cmid, "grade": grade} for grade, _, cmid in attempts[:max_results]]
+
+    def search_glossary(self, userid: int, courseid: int, searchterm: str, fullsearch: int = 1, startidx: int = 0, limit: int = 0):
+        term = searchterm.lower()
+        results = [{"id": entryid, "glossaryid": courseid, "concept": concept, "definition": definition}
+                   for entryid, concept, definition in self.courses[courseid].glossary
+                   if term in concept.lower() or (fullsearch and term in definition.lower())]
+        if startidx == 0 and limit == 0:
+            return results
+        return results[startidx:startidx + limit]
+
+    def log_interaction(self, userid: int, courseid: int, speaker: str, message: str, act: str):
+        return True
+
+    def booksearch_get_searched_locations(self, searchstring: str, courseid: int, contextlength: int = 3, userid: int = 0):
+        term = searchstring.lower()
+        results = []
+        for filename, page, url, text in self.courses[courseid].book_pages:
+            words = text.split()
+            for idx, word in enumerate(words):
+                if term in word.lower():
+                    snippet = " ".join(words[max(0, idx - contextlength):idx + contextlength + 1])
+                    results.append({"book_chapter_url": url, "context_snippet": f"... {snippet} ...", "filename": filename,
+                                    "page_number": page})
+                    break
+        # NOTE: the booksearch plugin returns a JSON encoded string
+        return json.dumps(results)
+
+
+class LatencyModel:
+    """ Draws response delays (seconds) from a distribution with the given mean """
+
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(self, mean_ms: float = 0.0, distribution: str = "lognormal", rng: random.Random = None):
+        assert distribution in LatencyModel.DISTRIBUTIONS, f"unknown latency distribution {distribution}"
+        self.mean = mean_ms / 1000.0
+        self.distribution = distribution
+        self.rng = rng if rng is not None else random.Random()
+
+    def sample(self) -> float:
+        if self.mean <= 0.0:
+            return 0.0
+        if self.distribution == "fixed":
+            return self.mean
+        if self.distribution == "uniform":
+            return self.rng.uniform(0.0, 2.0 * self.mean)
+        if self.distribution == "exponential":
+            return self.rng.expovariate(1.0 / self.mean)
+        # lognormal with sigma 0.5 (long tail), scaled to the requested mean
+        sigma = 0.5
+        return self.rng.lognormvariate(0.0, sigma) * self.mean / (2.718281828459045 ** (sigma * sigma / 2.0))
+
+
+_PARAM_TYPES = {"userid": int, "courseid": int, "sectionid": int, "cmid": int, "badgeid": int, "contextid": int, "completed": int,
+                "allowonlyunfinished": int, "currentcoursemodulecompletion": int, "updatedb": int, "max_results": int,
+                "fullsearch": int, "startidx": int, "limit": int, "contextlength": int, "starttime": int, "endtime": int}
+
+
+class WebServiceHandler(tornado.web.RequestHandler):
+    """ Handles POST requests to webservice/rest/server.php like moodle's REST protocol (moodlewsrestformat=json) """
+
+    def initialize(self, world: SyntheticMoodle, latency: LatencyModel, function_latency: Dict[str, LatencyModel],
+                   error_rate: float, http_error_rate: float, stats: dict):
+        self.world = world
+        self.latency = latency
+        self.function_latency = function_latency
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.stats = stats
+
+    def _exception(self, errorcode: str, message: str):
+        self.write(json.dumps({"exception": "moodle_exception", "errorcode": errorcode, "message": message}))
+
+    async def post(self):
+        wsfunction = self.get_body_argument("wsfunction", "")
+        self.stats[wsfunction] = self.stats.get(wsfunction, 0) + 1
+        await asyncio.sleep(self.function_latency.get(wsfunction, self.latency).sample())
+        self.set_header("Content-Type", "application/json")
+
+        if self.latency.rng.random() < self.http_error_rate:
+            self.set_status(503)
+            return
+        if self.get_body_argument("wstoken", "").startswith("invalid"):
+            return self._exception("invalidtoken", "Invalid token - token not found")
+        if self.latency.rng.random() < self.error_rate:
+            return self._exception("stub_error", f"injected error for {wsfunction}")
+
+        name = wsfunction
+        for prefix in ("block_chatbot_", "block_"):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+                break
+        handler = getattr(self.world, name, None) if not name.startswith("_") else None
+        if handler is None:
+            return self._exception("invalidrecord", f"Can't find data record in database table external_functions. ({wsfunction})")
+        params = {key: values[0].decode("utf-8") for key, values in self.request.body_arguments.items()
+                  if key not in ("wstoken", "wsfunction", "moodlewsrestformat")}
+        try:
+            params = {key: _PARAM_TYPES[key](value) if key in _PARAM_TYPES else value for key, value in params.items()}
+            self.write(json.dumps(handler(**params)))
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            self._exception("invalidparameter", f"Invalid parameter value detected ({e!r})")
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    """ Number of requests per web service function """
+
+    def initialize(self, stats: dict):
+        self.stats = stats
+
+    def get(self):
+        self.write(self.stats)
+
+
+def make_app(world: SyntheticMoodle, latency: LatencyModel, function_latency: Dict[str, LatencyModel] = {},
+             error_rate: float = 0.0, http_error_rate: float = 0.0) -> tornado.web.Application:
+    stats = {}
+    return tornado.web.Application([
+        (r"/webservice/rest/server.php", WebServiceHandler, dict(world=world, latency=latency, function_latency=function_latency,
+                                                                 error_rate=error_rate, http_error_rate=http_error_rate, stats=stats)),
+        (r"/stub/stats", StatsHandler, dict(stats=stats)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local moodle web service stub")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--host", default="localhost", help="host name used in generated links")
+    parser.add_argument("--courses", type=int, default=2, help="number of courses (course ids start at 2)")
+    parser.add_argument("--sections", type=int, default=6, help="sections per course")
+    parser.add_argument("--modules", type=int, default=6, help="course modules per section")
+    parser.add_argument("--completion-rate", type=float, default=0.4, help="avg. share of completed course modules per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response latency in ms")
+    parser.add_argument("--latency-dist", default="lognormal", choices=LatencyModel.DISTRIBUTIONS)
+    parser.add_argument("--function-latency", action="append", default=[], metavar="WSFUNCTION=MS",
+                        help="mean latency of a single web service function, e.g. block_chatbot_get_user_statistics=200")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a moodle exception")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="share of requests answered with HTTP 503")
+    parser.add_argument("--write-graphs", metavar="DIR", help="write the course graphs of the synthetic courses (for elearning/coursegraph.py) into DIR")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    world = SyntheticMoodle(num_courses=args.courses, num_sections=args.sections, modules_per_section=args.modules,
+                            completion_rate=args.completion_rate, seed=args.seed, host=args.host)
+    function_latency = {}
+    for entry in args.function_latency:
+        wsfunction, mean_ms = entry.split("=")
+        function_latency[wsfunction] = LatencyModel(float(mean_ms), args.latency_dist, rng)
+    if args.write_graphs:
+        os.makedirs(args.write_graphs, exist_ok=True)
+        for courseid in world.courses:
+            with open(os.path.join(args.write_graphs, f"course_{courseid}.json"), "w", encoding="utf-8") as graph_file:
+                json.dump(world.course_graph(courseid), graph_file, ensure_ascii=False)
+    app = make_app(world, LatencyModel(args.latency, args.latency_dist, rng), function_latency, args.error_rate, args.http_error_rate)
+    app.listen(args.port)
+    print(f"moodle stub: {len(world.courses)} courses, {len(world.modules)} course modules, listening on port {args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
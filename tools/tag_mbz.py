@@ -1,67 +1,39 @@
+"""
+Tags the course modules of moodle course backups (.mbz) with their branch topic (Thema:<branch>)
+and optionally writes the course graph used by elearning/coursegraph.py.
+
+Backups are processed as streams (no extraction to disk): a first pass over the archive collects the section and
+activity XML files (activity files are parsed in a process pool), a second pass copies the archive into the tagged
+backup and replaces the changed module.xml files. Each backup is written into its own temporary directory
+(next to the output file) and moved into place when it is complete, so several backups can be processed in one run
+(or by concurrent runs).
+
+Usage:
+    python tools/tag_mbz.py backup1 [backup2.mbz ...] [--graph-dir resources/course_graphs] [--workers 8]
+    -> backup1_tagged.mbz, backup2_tagged.mbz, ...
+"""
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-import glob
+import io
+import json
 import os
 import re
-import shutil
-from typing import Dict
+import sys
+import tarfile
+import tempfile
+from typing import Dict, List, Tuple
 import xml.etree.ElementTree as ET
 
 from tqdm import tqdm
-import subprocess
-
-
-def extract_mbz_file(file_path):
-    if not os.path.exists(file_path):
-        print("File does not exist.")
-        return
-    try:
-        if os.path.exists("./tmp"):
-            print("INFO: tmp directory already exists.")
-            return
-
-        # Create a temporary directory
-        os.makedirs('./tmp', exist_ok=True)
-
-        # Decompress the gzip file
-        subprocess.run(['tar', '-xzf', file_path, "--directory", './tmp']) #, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        print('Extraction successful!')
-    except Exception as e:
-        print(f'An error occurred: {e}')
-
-def compress_mbz_file(filename: str):
-    try:
-        # Create a gzip file
-        os.chdir('./tmp')
-        subprocess.run(['tar', '-czf', f'{filename}_tagged.mbz', '.']) # , stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        os.chdir('../')
-        shutil.move(f'./tmp/{filename}_tagged.mbz', f'{filename}_tagged.mbz')
-        # print('Compression successful!')
-
-        # Delete the temporary directory
-        shutil.rmtree('./tmp')
-
-    except Exception as e:
-        print(f'An error occurred: {e}')
-
-
-def read_xml_file(file_path):
-    if not os.path.exists(file_path):
-        print("File does not exist.")
-        return None
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        return root
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
-
-@dataclass  
+
+
+DEFAULT_WHITELIST = ['book', 'resource', 'url', 'quiz', 'label', 'h5pactivity', 'icecreamgame']
+ACTIVITY_PATTERN = re.compile(r'^activities/([a-z0-9]+)_(\d+)/(module|[a-z0-9]+)\.xml$')
+SECTION_PATTERN = re.compile(r'^sections/section_\d+/section\.xml$')
+
+
+@dataclass
 class CourseModule:
     cmid: int
     id: int
@@ -69,36 +41,116 @@ class CourseModule:
     type: str
     section: str
 
+@dataclass
+class ActivityInfo:
+    """ Contents of the module.xml / <type>.xml files of an activity """
+    module: CourseModule
+    visible: bool
+    completion: int
+    tags: List[Tuple[int, str]]  # (tag id, raw name)
+
 def get_unique_tag_id(tags: Dict[str, id]) -> int:
     if len(tags) == 0:
         return 1
     return max(tags.values()) + 1
 
-def get_module(cmid: str) -> CourseModule:
-    pattern = f'*_{cmid}'
-    matching_directories = glob.glob(pattern, root_dir='./tmp/activities')
-    assert len(matching_directories) == 1, f"Found {len(matching_directories)} directories matching {pattern}"
-    
-    module_type = matching_directories[0].split('_')[0]
-    root = read_xml_file(f'./tmp/activities/{matching_directories[0]}/{module_type}.xml')
-
-    if module_type == 'label':
-        # NOTE: label names are shortened, the full text is in the 'intro' field
-        name = root.find(module_type).find('intro').text
-    else:
-        name = root.find(module_type).find('name').text
-
-    return CourseModule(
-        cmid=cmid,
-        id=int(root.get('id')),
-        name=name,
-        type=module_type,
-        section=None
+def member_name(member: tarfile.TarInfo) -> str:
+    return member.name[2:] if member.name.startswith('./') else member.name
+
+def find_text(xml: bytes, path: List[str]) -> str:
+    """ Text of the first element at `path` (tags below the root element), parsed incrementally: stops as soon as it was found """
+    current = []
+    for event, elem in ET.iterparse(io.BytesIO(xml), events=('start', 'end')):
+        if event == 'start':
+            current.append(elem.tag)
+            continue
+        if current[1:] == path:
+            return elem.text
+        current.pop()
+        elem.clear()
+    return None
+
+def root_attribute(xml: bytes, attribute: str) -> str:
+    for _, elem in ET.iterparse(io.BytesIO(xml), events=('start',)):
+        return elem.get(attribute)
+
+def parse_activity(module_type: str, cmid: int, activity_xml: bytes, module_xml: bytes) -> ActivityInfo:
+    """ Reads name, visibility, completion tracking and tags of an activity (runs in the process pool) """
+    # NOTE: label names are shortened, the full text is in the 'intro' field
+    name = find_text(activity_xml, [module_type, 'intro' if module_type == 'label' else 'name'])
+    module_root = ET.fromstring(module_xml)
+    tags = [(int(tag.attrib['id']), tag.find('rawname').text) for tag in module_root.find('tags')]
+    return ActivityInfo(
+        module=CourseModule(cmid=cmid, id=int(root_attribute(activity_xml, 'id')), name=name, type=module_type, section=None),
+        visible=module_root.find('visible').text == '1',
+        completion=int(module_root.find('completion').text),
+        tags=tags
     )
 
-def add_section_tag(cm: CourseModule, tag_dict: Dict[str, id]):
-    # Read the XML file
-    root = read_xml_file(f'./tmp/activities/{cm.type}_{cm.cmid}/module.xml')
+def _parse_activity(args) -> ActivityInfo:
+    return parse_activity(*args)
+
+
+class Backup:
+    """ Section and activity XML files of a backup, read from the archive stream """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.courseid = None
+        self.sections: List[ET.Element] = []
+        self.module_xml: Dict[int, bytes] = {}     # cmid -> module.xml
+        self.module_paths: Dict[int, str] = {}     # cmid -> archive path of module.xml
+        self.activities: Dict[int, ActivityInfo] = {}
+
+    def read(self, pool: ProcessPoolExecutor):
+        activity_xml = {}  # cmid -> (type, <type>.xml)
+        with tarfile.open(self.path, 'r|gz') as archive:
+            for member in archive:
+                name = member_name(member)
+                if not member.isfile():
+                    continue
+                if name == 'moodle_backup.xml':
+                    self.courseid = int(find_text(archive.extractfile(member).read(), ['information', 'original_course_id']))
+                elif SECTION_PATTERN.match(name):
+                    self.sections.append(ET.fromstring(archive.extractfile(member).read()))
+                else:
+                    match = ACTIVITY_PATTERN.match(name)
+                    if match is None:
+                        continue
+                    module_type, cmid, filename = match.group(1), int(match.group(2)), match.group(3)
+                    if filename == 'module':
+                        self.module_xml[cmid] = archive.extractfile(member).read()
+                        self.module_paths[cmid] = member.name
+                    elif filename == module_type:
+                        activity_xml[cmid] = (module_type, archive.extractfile(member).read())
+        jobs = [(module_type, cmid, xml, self.module_xml[cmid]) for cmid, (module_type, xml) in activity_xml.items() if cmid in self.module_xml]
+        for info in pool.map(_parse_activity, jobs, chunksize=16):
+            self.activities[info.module.cmid] = info
+
+    def get_module(self, cmid: int) -> CourseModule:
+        assert cmid in self.activities, f"Found no activity for course module {cmid}"
+        module = self.activities[cmid].module
+        return CourseModule(cmid=module.cmid, id=module.id, name=module.name, type=module.type, section=None)
+
+    def write(self, output_path: str, replacements: Dict[str, bytes]):
+        """ Copies the archive into `output_path`, replacing the contents of the members in `replacements` (by archive path) """
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        with tempfile.TemporaryDirectory(prefix='tag_mbz_', dir=output_dir) as tmp_dir:
+            tmp_path = os.path.join(tmp_dir, os.path.basename(output_path))
+            with tarfile.open(self.path, 'r|gz') as archive, tarfile.open(tmp_path, 'w|gz') as output:
+                for member in archive:
+                    if member.isfile() and member.name in replacements:
+                        content = replacements[member.name]
+                        member.size = len(content)
+                        output.addfile(member, io.BytesIO(content))
+                    elif member.isfile():
+                        output.addfile(member, archive.extractfile(member))
+                    else:
+                        output.addfile(member)
+            os.replace(tmp_path, output_path)
+
+
+def add_section_tag(cm: CourseModule, root: ET.Element, tag_dict: Dict[str, id]):
     # find or create tag
     rawname = f"Thema:{cm.section}"
     if not rawname in tag_dict:
@@ -135,22 +187,13 @@ def add_section_tag(cm: CourseModule, tag_dict: Dict[str, id]):
         tag_name = ET.SubElement(tag, 'name')
         tag_name.text = rawname.lower()
 
-    # Save the modified XML file
-    tree = ET.ElementTree(root)
-    tree.write(f'./tmp/activities/{cm.type}_{cm.cmid}/module.xml')
 
-
-def find_all_tags(whitelist = ['book', 'resource', 'url', 'quiz', 'label', 'h5pactivity', 'icecreamgame']) -> Dict[str, id]:
+def find_all_tags(backup: Backup, whitelist = DEFAULT_WHITELIST) -> Dict[str, id]:
     tag_dict = {}
-    for activity in tqdm(glob.glob('./tmp/activities/*')):
-        activity_type = activity.split("/")[-1].split('_')[0]
-        if activity_type not in whitelist:
+    for activity in backup.activities.values():
+        if activity.module.type not in whitelist:
             continue
-        root = read_xml_file(f'{activity}/module.xml')
-        tags = root.find('tags')
-        for tag in tags:
-            id = int(tag.attrib['id'])
-            rawname = tag.find('rawname').text
+        for id, rawname in activity.tags:
             tag_dict[rawname] = id
     return tag_dict
 
@@ -180,48 +223,128 @@ def get_section_branch(section_name: str, top_level_section_name: str = None) ->
             print(f"WARNING: Section name {section_name} does not contain a branch id, but no top-level section id was provided")
     return extracted_section_branch
 
-def tag_activities(whitelist = ['book', 'resource', 'url', 'quiz', 'label', 'h5pactivity', 'icecreamgame']):
-    # get list of all existing tags
-    tags = find_all_tags(whitelist)
-
-    # list all files in the sections directory
-    sections = os.listdir('./tmp/sections')
-    for section in tqdm(sections):
-        root = read_xml_file(f'./tmp/sections/{section}/section.xml')
-
+def read_course_structure(backup: Backup) -> List[Tuple[ET.Element, str, List[CourseModule]]]:
+    """
+    Returns (section xml, branch of the section, course modules of the section) for all sections in course order.
+    The `section` of each course module is its branch topic: labels inside a section start a new topic for the following modules.
+    """
+    structure = []
+    for root in sorted(backup.sections, key=lambda root: int(root.find('number').text)):
         section_name = get_section_branch(root.find('name').text)
         top_level_section_name = section_name
         # if the section is from the ZQ, choose the section name as the section name.
         # if the section is from the DQR, choose the next label as section name.
 
+        modules = []
         sequence = root.find('sequence').text
         if sequence is None or sequence == "$@NULL@$":
             print(f'WARNING: Section {section_name}: No sequence found.')
-            continue
-        for cmid in sequence.split(','):
-            module = get_module(int(cmid))
-            module.section = section_name
-           
+        else:
+            for cmid in sequence.split(','):
+                module = backup.get_module(int(cmid))
+                module.section = section_name
+                if module.type == 'label' and "kann ich schon" not in module.name.lower():
+                    section_name = get_section_branch(module.name, top_level_section_name=top_level_section_name)
+                modules.append(module)
+        structure.append((root, top_level_section_name, modules))
+    return structure
+
+def tag_activities(backup: Backup, structure, whitelist = DEFAULT_WHITELIST) -> Dict[str, bytes]:
+    """ Returns the tagged module.xml files (archive path -> content) """
+    # get list of all existing tags
+    tags = find_all_tags(backup, whitelist)
+
+    tagged = {}
+    for root, branch, modules in structure:
+        for module in modules:
             if module.type == 'label' and "kann ich schon" not in module.name.lower():
-                section_name = get_section_branch(module.name, top_level_section_name=top_level_section_name)
-            elif module.type == 'label' and section_name == "abschluss":
+                # label starting a new topic
+                continue
+            elif module.type == 'label' and module.section == "abschluss":
                 # don't tag Abschluss labels: they would appear as a very big tag in the tag could block
-                continue 
-            else:
-                add_section_tag(cm=module, tag_dict=tags)
+                continue
+            module_root = ET.fromstring(backup.module_xml[module.cmid])
+            add_section_tag(cm=module, root=module_root, tag_dict=tags)
+            backup.activities[module.cmid].tags = [(int(tag.attrib['id']), tag.find('rawname').text) for tag in module_root.find('tags')]
+            tagged[backup.module_paths[module.cmid]] = ET.tostring(module_root, encoding='utf-8', xml_declaration=True)
+    return tagged
+
+def build_course_graph(backup: Backup, structure, types = ['book', 'resource', 'url', 'quiz', 'h5pactivity', 'icecreamgame']) -> dict:
+    """
+    Compact course structure for elearning/coursegraph.py: sections in course order with their modules in order,
+    type, name, branch topic, tags, visibility and completion tracking of each module (read after tagging).
+    """
+    sections = []
+    modules = {}
+    for root, branch, section_modules in structure:
+        name = root.find('name').text
+        sections.append({
+            "id": int(root.get('id')),
+            "section": int(root.find('number').text),
+            "name": None if name == "$@NULL@$" else name,
+            "branch": branch,
+            "visible": root.find('visible').text == '1',
+            "modules": [module.cmid for module in section_modules if module.type in types]
+        })
+        for module in section_modules:
+            if module.type not in types:
+                continue
+            activity = backup.activities[module.cmid]
+            modules[str(module.cmid)] = {
+                "type": module.type,
+                "name": module.name,
+                "topic": module.section,
+                "tags": [rawname for _, rawname in activity.tags],
+                "visible": activity.visible,
+                "completion": activity.completion  # 0: no completion tracking
+            }
+    return {"format": 1, "courseid": backup.courseid, "sections": sections, "modules": modules}
+
+def write_course_graph(graph: dict, file_path: str):
+    with open(file_path, 'w', encoding='utf-8') as graph_file:
+        json.dump(graph, graph_file, ensure_ascii=False, separators=(',', ':'))
+    print(f'Course graph ({len(graph["sections"])} sections, {len(graph["modules"])} modules) written to {file_path}')
+
+
+def process_backup(file_path: str, pool: ProcessPoolExecutor, graph_path: str = None, graph_only: bool = False):
+    """ Tags `<file_path>.mbz` into `<file_path>_tagged.mbz` (and writes the course graph to `graph_path`) """
+    backup = Backup(file_path + ".mbz")
+    backup.read(pool)
+    structure = read_course_structure(backup)
+    if not graph_only:
+        tagged = tag_activities(backup, structure)
+        backup.write(f'{file_path}_tagged.mbz', tagged)
+        print(f'{file_path}: {len(tagged)} course modules tagged, written to {file_path}_tagged.mbz')
+    if graph_path:
+        write_course_graph(build_course_graph(backup, structure), graph_path.format(courseid=backup.courseid))
+
 
 if __name__ == "__main__":
     # read filenames from command line
-    parser = argparse.ArgumentParser(description='Read filenames from command line')
-    parser.add_argument('file', type=str, help='File to read')
+    parser = argparse.ArgumentParser(description='Tag the course modules of moodle backups with their branch topic')
+    parser.add_argument('files', type=str, nargs='+', help='backup files (with or without .mbz)')
+    parser.add_argument('--graph', type=str, help='also write the course graph (JSON, see elearning/coursegraph.py) to this file '
+                                                  '(one backup only), e.g. resources/course_graphs/course_<id>.json')
+    parser.add_argument('--graph-dir', type=str, help='also write the course graphs of all backups (course_<courseid>.json) into this folder')
+    parser.add_argument('--graph-only', action='store_true', help='only write the course graphs, do not tag the backups')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes parsing the activities')
     args = parser.parse_args()
-    file_path = args.file
-
-    try:
-        extract_mbz_file(file_path + ".mbz")
-        tag_activities()
-        compress_mbz_file(file_path)
-
-
-    except Exception as e:
-        print(f'An error occurred: {e}')
\ No newline at end of file
+    if args.graph and len(args.files) > 1:
+        parser.error('--graph can only be used with a single backup, use --graph-dir')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for file_path in tqdm(args.files):
+            file_path = file_path[:-len('.mbz')] if file_path.endswith('.mbz') else file_path
+            graph_path = args.graph
+            if args.graph_dir:
+                os.makedirs(args.graph_dir, exist_ok=True)
+                graph_path = os.path.join(args.graph_dir, 'course_{courseid}.json')
+            elif args.graph_only and not graph_path:
+                graph_path = f'{file_path}_graph.json'
+            try:
+                process_backup(file_path, pool, graph_path=graph_path, graph_only=args.graph_only)
+            except Exception as e:
+                print(f'An error occurred ({file_path}.mbz): {e}')
+                failed.append(file_path)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,44 @@
+""" Consistent hashing for assigning users to worker processes. """
+import bisect
+import hashlib
+from typing import Any, List
+
+
+class ConsistentHashRing:
+    """
+    Maps keys (e.g. user ids) to nodes (e.g. worker processes).
+
+    Each node is placed on the ring several times (virtual nodes) to spread keys evenly.
+    Adding or removing a node only moves the keys of that node, all other keys keep their assignment.
+    """
+
+    def __init__(self, nodes: List[Any] = [], virtual_nodes: int = 64):
+        self.virtual_nodes = virtual_nodes
+        self._points = []   # sorted hash values of all virtual nodes
+        self._owners = {}   # hash value -> node
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], byteorder="big")
+
+    def add_node(self, node: Any):
+        for replica in range(self.virtual_nodes):
+            point = self._hash(f"{node}#{replica}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove_node(self, node: Any):
+        for replica in range(self.virtual_nodes):
+            point = self._hash(f"{node}#{replica}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def get_node(self, key: Any) -> Any:
+        """ Returns the node owning the given key (the first virtual node clockwise from the key's hash) """
+        assert len(self._points) > 0, "hash ring is empty"
+        idx = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[self._points[idx]]
@@ -0,0 +1,205 @@
+"""
+Lightweight in-process metrics (histograms and gauges / counters read from callbacks),
+exported in the Prometheus text format (see `render`, served at /metrics by run_server.py).
+
+Recording is cheap enough to stay enabled in production: every thread counts into its own buckets
+(created once per thread and label combination), so `observe` takes no lock.
+The per-thread counts are only summed up when the metrics are collected.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+_registry = {}  # metric name -> Histogram / Gauge (in order of registration)
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _HistogramChild:
+    """ Histogram for one combination of label values """
+
+    def __init__(self, buckets: Tuple[float]):
+        self._buckets = buckets
+        self._local = threading.local()
+        self._shards = []   # per thread: [count per bucket (incl. +Inf)..., sum, count]
+        self._lock = threading.Lock()
+
+    def _new_shard(self) -> list:
+        shard = [0] * (len(self._buckets) + 1) + [0.0, 0]
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def observe(self, value: float):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._new_shard()
+        shard[bisect.bisect_left(self._buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    @contextmanager
+    def time(self):
+        """ Observes the duration (seconds) of the with-block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """ Returns (cumulative bucket counts, sum, count) over all threads """
+        with self._lock:
+            shards = list(self._shards)
+        counts = [0] * (len(self._buckets) + 1)
+        total, count = 0.0, 0
+        for shard in shards:
+            for idx in range(len(counts)):
+                counts[idx] += shard[idx]
+            total += shard[-2]
+            count += shard[-1]
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class Histogram:
+    """
+    Histogram of observed values (e.g. latencies in seconds).
+
+    Usage:
+        TURN_LATENCY = metrics.histogram("ds_turn_latency_seconds", "...")
+        TURN_LATENCY.observe(0.3)
+        CALL_DURATION = metrics.histogram("ds_call_duration_seconds", "...", ["function"])
+        with CALL_DURATION.labels("NLU.extract_user_acts").time():
+            ...
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}     # label values -> _HistogramChild
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues) -> _HistogramChild:
+        child = self._children.get(labelvalues)
+        if child is None:
+            assert len(labelvalues) == len(self.labelnames), f"{self.name}: expected labels {self.labelnames}"
+            with self._lock:
+                child = self._children.setdefault(labelvalues, _HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def totals(self) -> Dict[Tuple, Tuple[float, int]]:
+        """ Returns (sum, count) of the observed values per combination of label values """
+        with self._lock:
+            children = list(self._children.items())
+        return {labelvalues: child.snapshot()[1:] for labelvalues, child in children}
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            children = list(self._children.items())
+        for labelvalues, child in children:
+            cumulative, total, count = child.snapshot()
+            for bucket, bucket_count in zip(self.buckets + (float("inf"),), cumulative):
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(bucket)}"')
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    Metric whose value(s) are read from a callback when the metrics are collected,
+    e.g. the number of open websockets or counters kept by other components.
+
+    The callback returns a number (no labels) or a dictionary {tuple of label values: number}.
+    """
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Union[float, Dict[Tuple, float]]],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge"):
+        assert metric_type in ("gauge", "counter"), f"unsupported metric type {metric_type}"
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+def _register(metric):
+    with _registry_lock:
+        if metric.name in _registry:
+            # e.g. module imported twice - keep the first instance, so all recordings end up in one metric
+            return _registry[metric.name]
+        _registry[metric.name] = metric
+        return metric
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """ Creates (or returns the already registered) histogram with the given name """
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name: str, documentation: str, callback: Callable, labelnames: Sequence[str] = (), metric_type: str = "gauge") -> Gauge:
+    """ Registers a metric read from `callback` on collection (replaces a previously registered callback with the same name) """
+    metric = Gauge(name, documentation, callback, labelnames, metric_type)
+    with _registry_lock:
+        _registry[name] = metric
+    return metric
+
+
+def render() -> str:
+    """ Returns all registered metrics in the Prometheus text exposition format """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.collect())
+        except Exception as e:
+            lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,214 @@
+"""
+On-demand profiling of functions decorated with `services.service.PublishSubscribe`.
+
+A profiling session targets one function, e.g. "ELearningPolicy.choose_sys_act" (service class name + function name),
+and ends after a number of calls and / or seconds. Results are written to `config.DS_PROFILE_DIR`:
+* mode "cprofile": deterministic profile of the calls, saved as pstats file (.prof, e.g. for snakeviz / flameprof)
+* mode "sample": statistical sampler (stack of the calling thread every `config.DS_PROFILE_SAMPLE_INTERVAL` seconds),
+  saved as collapsed stacks (.folded, input format of flamegraph.pl / speedscope)
+
+While no session is active, the PublishSubscribe wrapper only checks an empty dictionary per call.
+Sessions are controlled by the /admin/profile endpoint of run_server.py.
+"""
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import config
+
+
+CPROFILE = "cprofile"
+SAMPLE = "sample"
+MODES = (CPROFILE, SAMPLE)
+
+_sessions: Dict[str, "ProfileSession"] = {}  # target -> active session
+_sessions_lock = threading.Lock()
+_results: List[dict] = []                    # finished sessions (target, mode, calls, file)
+_targets = set()                             # functions that can be profiled in this process (see `register`)
+
+
+class ProfileSession:
+    """ Profiles the calls of one target function until `max_calls` calls were profiled or `max_seconds` passed """
+
+    def __init__(self, target: str, mode: str = CPROFILE, max_calls: int = None, max_seconds: float = None,
+                 output_dir: str = config.DS_PROFILE_DIR):
+        assert mode in MODES, f"unknown profiling mode {mode}"
+        assert max_calls is not None or max_seconds is not None, "profiling session needs a limit (calls or seconds)"
+        self.target = target
+        self.mode = mode
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self.output_dir = output_dir
+        self.started = time.time()
+        self.calls = 0
+        self.finished = False
+        self._lock = threading.Lock()
+        # cProfile can only profile one call at a time - concurrent calls run unprofiled
+        self._profiler = cProfile.Profile() if mode == CPROFILE else None
+        self._profiling = False
+        self._write_after_call = False  # finished while a call is profiled: write the result when the call ends
+        # sampler
+        self._sampled_threads = set()
+        self._stacks = defaultdict(int)
+        if max_seconds is not None:
+            timer = threading.Timer(max_seconds, self.finish)
+            timer.daemon = True
+            timer.start()
+        if mode == SAMPLE:
+            threading.Thread(target=self._sample, name=f"ProfileSampler-{target}", daemon=True).start()
+
+    def _begin(self) -> bool:
+        """ Returns True if the current call is profiled """
+        with self._lock:
+            if self.finished:
+                return False
+            if self.mode == CPROFILE:
+                if self._profiling:
+                    return False
+                self._profiling = True
+                self._profiler.enable()
+            else:
+                self._sampled_threads.add(threading.get_ident())
+            return True
+
+    def _end(self):
+        with self._lock:
+            if self.mode == CPROFILE:
+                # NOTE: the profiler can only be disabled by the profiled thread
+                self._profiler.disable()
+                self._profiling = False
+            else:
+                self._sampled_threads.discard(threading.get_ident())
+            self.calls += 1
+            done = self.max_calls is not None and self.calls >= self.max_calls
+            write = self._write_after_call
+            self._write_after_call = False
+        if write:
+            self._write()
+        elif done:
+            self.finish()
+
+    def call(self, func, *args, **kwargs):
+        """ Calls `func`, profiling the call if possible """
+        if not self._begin():
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._end()
+
+    async def call_async(self, func, *args, **kwargs):
+        """ Awaits the coroutine function `func`, profiling the call if possible (includes other tasks of the event loop) """
+        if not self._begin():
+            return await func(*args, **kwargs)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self._end()
+
+    def _sample(self):
+        interval = config.DS_PROFILE_SAMPLE_INTERVAL
+        while not self.finished:
+            time.sleep(interval)
+            with self._lock:
+                threads = list(self._sampled_threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self._stacks[";".join(reversed(stack))] += 1
+
+    def finish(self) -> Optional[str]:
+        """
+        Ends the session and writes the result file.
+        Returns the file path (None, if already finished, or if a profiled call is still running - then the file is
+        written as soon as the call returned).
+        """
+        with self._lock:
+            if self.finished:
+                return None
+            self.finished = True
+            self._write_after_call = self._profiling
+        with _sessions_lock:
+            if _sessions.get(self.target) is self:
+                del _sessions[self.target]
+        if self._write_after_call:
+            return None
+        return self._write()
+
+    def _write(self) -> Optional[str]:
+        try:
+            os.makedirs(os.path.realpath(self.output_dir), exist_ok=True)
+            file_name = f"{self.target}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{os.getpid()}"
+            if self.mode == CPROFILE:
+                path = os.path.join(self.output_dir, file_name + ".prof")
+                self._profiler.dump_stats(path)
+            else:
+                path = os.path.join(self.output_dir, file_name + ".folded")
+                with open(path, "w") as folded_file:
+                    for stack, count in list(self._stacks.items()):
+                        folded_file.write(f"{stack} {count}\n")
+        except:
+            logging.getLogger("error_log").error(traceback.format_exc())
+            return None
+        _results.append({"target": self.target, "mode": self.mode, "calls": self.calls, "file": path})
+        return path
+
+    def info(self) -> dict:
+        return {"target": self.target, "mode": self.mode, "calls": self.calls, "max_calls": self.max_calls,
+                "max_seconds": self.max_seconds, "running_for": time.time() - self.started}
+
+
+def session(target: str) -> Optional[ProfileSession]:
+    """ Returns the active profiling session for a function (called by the PublishSubscribe wrapper for every call) """
+    if not _sessions:
+        return None
+    return _sessions.get(target)
+
+
+def register(target: str):
+    """ Declares a PublishSubscribe function ("<service class>.<function name>") as profiling target (called by services.service.Service) """
+    _targets.add(target)
+
+
+def start(target: str, mode: str = CPROFILE, calls: int = None, seconds: float = None) -> ProfileSession:
+    """
+    Starts profiling the function `target` ("<service class>.<function name>").
+    A running session for the same target is finished first.
+    Raises ValueError if `target` is not a PublishSubscribe function of a service of this process (the session would never end).
+    """
+    if target not in _targets:
+        raise ValueError(f"unknown profiling target {target} (known: {', '.join(sorted(_targets))})")
+    stop(target)
+    new_session = ProfileSession(target, mode=mode, max_calls=calls, max_seconds=seconds)
+    with _sessions_lock:
+        _sessions[target] = new_session
+    return new_session
+
+
+def stop(target: str) -> Optional[str]:
+    """ Finishes the profiling session of `target`. Returns the path of the result file (None, if there was no session). """
+    with _sessions_lock:
+        active_session = _sessions.get(target)
+    return active_session.finish() if active_session is not None else None
+
+
+def status() -> dict:
+    """ Returns the active sessions, the result files of finished sessions and the functions that can be profiled """
+    with _sessions_lock:
+        active = [active_session.info() for active_session in _sessions.values()]
+    return {"active": active, "finished": list(_results), "targets": sorted(_targets)}
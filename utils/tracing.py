@@ -0,0 +1,124 @@
+"""
+Per-turn tracing across services.
+
+A trace is started for a sampled share of the turns (`config.DS_TRACE_SAMPLE_RATE`, see `trace`).
+The active trace context (trace id, id of the current span) is kept in a context variable:
+`services.service._send_msg` adds it to every message envelope, the listeners of the receiving services
+activate it again (`use_context`), so all functions decorated with PublishSubscribe record their spans in
+the same trace. Nested spans (e.g. moodle webservice calls) become children of the current span.
+
+Finished spans are written as JSON lines to `config.DS_TRACE_FILE` by a background thread:
+    {"trace_id": ..., "span_id": ..., "parent_id": ..., "name": ..., "start": <epoch seconds>, "duration": <seconds>,
+     "pid": ..., "attributes": {...}}
+Unsampled turns carry no trace context, so tracing costs one context variable lookup per message.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+import config
+
+
+_current: ContextVar = ContextVar("trace_context", default=None)  # [trace id, span id] of the active span
+
+
+def current() -> Optional[List[str]]:
+    """ Returns the active trace context [trace id, span id] (None, if the current turn is not traced) """
+    return _current.get()
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@contextmanager
+def use_context(context: Optional[List[str]]):
+    """ Activates a trace context received with a message (None: no trace) for the with-block """
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """ Records a span as child of the active span (does nothing if there is no active trace) """
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    span_id = _new_id()
+    token = _current.set([parent[0], span_id])
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        _Sink.get_instance().write({"trace_id": parent[0], "span_id": span_id, "parent_id": parent[1], "name": name,
+                                    "start": start, "duration": time.perf_counter() - start_counter, "pid": os.getpid(),
+                                    "attributes": attributes})
+
+
+@contextmanager
+def trace(name: str, sample_rate: float = None, **attributes):
+    """
+    Starts a new trace with a root span (only for a sampled share of calls, see `config.DS_TRACE_SAMPLE_RATE`).
+    Messages sent within the with-block carry the trace context.
+    """
+    sample_rate = config.DS_TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if sample_rate <= 0.0 or random.random() >= sample_rate:
+        with use_context(None):
+            yield
+        return
+    with use_context([uuid.uuid4().hex, None]):
+        with span(name, **attributes):
+            yield
+
+
+class _Sink:
+    """ Appends finished spans to the trace file (JSON lines) from a background thread """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name="TraceSink", daemon=True).start()
+
+    @classmethod
+    def get_instance(cls) -> "_Sink":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = _Sink(config.DS_TRACE_FILE)
+        return cls._instance
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def _run(self):
+        os.makedirs(os.path.dirname(os.path.realpath(self.path)), exist_ok=True)
+        with open(self.path, "a") as trace_file:
+            while True:
+                record = self._queue.get()
+                try:
+                    trace_file.write(json.dumps(record, default=str) + "\n")
+                    if self._queue.empty():
+                        trace_file.flush()
+                except:
+                    logging.getLogger("error_log").error(traceback.format_exc())
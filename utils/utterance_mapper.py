@@ -2,6 +2,9 @@ from sentence_transformers import SentenceTransformer, util
 import numpy
 import torch
 import os
+from utils import metrics
+
+_ENCODE_DURATION = metrics.histogram("nlu_encode_seconds", "Duration of encoding a user utterance with the sentence embedding model")
 
 class Utterance_Mapper():
     """
@@ -28,7 +31,8 @@ class Utterance_Mapper():
         """
         Returns the most similar utterance to the given utterance.
         """
-        query_embedding = self.embedder.encode(utterance, convert_to_tensor=True)
+        with _ENCODE_DURATION.time():
+            query_embedding = self.embedder.encode(utterance, convert_to_tensor=True)
         cos_scores = util.pytorch_cos_sim(query_embedding, self.embeddings)[0]
         top_results = torch.topk(cos_scores, k=1)
         mapped_utterance = self.corpus[top_results[1]]
@@ -41,7 +45,8 @@ class Utterance_Mapper():
         """
         Returns the label of the most similar utterance to the given utterance.
         """
-        query_embedding = self.embedder.encode(utterance, convert_to_tensor=True)
+        with _ENCODE_DURATION.time():
+            query_embedding = self.embedder.encode(utterance, convert_to_tensor=True)
         cos_scores = util.pytorch_cos_sim(query_embedding, self.embeddings)[0]
         #top_result = torch.topk(cos_scores, k=5)
         #print(top_result)